@@ -0,0 +1,277 @@
+import cv2
+import glob
+import hashlib
+import inspect
+import os
+import re
+import numpy as np
+
+from collections import OrderedDict
+
+chunk_frames = 64               # Frames per .npz chunk, reading one chunk pulls in all of its frames' records
+max_chunks_open = 2             # Chunks of each stage kept in memory, frames are normally visited in order
+
+chunk_name_pattern = r'^(.+)_([0-9a-f]{16})_\d{5}\.npz$'     # <stage>_<key>_<chunk index>.npz
+
+
+class CheckpointMiss(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+
+def get_recording_id(vid_path):
+
+    """ (absolute path, size in bytes, frame count) of a recording, for keying the stages reading its frames
+    """
+
+    frame_count_prop = cv2.CAP_PROP_FRAME_COUNT if hasattr(cv2, 'CAP_PROP_FRAME_COUNT') else cv2.cv.CV_CAP_PROP_FRAME_COUNT
+    vc = cv2.VideoCapture(vid_path)
+    num_frames = int(vc.get(frame_count_prop))
+    vc.release()
+
+    return os.path.abspath(vid_path), os.path.getsize(vid_path), num_frames
+
+
+def get_session_path(checkpoint_root, vid_path):
+
+    """ Directory of a recording's checkpoints under checkpoint_root
+    """
+
+    return os.path.join(checkpoint_root, os.path.splitext(os.path.basename(vid_path))[0])
+
+
+def get_code_version(modules):
+
+    """ Hash of the source of modules (module objects or names), so editing any of them changes stage keys
+    """
+
+    sha = hashlib.sha1()
+    for module in modules:
+        if isinstance(module, str): module = __import__(module)
+        with open(inspect.getsourcefile(module), 'rb') as source_file:
+            sha.update(source_file.read())
+    return sha.hexdigest()
+
+
+def get_stage_key(stage, params=None, code_version='', upstream_key=''):
+
+    """ Short hash of everything a stage's outputs depend on, including (via upstream_key) its inputs
+    """
+
+    # Arrays are listed in full, repr of a large array elides its middle
+    params = sorted((name, value.tolist() if isinstance(value, np.ndarray) else value)
+                    for (name, value) in (params or {}).items())
+    return hashlib.sha1(repr((stage, params, code_version, upstream_key))).hexdigest()[:16]
+
+
+class StageCheckpoint:
+
+    def __init__(self, path, stage, key, chunk_frames=chunk_frames, compress=True):
+
+        """ Per-frame records of one stage ~ {name: array}, in .npz chunks named by stage & key
+
+        Each record is stored under (frame_index, part), part telling apart e.g. eyes of one frame. Names with None
+        values are left out and read back as None. Records of other keys are never read, so changing a stage's
+        params or code invalidates its checkpoints (see CheckpointStore.purge_stale to delete them)
+        """
+
+        self.path = path
+        self.stage = stage
+        self.key = key
+        self.chunk_frames = chunk_frames
+        self.compress = compress
+
+        self.chunks = OrderedDict() # chunk index -> {entry name: array}, of recently used chunks, least recent first
+        self.dirty = set()          # chunks holding records not yet written
+
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+
+    def get_chunk_path(self, chunk_index):
+        return os.path.join(self.path, '%s_%s_%05d.npz' % (self.stage, self.key, chunk_index))
+
+    def get_chunk(self, frame_index):
+
+        chunk_index = frame_index / self.chunk_frames
+        if chunk_index in self.chunks:
+            self.chunks[chunk_index] = self.chunks.pop(chunk_index)        # now most recently used
+            return self.chunks[chunk_index]
+
+        # Least recently used chunk is written (if needed) & dropped
+        while len(self.chunks) >= max_chunks_open:
+            self.flush_chunk(next(iter(self.chunks)), drop=True)
+
+        chunk = {}
+        chunk_path = self.get_chunk_path(chunk_index)
+        if os.path.exists(chunk_path):
+            npz_file = np.load(chunk_path)
+            chunk = dict((name, npz_file[name]) for name in npz_file.files)
+            npz_file.close()
+
+        self.chunks[chunk_index] = chunk
+        return chunk
+
+    def get_record_id(self, frame_index, part):
+        return 'f%d_%s' % (frame_index, part)
+
+    def get(self, frame_index, part=''):
+
+        """ Record of frame ~ {name: array or None}, or None if there is none
+        """
+
+        chunk = self.get_chunk(frame_index)
+        record_id = self.get_record_id(frame_index, part)
+
+        if record_id not in chunk:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        names = chunk[record_id]
+        return dict((name, chunk.get('%s.%s' % (record_id, name))) for name in names.tolist())
+
+    def put(self, frame_index, record, part=''):
+
+        chunk = self.get_chunk(frame_index)
+        record_id = self.get_record_id(frame_index, part)
+
+        # Record id maps to its names, so a record whose values are all None still counts as present
+        chunk[record_id] = np.array(sorted(record.keys()))
+        for name, value in record.items():
+            entry_name = '%s.%s' % (record_id, name)
+            if value is None:
+                chunk.pop(entry_name, None)
+            else:
+                chunk[entry_name] = np.array(value)         # copied, ROI imgs are views of frames drawn on later
+
+        self.dirty.add(frame_index / self.chunk_frames)
+        self.puts += 1
+
+    def flush_chunk(self, chunk_index, drop=False):
+
+        if chunk_index in self.dirty:
+            save = np.savez_compressed if self.compress else np.savez
+            
+            # Written aside then renamed, so processes sharing a store never read half a chunk. Concurrent writers of
+            # one chunk can still drop each other's records, which only costs misses
+            chunk_path = self.get_chunk_path(chunk_index)
+            tmp_path = '%s.tmp%d.npz' % (chunk_path[:-len('.npz')], os.getpid())
+            save(tmp_path, **self.chunks[chunk_index])
+            if os.name == 'nt' and os.path.exists(chunk_path): os.remove(chunk_path)     # rename won't replace there
+            os.rename(tmp_path, chunk_path)
+            self.dirty.discard(chunk_index)
+
+        if drop: del self.chunks[chunk_index]
+
+    def flush(self):
+        for chunk_index in list(self.dirty): self.flush_chunk(chunk_index)
+
+    def get_summary(self):
+        return '%s: %d hits, %d misses, %d written' % (self.stage, self.hits, self.misses, self.puts)
+
+
+class CheckpointStore:
+
+    def __init__(self, path, chunk_frames=chunk_frames, compress=True, recording=None):
+
+        """ Per-session store of stage checkpoints in directory path
+
+        Stages are opened in pipeline order, each key chaining its upstream's key, so invalidating a stage also
+        invalidates everything downstream of it. recording (see get_recording_id) identifies the frames read, the
+        first stage is keyed on it so checkpoints of another recording in the same directory are never replayed
+        """
+
+        if not os.path.isdir(path): os.makedirs(path)
+
+        self.path = path
+        self.chunk_frames = chunk_frames
+        self.compress = compress
+        self.recording = recording
+        self.stages = {}
+        self.stage_order = []
+
+    def open_stage(self, stage, params=None, modules=(), upstream=None):
+
+        """ StageCheckpoint of stage, keyed on params ~ {name: value}, source of modules & upstream stage's key
+        """
+
+        upstream_key = self.stages[upstream].key if upstream is not None else ''
+        key = get_stage_key(stage, params, get_code_version(modules), upstream_key)
+
+        self.stages[stage] = StageCheckpoint(self.path, stage, key, self.chunk_frames, self.compress)
+        if stage not in self.stage_order: self.stage_order.append(stage)
+        return self.stages[stage]
+
+    def flush(self):
+        for stage in self.stage_order: self.stages[stage].flush()
+
+    def purge_stale(self):
+
+        """ Deletes chunks of opened stages written under any other key, returns how many
+        """
+
+        num_removed = 0
+        for chunk_path in glob.glob(os.path.join(self.path, '*.npz')):
+            match = re.match(chunk_name_pattern, os.path.basename(chunk_path))
+            if match is None: continue
+
+            stage, key = match.groups()
+            if stage in self.stages and key != self.stages[stage].key:
+                os.remove(chunk_path)
+                num_removed += 1
+
+        return num_removed
+
+    def get_summary(self):
+        return ', '.join(self.stages[stage].get_summary() for stage in self.stage_order)
+
+
+#----------------------------------------
+# EXAMPLE USAGE
+#----------------------------------------
+if __name__ == '__main__':
+
+    import cv2
+    import shutil
+    import tempfile
+    from find_limbus_points import get_limb_pts
+    from time import time
+
+    eye_imgs = []
+    for path in sorted(glob.glob('eye_images/*.png')):
+        eye_img = cv2.imread(path)
+        img_h, img_w = eye_img.shape[:2]
+        eye_imgs.append(np.ascontiguousarray(eye_img[:, (img_w - img_h) / 2:(img_w + img_h) / 2]))
+
+    session_path = tempfile.mkdtemp()
+    try:
+        for compress in [False, True]:
+            store = CheckpointStore(os.path.join(session_path, 'compressed' if compress else 'raw'), compress=compress)
+            checkpoint = store.open_stage('limbus_pts', {'phi': 20, 'angle_step': 1}, ['find_limbus_points'])
+
+            # First pass computes & writes, second reads back from disk in a fresh store
+            tick = time()
+            for frame_index, eye_img in enumerate(eye_imgs):
+                checkpoint.put(frame_index, {'img': eye_img, 'pts': get_limb_pts(eye_img), 'r_range': None}, 'e0')
+            store.flush()
+            write_ms = (time() - tick) * 1000 / len(eye_imgs)
+
+            store = CheckpointStore(store.path, compress=compress)
+            checkpoint = store.open_stage('limbus_pts', {'phi': 20, 'angle_step': 1}, ['find_limbus_points'])
+            tick = time()
+            records = [checkpoint.get(frame_index, 'e0') for frame_index in range(len(eye_imgs))]
+            read_ms = (time() - tick) * 1000 / len(eye_imgs)
+
+            same = all(np.array_equal(record['pts'], get_limb_pts(eye_img)) and record['r_range'] is None
+                       for (record, eye_img) in zip(records, eye_imgs))
+            size_kb = sum(os.path.getsize(p) for p in glob.glob(os.path.join(store.path, '*.npz'))) / 1024.0
+            print '%s: compute & write %0.2f ms, read %0.2f ms per frame, %0.1f KB per frame, identical: %s' % (
+                'Compressed' if compress else 'Raw', write_ms, read_ms, size_kb / len(eye_imgs), same)
+
+        # Other params give another key, so nothing is found until stale chunks are purged & rewritten
+        checkpoint = store.open_stage('limbus_pts', {'phi': 20, 'angle_step': 2}, ['find_limbus_points'])
+        print 'Changed params: %s' % ('miss' if checkpoint.get(0, 'e0') is None else 'hit')
+        print 'Stale chunks purged: %d' % store.purge_stale()
+    finally:
+        shutil.rmtree(session_path)
@@ -2,11 +2,93 @@ from math import sin, cos, radians, pow, sqrt
 
 import numpy as np
 
+from ellipse_scoring import get_sampson_distances
+
 class BadEllipseShape(Exception):
     def __init__(self, msg):
         self.msg = msg
 
 
+def rotated_rects_to_array(rotated_rects):
+    
+    """ Packs rotated_rects ((x0, y0), (w, h), angle) into an (N, 5) array of [x0, y0, w, h, angle]
+    """
+    
+    if isinstance(rotated_rects, np.ndarray): return rotated_rects.reshape(-1, 5).astype(float)
+    return np.array([[x0, y0, w, h, angle] for ((x0, y0), (w, h), angle) in rotated_rects], dtype=float).reshape(-1, 5)
+
+
+def get_conic_coeffs(rects):
+    
+    """ Vectorized version of Ellipse constructor for an (N, 5) rotated_rect array, returns (N, 6) [A B C D E F]
+    """
+    
+    ell_x0, ell_y0, ell_w, ell_h, angle = rects.T
+    axis_x, axis_y = np.cos(np.radians(angle)), np.sin(np.radians(angle))
+    a2 = ell_w * ell_w / 4
+    b2 = ell_h * ell_h / 4
+    
+    xx, yy, xy = axis_x * axis_x, axis_y * axis_y, axis_x * axis_y
+    
+    A = xx / a2 + yy / b2
+    B = 2 * xy / a2 - 2 * xy / b2
+    C = yy / a2 + xx / b2
+    D = (-2 * xy * ell_y0 - 2 * xx * ell_x0) / a2 + (2 * xy * ell_y0 - 2 * yy * ell_x0) / b2
+    E = (-2 * xy * ell_x0 - 2 * yy * ell_y0) / a2 + (2 * xy * ell_x0 - 2 * xx * ell_y0) / b2
+    F = (2 * xy * ell_x0 * ell_y0 + xx * ell_x0 * ell_x0 + yy * ell_y0 * ell_y0) / a2 + (-2 * xy * ell_x0 * ell_y0 + yy * ell_x0 * ell_x0 + xx * ell_y0 * ell_y0) / b2 - 1
+    
+    return np.column_stack([A, B, C, D, E, F])
+
+
+def conic_coeffs_to_rects(coeffs):
+    
+    """ Inverse of get_conic_coeffs for (N, 6) [A B C D E F], returns (N, 5) rotated_rects with w <= h and angle
+    in [0, 180), and validity (False where conic is not a real ellipse). Coeffs are also rescaled so Q = -1 at centre
+    """
+    
+    coeffs = np.array(coeffs, dtype=float).reshape(-1, 6)
+    A, B, C, D, E, F = coeffs.T
+    
+    det = 4 * A * C - B * B
+    valid = det > 0
+    det = np.where(valid, det, 1)
+    
+    x0 = (B * E - 2 * C * D) / det
+    y0 = (B * D - 2 * A * E) / det
+    
+    # Q at centre, which is -1 for conics from get_conic_coeffs
+    q0 = D * x0 / 2 + E * y0 / 2 + F
+    valid &= q0 * (A + C) < 0
+    q0 = np.where(valid, q0, -1)
+    coeffs /= -q0[:, np.newaxis]
+    A, B, C = coeffs[:, 0], coeffs[:, 1], coeffs[:, 2]
+    
+    # Eigenvalues 1/a^2 > 1/b^2 of quadratic part, axis a along angle
+    mean, diff = (A + C) / 2, np.sqrt((A - C) ** 2 + B ** 2) / 2
+    valid &= mean - diff > 0
+    inv_a2, inv_b2 = mean + diff, np.where(valid, mean - diff, 1)
+    
+    angle = np.degrees(0.5 * np.arctan2(B, A - C)) % 180
+    rects = np.column_stack([x0, y0, 2 / np.sqrt(inv_a2), 2 / np.sqrt(inv_b2), angle])
+    
+    return rects, coeffs, valid
+
+
+def shift_conic_coeffs(coeffs, dx, dy):
+    
+    """ Coeffs of conics moved by (dx, dy), i.e. Q'(x,y) = Q(x - dx, y - dy), without going back to rotated_rects
+    
+    coeffs ~ (6,) or (N, 6), dx & dy scalars or (N,) arrays
+    """
+    
+    A, B, C, D, E, F = np.asarray(coeffs, dtype=float).T
+    
+    return np.array([A, B, C,
+                     D - 2 * A * dx - B * dy,
+                     E - B * dx - 2 * C * dy,
+                     F + A * dx * dx + B * dx * dy + C * dy * dy - D * dx - E * dy]).T
+
+
 class Ellipse:
     
     def __init__(self, rotated_rect, coeffs=None):
@@ -35,6 +117,19 @@ class Ellipse:
             self.A,self.B,self.C,self.D,self.E,self.F = coeffs
 
 
+    def get_coeffs(self):
+        return np.array([self.A, self.B, self.C, self.D, self.E, self.F])
+    
+    
+    def shifted(self, dx, dy):
+        
+        """ Same ellipse moved by (dx, dy), e.g. from ROI to frame coords
+        """
+        
+        (x0, y0), axes, angle = self.rotated_rect
+        return Ellipse(((x0 + dx, y0 + dy), axes, angle), shift_conic_coeffs(self.get_coeffs(), dx, dy))
+
+
     def algebraic_distance(self, (px, py)):
         
         """ Returns value of Q at x,y
@@ -107,20 +202,159 @@ class Ellipse:
         """
         
         grads_x, grads_y = self.algebraic_gradients(pts_x, pts_y)
-        lengths = np.sqrt(grads_x.dot(grads_x) + grads_y.dot(grads_y))
+        lengths = np.sqrt(grads_x ** 2 + grads_y ** 2)            # Per point, not one norm over all points
         return (grads_x / lengths, grads_y / lengths)
     
     
     def distances(self, pts_x, pts_y):
         
-        """ Numpy array version of EOF2 from Rosin '96: Q(x,y) / |grad.Q(x,y)|
+        """ Sampson distance |Q(x,y)| / |grad.Q(x,y)| of every point, first-order distance in px
         """
         
-        dists = self.algebraic_distances(pts_x, pts_y)
-        grads_x, grads_y = self.algebraic_gradients(pts_x, pts_y)
-        sqgrads = grads_x.dot(grads_x) + grads_y.dot(grads_y)
-        return dists / (sqgrads ** (0.45 / 2))
+        return get_sampson_distances(self.get_coeffs(), pts_x, pts_y)[0]
 
 
+class EllipseBatch:
+    
+    def __init__(self, rotated_rects, coeffs=None):
+        
+        """ N ellipses as contiguous arrays: rects ~ (N, 5) [x0, y0, w, h, angle] and coeffs ~ (N, 6) [A B C D E F]
+        
+        rotated_rects may be a list of rotated_rects or an (N, 5) array. Indexing gives back single Ellipses
+        """
+        
+        self.rects = np.ascontiguousarray(rotated_rects_to_array(rotated_rects))
+        self.coeffs = np.ascontiguousarray(get_conic_coeffs(self.rects) if coeffs is None else 
+                                           np.asarray(coeffs, dtype=float).reshape(-1, 6))
+    
+    
+    @staticmethod
+    def from_ellipses(ellipses):
+        return EllipseBatch([ellipse.rotated_rect for ellipse in ellipses], [ellipse.get_coeffs() for ellipse in ellipses])
+    
+    
+    def __len__(self):
+        return len(self.rects)
+    
+    
+    def __getitem__(self, i):
+        
+        """ Single Ellipse for an int, or EllipseBatch for a slice, index array or boolean mask
+        """
+        
+        if isinstance(i, (int, np.integer)):
+            return Ellipse(self.get_rotated_rects()[i], self.coeffs[i])
+        return EllipseBatch(self.rects[i], self.coeffs[i])
+    
+    
+    def to_ellipses(self):
+        return [Ellipse(rect, coeffs) for (rect, coeffs) in zip(self.get_rotated_rects(), self.coeffs)]
+    
+    
+    def shifted(self, dx, dy):
+        
+        """ All ellipses moved by (dx, dy), scalars or (N,) arrays
+        """
+        
+        rects = self.rects.copy()
+        rects[:, 0] += dx
+        rects[:, 1] += dy
+        return EllipseBatch(rects, shift_conic_coeffs(self.coeffs, dx, dy))
+    
+    
+    ### --- Every ellipse against every point, results ~ (N, num points) ---
+    
+    
+    def algebraic_distances(self, pts_x, pts_y):
+        
+        A, B, C, D, E, F = [c[:, np.newaxis] for c in self.coeffs.T]
+        return A * pts_x ** 2 + B * pts_x * pts_y + C * pts_y ** 2 + D * pts_x + E * pts_y + F
+    
+    
+    def algebraic_gradients(self, pts_x, pts_y):
+        
+        A, B, C, D, E, _ = [c[:, np.newaxis] for c in self.coeffs.T]
+        return (2 * A * pts_x + B * pts_y + D,
+                B * pts_x + 2 * C * pts_y + E)
+    
+    
+    def algebraic_gradient_dirs(self, pts_x, pts_y):
+        
+        grads_x, grads_y = self.algebraic_gradients(pts_x, pts_y)
+        lengths = np.sqrt(grads_x ** 2 + grads_y ** 2)
+        return (grads_x / lengths, grads_y / lengths)
+    
+    
+    def distances(self, pts_x, pts_y):
+        
+        """ Sampson distance |Q(x,y)| / |grad.Q(x,y)|, first-order distance in px
+        """
+        
+        return get_sampson_distances(self.coeffs, pts_x, pts_y)[0]
+    
+    
+    ### --- Export for drawing ---
+    
+    
+    def get_rotated_rects(self):
+        
+        """ rotated_rects ((x0, y0), (w, h), angle) as taken by cv2.ellipse
+        """
+        
+        return [((x0, y0), (w, h), angle) for (x0, y0, w, h, angle) in self.rects.tolist()]
+    
+    
+    def get_outlines(self, num_pts=36):
+        
+        """ Points around each ellipse ~ (N, num_pts, 2) int32, to draw all at once with cv2.polylines
+        """
+        
+        x0, y0, w, h, angle = [c[:, np.newaxis] for c in self.rects.T]
+        thetas = np.linspace(0, 2 * np.pi, num_pts, endpoint=False)
+        cos_angle, sin_angle = np.cos(np.radians(angle)), np.sin(np.radians(angle))
+        
+        xs, ys = w / 2 * np.cos(thetas), h / 2 * np.sin(thetas)
+        outlines = np.dstack([x0 + xs * cos_angle - ys * sin_angle, y0 + xs * sin_angle + ys * cos_angle])
+        return np.round(outlines).astype(np.int32)
 
 
+#----------------------------------------
+# EXAMPLE USAGE
+#----------------------------------------
+if __name__ == '__main__':
+    
+    from time import time
+    
+    # Random limbus-like ellipses and points near them
+    np.random.seed(0)
+    num_ellipses, num_pts = 200, 300
+    rects = np.column_stack([np.random.uniform(40, 80, num_ellipses), np.random.uniform(40, 80, num_ellipses),
+                             np.random.uniform(30, 50, num_ellipses), np.random.uniform(50, 70, num_ellipses),
+                             np.random.uniform(0, 180, num_ellipses)])
+    rotated_rects = [((x0, y0), (w, h), angle) for (x0, y0, w, h, angle) in rects]
+    pts_x, pts_y = np.random.uniform(0, 120, num_pts), np.random.uniform(0, 120, num_pts)
+    
+    tick = time()
+    ellipses = [Ellipse(rect) for rect in rotated_rects]
+    single_dists = np.array([np.abs(ell.algebraic_distances(pts_x, pts_y)) / 
+                             np.hypot(*ell.algebraic_gradients(pts_x, pts_y)) for ell in ellipses])
+    single_ms = (time() - tick) * 1000
+    
+    tick = time()
+    batch = EllipseBatch(rects)
+    batch_dists = batch.distances(pts_x, pts_y)
+    batch_ms = (time() - tick) * 1000
+    
+    print '%d ellipses x %d points - Ellipse objects: %0.2f ms, EllipseBatch: %0.2f ms' % (num_ellipses, num_pts,
+                                                                                          single_ms, batch_ms)
+    print 'Max coeff difference: %g, max distance difference: %g' % (
+        np.abs(batch.coeffs - [ell.get_coeffs() for ell in ellipses]).max(), np.abs(batch_dists - single_dists).max())
+    
+    # Shifting coeffs directly agrees with rebuilding ellipses at the new position
+    dx, dy = 344.6, 626.7
+    shifted_coeffs = batch.shifted(-dx, -dy).coeffs
+    rebuilt_coeffs = get_conic_coeffs(rects - [dx, dy, 0, 0, 0])
+    print 'Max relative difference, shifted vs rebuilt coeffs: %g' % (
+        np.abs(shifted_coeffs - rebuilt_coeffs).max(axis=0) / np.abs(rebuilt_coeffs).max(axis=0)).max()
+    print 'Round trip through Ellipse objects matches: %s' % np.allclose(
+        EllipseBatch.from_ellipses(batch.to_ellipses()).coeffs, batch.coeffs)
@@ -0,0 +1,174 @@
+import numpy as np
+
+coverage_step = 5           # Degrees per angular bin when measuring how much of an ellipse its inliers cover
+
+
+def get_sampson_distances(coeffs, pts_x, pts_y):
+
+    """ First-order geometric distance |Q(x,y)| / |grad.Q(x,y)| (px) of every point, and unit gradients of Q there
+
+    coeffs ~ [A B C D E F] of one conic, or (H, 6) for H conics at once giving (H, N) results
+    """
+
+    A, B, C, D, E, F = [c[..., np.newaxis] for c in np.asarray(coeffs, dtype=float).T]
+
+    grads_x = 2 * A * pts_x + B * pts_y + D
+    grads_y = B * pts_x + 2 * C * pts_y + E
+    alg_dists = A * pts_x ** 2 + B * pts_x * pts_y + C * pts_y ** 2 + D * pts_x + E * pts_y + F
+
+    # Zero gradient only at the centre, which is never a limbus point
+    grad_lengths = np.sqrt(grads_x ** 2 + grads_y ** 2)
+    grad_lengths[grad_lengths == 0] = np.inf
+
+    return np.abs(alg_dists) / grad_lengths, grads_x / grad_lengths, grads_y / grad_lengths
+
+
+def get_coverage(x0, y0, pts_x, pts_y, step=coverage_step):
+
+    """ Percentage of angular bins around (x0, y0) holding at least one point
+
+    Same binning as the dict it replaces: angles are truncated towards 0, so exactly 180 degrees gets a bin of its own
+    """
+
+    if len(pts_x) == 0: return 0.0
+
+    angles = np.degrees(np.arctan2(pts_y - y0, pts_x - x0))
+    bins = np.trunc(angles / step).astype(int) + 180 / step
+    bins_hit = np.bincount(bins, minlength=360 / step + 1) > 0
+
+    return np.sum(bins_hit) / (360.0 / step) * 100
+
+
+def get_image_grads_at(image_dx, image_dy, pts_x, pts_y):
+
+    """ Image gradients at each point, looked up once per point set rather than once per hypothesis
+    """
+
+    pts_xi, pts_yi = pts_x.astype(int), pts_y.astype(int)
+    return image_dx[pts_yi, pts_xi], image_dy[pts_yi, pts_xi]
+
+
+def score_ellipse(ellipse, pts_x, pts_y, max_err, pts_dx=None, pts_dy=None, step=coverage_step):
+
+    """ Scores ellipse against all points in one pass, returns (inlier mask, support, coverage)
+
+    Support is the agreement of image gradients (pts_dx, pts_dy) with the ellipse's normals summed over inliers,
+    or the number of inliers without image gradients
+    """
+
+    dists, dirs_x, dirs_y = get_sampson_distances(ellipse.get_coeffs(), pts_x, pts_y)
+    inliers = dists < max_err
+
+    if pts_dx is None:
+        support = np.sum(inliers)
+    else:
+        support = np.sum(pts_dx[inliers] * dirs_x[inliers] + pts_dy[inliers] * dirs_y[inliers])
+
+    (x0, y0) = ellipse.rotated_rect[0]
+    coverage = get_coverage(x0, y0, pts_x[inliers], pts_y[inliers], step)
+
+    return inliers, support, coverage
+
+
+#----------------------------------------
+# EXAMPLE USAGE
+#----------------------------------------
+if __name__ == '__main__':
+
+    import cv2
+    import glob
+    import random
+    import ransac_ellipse
+    from find_limbus_points import get_limb_pts
+    from math import sin, cos, radians, atan2, degrees
+    from time import time
+
+    # Previous per-hypothesis scoring, as ransac_ellipse did it, with conic_section's previous Ellipse methods
+    def distances_reference(ellipse, pts_x, pts_y):
+        dists = ellipse.algebraic_distances(pts_x, pts_y)
+        grads_x, grads_y = ellipse.algebraic_gradients(pts_x, pts_y)
+        sqgrads = grads_x.dot(grads_x) + grads_y.dot(grads_y)
+        return dists / (sqgrads ** (0.45 / 2))
+
+    def algebraic_gradient_dirs_reference(ellipse, pts_x, pts_y):
+        grads_x, grads_y = ellipse.algebraic_gradients(pts_x, pts_y)
+        lengths = np.sqrt(grads_x.dot(grads_x) + grads_y.dot(grads_y))
+        return (grads_x / lengths, grads_y / lengths)
+
+    def get_err_scale(ellipse):
+        (x0, y0), (_, maj_axis), angle = ellipse.rotated_rect
+        min_axis_plus_1px = (x0 + (maj_axis / 2 + 1) * -sin(radians(angle)), y0 + (maj_axis / 2 + 1) * cos(radians(angle)))
+        return 1 / ellipse.distance(min_axis_plus_1px)
+
+    def calculate_coverage_reference(ellipse, inliers, step=5):
+        coverage = dict((angle, 0) for angle in range(-180, 180, step))
+        (x0, y0) = ellipse.rotated_rect[0]
+        for (x, y) in inliers:
+            coverage[int(degrees(atan2(y - y0, x - x0)) / step) * step] = 1
+        return sum(coverage.values()) / (360.0 / step) * 100
+
+    def score_reference(ellipse, points, max_err, image_dx, image_dy):
+        pts_x, pts_y = points[:, 0], points[:, 1]
+        inliers = points[np.abs(get_err_scale(ellipse) * distances_reference(ellipse, pts_x, pts_y)) < max_err]
+        grads_x, grads_y = algebraic_gradient_dirs_reference(ellipse, inliers[:, 0], inliers[:, 1])
+        dxs = image_dx[inliers[:, 1].astype(int), inliers[:, 0].astype(int)]
+        dys = image_dy[inliers[:, 1].astype(int), inliers[:, 0].astype(int)]
+        support = np.sum(dxs.dot(grads_x) + dys.dot(grads_y))
+        return inliers, support, calculate_coverage_reference(ellipse, inliers)
+
+    eye_imgs = []
+    for path in sorted(glob.glob('eye_images/*.png')):
+        eye_img = cv2.imread(path)
+        img_h, img_w = eye_img.shape[:2]
+        eye_imgs.append(np.ascontiguousarray(eye_img[:, (img_w - img_h) / 2:(img_w + img_h) / 2]))
+
+    # Hypotheses from limbus points of every ROI, each scored both ways
+    cases, num_iters = [], 20
+    for eye_img in eye_imgs:
+        points = get_limb_pts(eye_img, phi=20, angle_step=1)
+        grey_img = cv2.blur(cv2.cvtColor(eye_img, cv2.COLOR_BGR2GRAY), (3, 3))
+        image_dx = cv2.Sobel(grey_img, ddepth=cv2.CV_32F, dx=1, dy=0, ksize=5)
+        image_dy = cv2.Sobel(grey_img, ddepth=cv2.CV_32F, dx=0, dy=1, ksize=5)
+        random.seed(0)
+        try:
+            ellipse = ransac_ellipse.fit_ellipse(random.sample(list(points), 6), eye_img.shape[:2])
+            get_err_scale(ellipse)
+        except ransac_ellipse.BadEllipseShape:
+            continue
+        cases.append((ellipse, points, image_dx, image_dy))
+
+    tick = time()
+    for _ in range(num_iters):
+        ref_scores = [score_reference(ellipse, points, 3, image_dx, image_dy) for (ellipse, points, image_dx, image_dy) in cases]
+    ref_ms = (time() - tick) * 1000 / (num_iters * len(cases))
+
+    tick = time()
+    for _ in range(num_iters):
+        scores = []
+        for (ellipse, points, image_dx, image_dy) in cases:
+            pts_dx, pts_dy = get_image_grads_at(image_dx, image_dy, points[:, 0], points[:, 1])
+            scores.append(score_ellipse(ellipse, points[:, 0], points[:, 1], 3, pts_dx, pts_dy))
+    new_ms = (time() - tick) * 1000 / (num_iters * len(cases))
+
+    print 'Scoring per hypothesis - reference: %0.3f ms, vectorized: %0.3f ms' % (ref_ms, new_ms)
+
+    # Coverage binning matches exactly when given the same inliers
+    max_cov_diff = max(abs(calculate_coverage_reference(ellipse, points) -
+                           get_coverage(ellipse.rotated_rect[0][0], ellipse.rotated_rect[0][1], points[:, 0], points[:, 1]))
+                       for (ellipse, points, _, _) in cases)
+    print 'Max coverage difference on same points: %0.3f' % max_cov_diff
+
+    # Sampson distances against brute-force distances to densely sampled ellipse outlines
+    errs = []
+    for (ellipse, points, _, _) in cases:
+        (x0, y0), (ell_w, ell_h), angle = ellipse.rotated_rect
+        thetas, angle = np.linspace(0, 2 * np.pi, 3600), radians(angle)
+        outline_x, outline_y = ell_w / 2 * np.cos(thetas), ell_h / 2 * np.sin(thetas)
+        outline = np.column_stack([x0 + outline_x * cos(angle) - outline_y * sin(angle),
+                                   y0 + outline_x * sin(angle) + outline_y * cos(angle)])
+        true_dists = np.min(np.hypot(points[:, 0, np.newaxis] - outline[:, 0], points[:, 1, np.newaxis] - outline[:, 1]), axis=1)
+        dists, _, _ = get_sampson_distances(ellipse.get_coeffs(), points[:, 0], points[:, 1])
+        near = true_dists < 5
+        errs.extend(np.abs(dists[near] - true_dists[near]))
+    print 'Sampson vs true distance within 5 px of outline - median error: %0.2f px, 90th percentile: %0.2f px' % (
+        np.median(errs), np.percentile(errs, 90))
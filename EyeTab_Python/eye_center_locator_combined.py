@@ -10,6 +10,8 @@ __debug_imgs = {}
 
 w_grads, w_iso = 0.7, 0.3
 
+refine_window_r = 2                 # Half-size (in low-res map cells) of window upsampled around candidate peak
+
 def find_pupil(eye_img_bgr, fast_width_grads=25.5, fast_width_iso=80, weight_grads=0.9, weight_iso=0.1, debug_index=False):
     
     eye_img_r = cv2.split(eye_img_bgr)[2]
@@ -67,3 +69,166 @@ def find_pupil(eye_img_bgr, fast_width_grads=25.5, fast_width_iso=80, weight_gra
     
     return pupil_x0, pupil_y0
 
+
+def resize_window(c_map, full_size, (x0, y0, x1, y1)):
+    
+    """ Same pixels as cv2.resize(c_map, full_size)[y0:y1, x0:x1] (bilinear), without resizing the rest
+    """
+    
+    full_w, full_h = full_size
+    scale_x, scale_y = c_map.shape[1] / float(full_w), c_map.shape[0] / float(full_h)
+    
+    map_xs, map_ys = np.empty((y1 - y0, x1 - x0), np.float32), np.empty((y1 - y0, x1 - x0), np.float32)
+    map_xs[:] = (np.arange(x0, x1) + 0.5) * scale_x - 0.5
+    map_ys[:] = ((np.arange(y0, y1) + 0.5) * scale_y - 0.5)[:, np.newaxis]
+    
+    return cv2.remap(c_map, map_xs, map_ys, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+
+def get_peak_confidence(c_map, (peak_x, peak_y), suppress_r):
+    
+    """ 1 - second peak / peak, with second peak taken outside suppress_r (cells) of peak. 0 if ambiguous, 1 if unique
+    """
+    
+    peak_val = c_map[peak_y, peak_x]
+    if peak_val <= 0: return 0.0
+    
+    others = c_map.copy()
+    others[max(peak_y - suppress_r, 0):peak_y + suppress_r + 1, max(peak_x - suppress_r, 0):peak_x + suppress_r + 1] = 0
+    return float(1 - np.max(others) / peak_val)
+
+
+def fuse_c_maps(c_map_grads, c_map_iso, full_size, weight_grads=w_grads, weight_iso=w_iso):
+    
+    """ Fuses centre maps on the (finer) isophote grid, so only the coarse gradient map is resampled. Only a window
+    around the best cell is upsampled to full_size. Returns (pupil_x0, pupil_y0, confidence, low-res map, window)
+    """
+    
+    low_size = (c_map_iso.shape[1], c_map_iso.shape[0])
+    
+    c_map_norm_grads = cv2.normalize(c_map_grads, alpha=0, beta=255, norm_type=cv2.NORM_MINMAX)
+    c_map_norm_iso = cv2.normalize(c_map_iso, alpha=0, beta=255, norm_type=cv2.NORM_MINMAX)
+    c_map_low_grads = cv2.resize(c_map_norm_grads, low_size)
+    joint_c_map_low = weight_grads * c_map_low_grads + weight_iso * c_map_norm_iso
+    
+    max_val_index = np.argmax(joint_c_map_low)
+    low_y0, low_x0 = max_val_index // joint_c_map_low.shape[1], max_val_index % joint_c_map_low.shape[1]
+    
+    # Full-res window covering refine_window_r cells either side of candidate
+    scale_x, scale_y = full_size[0] / float(low_size[0]), full_size[1] / float(low_size[1])
+    win_x0 = int(max((low_x0 - refine_window_r) * scale_x, 0))
+    win_x1 = int(min((low_x0 + refine_window_r + 1) * scale_x, full_size[0]))
+    win_y0 = int(max((low_y0 - refine_window_r) * scale_y, 0))
+    win_y1 = int(min((low_y0 + refine_window_r + 1) * scale_y, full_size[1]))
+    
+    # Quantized to uint8 & combined as cv2.addWeighted does in find_pupil, so both agree on ties
+    window_grads = resize_window(c_map_norm_grads, full_size, (win_x0, win_y0, win_x1, win_y1)).astype(np.uint8)
+    window_iso = resize_window(c_map_norm_iso, full_size, (win_x0, win_y0, win_x1, win_y1)).astype(np.uint8)
+    window_c_map = np.round(weight_grads * window_grads + weight_iso * window_iso + 1.0)
+    
+    max_val_index = np.argmax(window_c_map)
+    pupil_y0 = win_y0 + max_val_index // window_c_map.shape[1]
+    pupil_x0 = win_x0 + max_val_index % window_c_map.shape[1]
+    
+    # Second peak must be further away than smallest pupil radius isophote method looks for
+    confidence = get_peak_confidence(joint_c_map_low, (low_x0, low_y0), c_map_iso.shape[1] / 8)
+    
+    return pupil_x0, pupil_y0, confidence, joint_c_map_low, (win_x0, win_y0, win_x1, win_y1)
+
+
+def find_pupil_fused(eye_img_bgr, fast_width_grads=25.0, fast_width_iso=80.0, weight_grads=w_grads, weight_iso=w_iso,
+                     debug_index=False):
+    
+    """ Combines gradient & isophote centre maps at low resolution, then only upsamples a small window around the
+    candidate to refine it to full-res pixels. Returns (pupil_x0, pupil_y0, confidence)
+    
+    Weights default to those find_pupil actually uses (it ignores its weight arguments)
+    """
+    
+    eye_img_r = cv2.split(eye_img_bgr)[2]
+    full_size = (eye_img_bgr.shape[1], eye_img_bgr.shape[0])
+    
+    fast_size_grads = (int((fast_width_grads / eye_img_bgr.shape[0]) * eye_img_bgr.shape[1]), int(fast_width_grads))
+    c_map_grads = eye_center_locator_gradients.get_center_map(cv2.resize(eye_img_r, fast_size_grads))
+    
+    fast_size_iso = (int(fast_width_iso), int((fast_width_iso / eye_img_r.shape[1]) * eye_img_r.shape[0]))
+    c_map_iso = eye_center_locator_isophote.get_center_map(cv2.resize(eye_img_r, fast_size_iso))
+    
+    pupil_x0, pupil_y0, confidence, joint_c_map_low, win_rect = fuse_c_maps(c_map_grads, c_map_iso, full_size,
+                                                                             weight_grads, weight_iso)
+    
+    if debug_index:
+        
+        debug_img = eye_img_bgr.copy()
+        joint_c_map = cv2.resize(joint_c_map_low, full_size).astype(np.uint8)
+        joint_c_map = cv2.cvtColor(joint_c_map, cv2.COLOR_GRAY2BGR)
+        
+        draw_utils.draw_cross(debug_img, (pupil_x0, pupil_y0), (0, 255, 255), 16, 2)
+        draw_utils.draw_cross(joint_c_map, (pupil_x0, pupil_y0), (255, 0, 0), 16, 2)
+        cv2.rectangle(joint_c_map, win_rect[:2], win_rect[2:], (0, 255, 0))
+        cv2.putText(joint_c_map, '%0.2f' % confidence, (5, 15), cv2.FONT_HERSHEY_PLAIN, 1, (0, 255, 0))
+        
+        stacked_imgs = image_utils.stack_imgs_horizontal([debug_img, joint_c_map])
+        __debug_imgs[debug_index] = stacked_imgs
+        
+        if debug_index == 2:
+            full_debug_img = image_utils.stack_imgs_vertical([__debug_imgs[1], __debug_imgs[2]]);
+            cv2.imshow(__winname, full_debug_img)
+        elif debug_index > 2:
+            cv2.imshow(__winname, stacked_imgs);
+    
+    return pupil_x0, pupil_y0, confidence
+
+
+#----------------------------------------
+# EXAMPLE USAGE 
+#----------------------------------------
+if __name__ == '__main__':
+    
+    import glob
+    from time import time
+    
+    eye_imgs = [cv2.imread(path) for path in glob.glob('eye_images/*.png')]
+    num_iters = 20
+    
+    # Warm up both, first calls include one-off allocations
+    for eye_img in eye_imgs[:4]: find_pupil(eye_img, 25.0, 80.0), find_pupil_fused(eye_img)
+    
+    tick = time()
+    ref_pupils = [find_pupil(eye_img, 25.0, 80.0) for eye_img in eye_imgs]
+    ref_ms = (time() - tick) * 1000 / len(eye_imgs)
+    
+    tick = time()
+    fused_pupils = [find_pupil_fused(eye_img) for eye_img in eye_imgs]
+    fused_ms = (time() - tick) * 1000 / len(eye_imgs)
+    
+    # Combining step alone, centre maps dominate the totals above
+    c_maps = []
+    for eye_img in eye_imgs:
+        eye_img_r = cv2.split(eye_img)[2]
+        c_maps.append((eye_center_locator_gradients.get_center_map(cv2.resize(eye_img_r, (int(25.0 / eye_img.shape[0] * eye_img.shape[1]), 25))),
+                       eye_center_locator_isophote.get_center_map(cv2.resize(eye_img_r, (80, int(80.0 / eye_img.shape[1] * eye_img.shape[0])))),
+                       (eye_img.shape[1], eye_img.shape[0])))
+    
+    tick = time()
+    for _ in range(num_iters):
+        for c_map_grads, c_map_iso, full_size in c_maps:
+            c_map_big_grads = cv2.resize(cv2.normalize(c_map_grads, alpha=0, beta=255, norm_type=cv2.NORM_MINMAX), full_size).astype(np.uint8)
+            c_map_big_iso = cv2.resize(cv2.normalize(c_map_iso, alpha=0, beta=255, norm_type=cv2.NORM_MINMAX), full_size).astype(np.uint8)
+            joint_c_map = cv2.addWeighted(c_map_big_grads, w_grads, c_map_big_iso, w_iso, 1.0)
+            np.argmax(joint_c_map), np.argmax(c_map_big_grads), np.argmax(c_map_big_iso)
+    ref_combine_ms = (time() - tick) * 1000 / (num_iters * len(c_maps))
+    
+    tick = time()
+    for _ in range(num_iters):
+        for c_map_grads, c_map_iso, full_size in c_maps:
+            fuse_c_maps(c_map_grads, c_map_iso, full_size)
+    fused_combine_ms = (time() - tick) * 1000 / (num_iters * len(c_maps))
+    
+    dists = [np.sqrt((x1 - x2) ** 2 + (y1 - y2) ** 2) for ((x1, y1), (x2, y2, _)) in zip(ref_pupils, fused_pupils)]
+    print 'Total - reference: %0.2f ms, fused: %0.2f ms' % (ref_ms, fused_ms)
+    print 'Combining maps only - reference: %0.3f ms, fused: %0.3f ms' % (ref_combine_ms, fused_combine_ms)
+    print 'Distance from reference (px) - median: %0.2f, max: %0.2f, identical: %d/%d' % (np.median(dists), np.max(dists),
+                                                                                      np.sum(np.array(dists) == 0), len(dists))
+    print 'Confidence - min: %0.2f, median: %0.2f' % (np.min([c for (_, _, c) in fused_pupils]),
+                                                      np.median([c for (_, _, c) in fused_pupils]))
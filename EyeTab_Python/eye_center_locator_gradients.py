@@ -1,4 +1,4 @@
-import cv2, numpy as np, draw_utils, image_utils
+import cv2, numpy as np, draw_utils, image_utils, fast_kernels
 
 from time import time
 
@@ -25,7 +25,10 @@ def test_possible_centers_formula((grad_x0, grad_y0), darkness_weight, grad_x_va
     return diffs
 
 
-def get_center_map(eye_img_grey):
+def get_gradients(eye_img_grey):
+    
+    """ Normalised gradients (0 below magnitude threshold) and darkness weights of each pixel
+    """
     
     grad_x_img = cv2.Sobel(eye_img_grey, ddepth=cv2.CV_32F, dx=1, dy=0, ksize=5)
     grad_y_img = cv2.Sobel(eye_img_grey, ddepth=cv2.CV_32F, dx=0, dy=1, ksize=5)
@@ -44,6 +47,24 @@ def get_center_map(eye_img_grey):
     eye_img_inv = 255 - eye_img_grey
     darkness_weights = eye_img_inv / __inv_intensity_weight_divisor
     
+    return grad_x_img, grad_y_img, darkness_weights
+
+
+def get_center_map(eye_img_grey):
+    
+    accumulator = fast_kernels.gradient_center_map(*get_gradients(eye_img_grey))
+    
+    num_gradients = eye_img_grey.shape[0] * eye_img_grey.shape[1]
+    return accumulator / num_gradients
+
+
+def get_center_map_reference(eye_img_grey):
+    
+    """ Reference version of get_center_map, one candidate map per gradient pixel
+    """
+    
+    grad_x_img, grad_y_img, darkness_weights = get_gradients(eye_img_grey)
+    
     accumulator = np.zeros(eye_img_grey.shape[:2], dtype=np.float32)
     indicies_grid = np.indices(accumulator.shape[:2])
     indicies_shape = indicies_grid.shape[1:3]
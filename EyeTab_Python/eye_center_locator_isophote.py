@@ -36,7 +36,6 @@ def get_center_map(eye_img):
     # Calculate the curved-ness and weighting function
     curvedness = np.sqrt(f_xx ** 2 + 2 * f_xy ** 2 + f_yy ** 2)
     curvedness_norm = cv2.normalize(curvedness, 0, 255, norm_type=cv2.NORM_MINMAX).astype(np.uint8)
-    cv2.imshow("curvedness", curvedness_norm)
     weight_edge = cv2.normalize(curvedness, 0, 255 * __weight_ratio_edge, norm_type=cv2.NORM_MINMAX)               # higher weight to stronger edges
     weight_middle = cv2.normalize((255 - eye_img), 0, 255 * __weight_ratio_darkness, norm_type=cv2.NORM_MINMAX)       # higher center weight to darker areas
     
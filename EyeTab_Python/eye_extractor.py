@@ -1,4 +1,4 @@
-import cv2, os, numpy as np
+import cv2, os, threading, numpy as np
 import image_utils
 import time_profiler
 import device_constants
@@ -13,9 +13,18 @@ angles_to_try = [0, 15, -15, 30, -30]
 
 winname = 'Eye Extractor'
 
-classifier_pair = cv2.CascadeClassifier(os.path.join('cascades', 'haarcascade_mcs_eyepair_big.xml'))
-classifier_l_eye = cv2.CascadeClassifier(os.path.join('cascades', 'haarcascade_mcs_lefteye.xml'))
-classifier_r_eye = cv2.CascadeClassifier(os.path.join('cascades', 'haarcascade_mcs_righteye.xml'))
+cascade_paths = {'pair': os.path.join('cascades', 'haarcascade_mcs_eyepair_big.xml'),
+                 'l_eye': os.path.join('cascades', 'haarcascade_mcs_lefteye.xml'),
+                 'r_eye': os.path.join('cascades', 'haarcascade_mcs_righteye.xml')}
+
+# CascadeClassifiers aren't safe to share between threads, so each thread (e.g. gaze_server's workers) loads its own
+__thread_classifiers = threading.local()
+
+def get_classifier(name):
+    classifiers = __thread_classifiers.__dict__
+    if name not in classifiers: classifiers[name] = cv2.CascadeClassifier(cascade_paths[name])
+    return classifiers[name]
+
 
 class NoEyesFound(Exception):
     def __init__(self, msg):
@@ -28,6 +37,7 @@ class EyeRoi:
         self.roi_x0, self.roi_y0 = int(roi_x0_param), int(roi_y0_param)
         self.roi_h, self.roi_w = img_param.shape[:2]
         self.img = img_param
+        self.pupil_conf = None          # Set once pupil is located, 0 (ambiguous) - 1 (unique peak)
         
         if self.img is None: raise NoEyesFound()    # Prevent future problems with NoneType image
 
@@ -69,7 +79,6 @@ def get_eye_rois_default(frame_pyr, down_scale=4, debug=False, device=None):
     """
 
     pyr_img = frame_pyr[down_scale].copy()
-    full_frame = frame_pyr[1]
     
     pyr_img_grey = cv2.cvtColor(pyr_img, cv2.COLOR_BGR2GRAY)
     
@@ -79,8 +88,8 @@ def get_eye_rois_default(frame_pyr, down_scale=4, debug=False, device=None):
     roi_l[:, img_w / 2:img_w] = 0
     min_eye_size = (pyr_img.shape[0] / 6, pyr_img.shape[0] / 9)
     
-    eye_l_rects = classifier_l_eye.detectMultiScale(roi_l, scaleFactor=1.1, minSize=min_eye_size)
-    eye_r_rects = classifier_r_eye.detectMultiScale(roi_r, scaleFactor=1.1, minSize=min_eye_size)
+    eye_l_rects = get_classifier('l_eye').detectMultiScale(roi_l, scaleFactor=1.1, minSize=min_eye_size)
+    eye_r_rects = get_classifier('r_eye').detectMultiScale(roi_r, scaleFactor=1.1, minSize=min_eye_size)
     
     if len(eye_l_rects) == 0 or len(eye_r_rects) == 0 :
         raise NoEyesFound('Did not find eyes with default behaviour')
@@ -99,6 +108,7 @@ def get_eye_rois_default(frame_pyr, down_scale=4, debug=False, device=None):
     rect_r_x0, rect_r_y0, rect_r_w, rect_r_h = best_eye_r_rect
     roi_r_x0, roi_r_y0, roi_r_w, roi_r_h = [x * down_scale for x in [rect_r_x0, rect_r_y0, rect_r_w, rect_r_h]]
     
+    full_frame = frame_pyr[1]      # Only needed (and decoded, if lazy) once eyes are found
     eye_1_img = full_frame[roi_l_y0:(roi_l_y0 + roi_l_h), roi_l_x0:roi_l_x0 + roi_l_w]
     eye_2_img = full_frame[roi_r_y0:(roi_r_y0 + roi_r_h), roi_r_x0:roi_r_x0 + roi_r_w]
     eye_roi_1, eye_roi_2 = EyeRoi((roi_l_x0, roi_l_y0), eye_1_img), EyeRoi((roi_r_x0, roi_r_y0), eye_2_img)
@@ -126,7 +136,6 @@ def get_eye_rois_at_angle(frame_pyr, angle, down_scale=4, debug=False, device=No
     """
 
     pyr_img = frame_pyr[down_scale].copy()
-    full_frame = frame_pyr[1]
     
     # Rotate down-scaled frame for potential non-horizontal eye-pairs
     if angle != 0:
@@ -141,7 +150,7 @@ def get_eye_rois_at_angle(frame_pyr, angle, down_scale=4, debug=False, device=No
         
     pyr_img_grey = cv2.cvtColor(pyr_img, cv2.COLOR_BGR2GRAY)
         
-    eye_pair_rects = classifier_pair.detectMultiScale(pyr_img_grey,
+    eye_pair_rects = get_classifier('pair').detectMultiScale(pyr_img_grey,
                                                       scaleFactor=1.1,
                                                       minSize=min_eye_pair_size)
     
@@ -162,6 +171,8 @@ def get_eye_rois_at_angle(frame_pyr, angle, down_scale=4, debug=False, device=No
     eye_1_w = int(roi_w * eye_part_ratios[1])
     eye_2_x0 = int(roi_x0 + roi_w * sum(eye_part_ratios[:3]))
     eye_2_w = int(roi_w * eye_part_ratios[3])
+    
+    full_frame = frame_pyr[1]      # Only needed (and decoded, if lazy) once eyes are found
 
     if angle == 0:
         eye_1_img = full_frame[roi_y0:(roi_y0 + roi_h), eye_1_x0:eye_1_x0 + eye_1_w]
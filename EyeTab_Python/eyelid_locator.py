@@ -1,20 +1,12 @@
 import cv2
 import numpy as np
+import fast_kernels
 
 from ransac_eyelids import ransac_line, ransac_parabola
 from image_utils import stack_imgs_horizontal, stack_imgs_vertical
 from draw_utils import draw_points
+from gabor_filters import gabor_bank
 from time import time
-from math import pi
-
-__gabor_params = {'ksize':(5, 5),
-                  'sigma':3,
-                  'theta':pi / 4,
-                  'lambd':pi * 2,
-                  'gamma':2,
-                  'psi':pi / 2,
-                  'ktype':cv2.CV_32F}
-__gabor_kern_diag = cv2.getGaborKernel(**__gabor_params)
 
 __winname = "Eyelid Detection"
 __debug_imgs_upper = {}
@@ -79,20 +71,25 @@ __u_win_rats_w_r = [0.7, 0.3, 0.0]
 __u_win_rats_h = [0.3, 0.6, 0.1]
 
 __y_pos_weight = 1                              # Try and weight sclera-boundary higher than eyelid crease
-__crease_offset = __gabor_kern_diag.shape[0]
+__crease_offset = gabor_bank.kernels['lower_eyelid_l'].shape[0]
 
 __parabola_y_offset = -10                       # Amount to shift eye-lid by after detection
 
 __min_num_pts_u = 10
 
-__gabor_params = {'ksize':(7, 7),
-                  'sigma':3,
-                  'theta':-pi / 2,
-                  'lambd':pi * 3,
-                  'gamma':2,
-                  'psi':pi / 2,
-                  'ktype':cv2.CV_32F}
-__gabor_kern_horiz = cv2.getGaborKernel(**__gabor_params)
+__crease_search_range = (5, 100)                # Rows below first response to look for the sclera boundary
+__crease_max_drop = 50                          # How much weaker sclera boundary can be than crease response
+
+def refine_upper_eyelid_ys(filter_img, xs, ys):
+    
+    """ For each column x, moves y from the strongest response (often the crease) to the best one below it,
+    if that is almost as strong. Only looks at rows within __crease_search_range of y
+    """
+    
+    if len(xs) == 0: return ys
+    
+    return fast_kernels.refine_upper_eyelid_ys(filter_img, xs, ys, __crease_search_range, __crease_max_drop)
+
 
 def find_upper_eyelid(eye_img, debug_index):
 
@@ -115,7 +112,7 @@ def find_upper_eyelid(eye_img, debug_index):
     window_img = cv2.morphologyEx(window_img, cv2.MORPH_CLOSE, morph_kernel)
  
     # Filter right half with inverse kernel of left half to ignore iris/sclera boundary    
-    filter_img_win = cv2.filter2D(window_img, -1, __gabor_kern_horiz)
+    filter_img_win = gabor_bank.filter('upper_eyelid', window_img)
     
     # Copy windows back into correct places in full filter image
     filter_img = np.zeros(eye_img.shape[:2], dtype=np.uint8)
@@ -129,31 +126,20 @@ def find_upper_eyelid(eye_img, debug_index):
     xs = np.arange(filter_img.shape[1])[ys > 0]
     ys = (ys)[ys > 0]
 
-    u_lid_pts = []
-    
-    for i, x in enumerate(xs):
-        col = filter_img.T[x]
-        start_ind, end_ind = ys[i] + 5, min(ys[i] + 100, len(col) - 2)
-        col_window = col[start_ind:end_ind]
-        max_col = np.max(col)
-        max_win = np.max(col_window)
-        if max_col - max_win < 50 :
-            new_y = np.argmax(col_window) + ys[i] + 5
-            u_lid_pts.append((x, new_y))
-        else:u_lid_pts.append((x, ys[i]))
+    u_lid_pts = np.column_stack([xs, refine_upper_eyelid_ys(filter_img, xs, ys)])
     
     # Only RANSAC fit eyelid if there are enough points
     if len(u_lid_pts) < __min_num_pts_u * 2:
         eyelid_upper_parabola = None
         u_lid_pts = []
     else:
-        u_lid_pts_l = [(x,y) for (x,y) in u_lid_pts if x < filter_img.shape[1]/2]
-        u_lid_pts_r = [(x,y) for (x,y) in u_lid_pts if x > filter_img.shape[1]/2]
+        u_lid_pts_l = u_lid_pts[u_lid_pts[:, 0] < filter_img.shape[1] / 2]
+        u_lid_pts_r = u_lid_pts[u_lid_pts[:, 0] > filter_img.shape[1] / 2]
         
         # Fit eye_img coord points of sclera-segs to degree 2 polynomial
         # a(x^2) + b(x) + c
         eyelid_upper_parabola = ransac_parabola(u_lid_pts_l, u_lid_pts_r,
-                                                ransac_iters_max=5,
+                                                ransac_iters_max=16,
                                                 refine_iters_max=2,
                                                 max_err=4)
     if eyelid_upper_parabola is not None:
@@ -214,8 +200,8 @@ def find_lower_eyelid(eye_img, debug_index):
     window_img_l = cv2.GaussianBlur(window_img_l, (5, 5), 20)
     window_img_r = cv2.GaussianBlur(window_img_r, (5, 5), 20)
 
-    filter_img_l = cv2.filter2D(window_img_l, -1, __gabor_kern_diag)
-    filter_img_r = cv2.filter2D(window_img_r, -1, cv2.flip(__gabor_kern_diag, 1))
+    filter_img_l = gabor_bank.filter('lower_eyelid_l', window_img_l)
+    filter_img_r = gabor_bank.filter('lower_eyelid_r', window_img_r)
     filter_img = np.concatenate([filter_img_l, filter_img_r], axis=1)
 
     # In polar image, x <-> theta, y <-> magnitude         
@@ -0,0 +1,371 @@
+import cv2
+import numpy as np
+
+from math import sin, cos, sqrt
+from time import time
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# Loop-shaped kernels, compiled with Numba when it is installed. Without it, NumPy versions of the same kernels
+# run instead. Reference implementations stay in their own modules, see EXAMPLE USAGE for parity checks
+backend = 'numba' if numba is not None else 'numpy'
+warm_up_ms = 0.0                # JIT compile time spent at import, so it is not charged to the first frame
+
+grads_per_chunk = 256           # Gradient pixels voted at once by NumPy centre map, bounds (chunk x pixels) arrays
+
+
+#----------------------------------------
+# Loop kernels - written for Numba, also run (slowly) as plain Python
+#----------------------------------------
+
+def _gradient_center_map_loops(grad_x, grad_y, weights, accumulator):
+
+    img_h, img_w = grad_x.shape
+    for y in range(img_h):
+        for x in range(img_w):
+            g_x, g_y = grad_x[y, x], grad_y[y, x]
+            if g_x == 0 and g_y == 0: continue
+            for c_y in range(img_h):
+                for c_x in range(img_w):
+                    d_x, d_y = x - c_x, y - c_y
+                    magnitude = sqrt((d_x + 0.0001) ** 2 + d_y ** 2)          # 0.0001 offsets division by 0
+                    diff = (d_x * g_x + d_y * g_y) / magnitude * weights[y, x]
+                    if diff > 0: accumulator[c_y, c_x] += diff
+
+
+def _linpolar_table_loops(i_0, j_0, i_n, j_n, p_n, t_n, t_s, table):
+
+    num_found = 0
+    for p in range(p_n):
+        for t in range(t_n):
+            t_rad = t * t_s
+            i = int(i_0 + p * sin(t_rad))
+            j = int(j_0 + p * cos(t_rad))
+            if 0 <= i < i_n and 0 <= j < j_n:
+                table[0, num_found], table[1, num_found] = p, t
+                table[2, num_found], table[3, num_found] = i, j
+                num_found += 1
+    return num_found
+
+
+def _sample_rays_loops(intensity_img, x0, y0, angles, ray_start, ray_len, step_ray, kernel, pts, responses):
+
+    img_h, img_w = intensity_img.shape
+    kernel_len = len(kernel)
+    samples = np.zeros(ray_len, dtype=np.float64)
+
+    for r in range(len(angles)):
+        x0_off, y0_off = x0 + ray_start * cos(angles[r]), y0 + ray_start * sin(angles[r])
+        d_x, d_y = step_ray * cos(angles[r]), step_ray * sin(angles[r])
+
+        num_samples = 0
+        for i in range(ray_len):
+            x_sample, y_sample = x0_off + d_x * i, y0_off + d_y * i
+            if not (0 < x_sample < img_w and 0 < y_sample < img_h): break
+            samples[i] = intensity_img[int(y_sample), int(x_sample)]
+            num_samples += 1
+
+        # Convolution (flipped kernel) over samples, first maximum
+        best_i, best_conv = 0, -np.inf
+        for i in range(num_samples - kernel_len + 1):
+            conv = 0.0
+            for k in range(kernel_len):
+                conv += samples[i + kernel_len - 1 - k] * kernel[k]
+            if conv > best_conv: best_i, best_conv = i, conv
+
+        pts[r, 0] = int(x0_off + d_x * (best_i + kernel_len // 2))
+        pts[r, 1] = int(y0_off + d_y * (best_i + kernel_len // 2))
+        responses[r] = best_conv
+
+
+def _refine_upper_eyelid_loops(filter_img, xs, ys, search_start, search_end, max_drop, new_ys):
+
+    for c in range(len(xs)):
+        x, y = xs[c], ys[c]
+        start_y, end_y = y + search_start, min(y + search_end, filter_img.shape[0] - 2)
+        new_ys[c] = y
+        if end_y <= start_y: continue
+
+        best_y = start_y
+        for row in range(start_y, end_y):
+            if filter_img[row, x] > filter_img[best_y, x]: best_y = row
+
+        if int(filter_img[y, x]) - int(filter_img[best_y, x]) < max_drop: new_ys[c] = best_y
+
+
+#----------------------------------------
+# NumPy versions
+#----------------------------------------
+
+def _gradient_center_map_numpy(grad_x, grad_y, weights, accumulator):
+
+    img_h, img_w = grad_x.shape
+    grad_ys, grad_xs = np.nonzero((grad_x != 0) | (grad_y != 0))
+    c_ys, c_xs = np.indices((img_h, img_w)).reshape(2, -1)
+
+    for i in range(0, len(grad_xs), grads_per_chunk):
+        g_ys, g_xs = grad_ys[i:i + grads_per_chunk], grad_xs[i:i + grads_per_chunk]
+
+        d_x = (g_xs[:, np.newaxis] - c_xs).astype(float)
+        d_y = (g_ys[:, np.newaxis] - c_ys).astype(float)
+        magnitudes = np.sqrt((d_x + 0.0001) ** 2 + d_y ** 2)
+
+        diffs = ((d_x * grad_x[g_ys, g_xs][:, np.newaxis] + d_y * grad_y[g_ys, g_xs][:, np.newaxis]) / magnitudes *
+                 weights[g_ys, g_xs][:, np.newaxis])
+        accumulator += np.maximum(diffs, 0).sum(axis=0).reshape(img_h, img_w)
+
+
+def _linpolar_table_numpy(i_0, j_0, i_n, j_n, p_n, t_n, t_s, table):
+
+    ps, ts = np.arange(p_n)[:, np.newaxis], np.arange(t_n)
+    t_rads = ts * t_s
+    i_s = (i_0 + ps * np.sin(t_rads)).astype(int)
+    j_s = (j_0 + ps * np.cos(t_rads)).astype(int)
+
+    inside = (0 <= i_s) & (i_s < i_n) & (0 <= j_s) & (j_s < j_n)
+    ps, ts = np.broadcast_to(ps, inside.shape)[inside], np.broadcast_to(ts, inside.shape)[inside]
+
+    table[:, :len(ps)] = [ps, ts, i_s[inside], j_s[inside]]
+    return len(ps)
+
+
+def _sample_rays_numpy(intensity_img, x0, y0, angles, ray_start, ray_len, step_ray, kernel, pts, responses):
+
+    img_h, img_w = intensity_img.shape
+    kernel_len = len(kernel)
+
+    cos_ts, sin_ts = np.cos(angles), np.sin(angles)
+    x0_offs, y0_offs = x0 + ray_start * cos_ts, y0 + ray_start * sin_ts
+    d_xs, d_ys = step_ray * cos_ts, step_ray * sin_ts
+
+    # Sample coords (rays x samples), in place as these are the largest arrays here
+    steps = np.arange(ray_len, dtype=np.float64)
+    xs, ys = np.outer(d_xs, steps), np.outer(d_ys, steps)
+    xs += x0_offs[:, np.newaxis]
+    ys += y0_offs[:, np.newaxis]
+
+    # Rays stop at their first sample outside the image, a ray that has left the image never comes back
+    inside = (0 < xs) & (xs < img_w) & (0 < ys) & (ys < img_h)
+    num_samples = np.where(inside.all(axis=1), ray_len, np.argmin(inside, axis=1))
+
+    # Whole fan in one remap, of the pixels ray_sample truncates to (as whole coords, nearest is that pixel)
+    map_x, map_y = xs.astype(np.int32).astype(np.float32), ys.astype(np.int32).astype(np.float32)
+    samples = cv2.remap(intensity_img.astype(np.float32), map_x, map_y, cv2.INTER_NEAREST,
+                        borderMode=cv2.BORDER_CONSTANT)
+
+    # Convolution (flipped kernel) of every ray at once, positions past each ray's end can't win. float32 is exact for
+    # integer kernels on 8-bit intensities
+    num_convs = max(ray_len - kernel_len + 1, 1)
+    convs = cv2.filter2D(samples, -1, np.asarray(kernel[::-1], np.float32)[np.newaxis], anchor=(0, 0),
+                         borderType=cv2.BORDER_CONSTANT)[:, :num_convs]
+    convs[np.arange(num_convs) + kernel_len > num_samples[:, np.newaxis]] = -np.inf
+
+    best_is = np.argmax(convs, axis=1)
+    responses[:] = convs[np.arange(len(angles)), best_is]
+
+    best_is += kernel_len // 2
+    pts[:, 0] = (x0_offs + d_xs * best_is).astype(int)
+    pts[:, 1] = (y0_offs + d_ys * best_is).astype(int)
+
+
+def _refine_upper_eyelid_numpy(filter_img, xs, ys, search_start, search_end, max_drop, new_ys):
+
+    start_ys = ys + search_start
+    end_ys = np.minimum(ys + search_end, filter_img.shape[0] - 2)
+
+    # Only the band of rows some column searches needs looking at
+    band_y0, band_y1 = start_ys.min(), max(end_ys.max(), start_ys.min())
+    band = filter_img[band_y0:band_y1, xs].astype(np.int16)
+    band_ys = np.arange(band_y0, band_y1)[:, np.newaxis]
+
+    # Mask rows outside each column's own window, then take max & argmax in one go
+    in_window = (band_ys >= start_ys) & (band_ys < end_ys)
+    band[~in_window] = -1
+
+    max_cols = filter_img[ys, xs].astype(np.int16)
+    max_wins = band.max(axis=0) if band.size else np.full(len(xs), -1, dtype=np.int16)
+    best_ys = (band.argmax(axis=0) if band.size else 0) + band_y0
+
+    # Columns with an empty window keep their first response
+    use_new = (end_ys > start_ys) & (max_cols - max_wins < max_drop)
+    new_ys[:] = np.where(use_new, best_ys, ys)
+
+
+if backend == 'numba':
+    _kernels = dict((name, numba.njit(cache=True)(kernel)) for (name, kernel) in
+                    [('center_map', _gradient_center_map_loops), ('linpolar', _linpolar_table_loops),
+                     ('rays', _sample_rays_loops), ('eyelid', _refine_upper_eyelid_loops)])
+else:
+    _kernels = {'center_map': _gradient_center_map_numpy, 'linpolar': _linpolar_table_numpy,
+                'rays': _sample_rays_numpy, 'eyelid': _refine_upper_eyelid_numpy}
+
+
+#----------------------------------------
+# Kernels
+#----------------------------------------
+
+def gradient_center_map(grad_x, grad_y, weights):
+
+    """ Sum over gradient pixels of their (weighted) agreement with the direction to each candidate centre, the
+    accumulator of eye_center_locator_gradients, ~ float32 image
+    """
+
+    accumulator = np.zeros(grad_x.shape, dtype=np.float32)
+    _kernels['center_map'](np.asarray(grad_x, dtype=np.float64), np.asarray(grad_y, dtype=np.float64),
+                           np.asarray(weights, dtype=np.float64), accumulator)
+    return accumulator
+
+
+def linpolar_table(i_0, j_0, i_n, j_n, p_n, t_n, t_s):
+
+    """ Fancy indices of linpolar_transform, returns (p_k, t_k, i_k, j_k) for polar coords inside the input image
+    """
+
+    table = np.empty((4, p_n * t_n), dtype=np.int64)
+    num_found = _kernels['linpolar'](float(i_0), float(j_0), i_n, j_n, p_n, t_n, float(t_s), table)
+    return tuple(table[:, :num_found])
+
+
+def sample_rays(intensity_img, (x0, y0), angles, ray_start, ray_end, step_ray=1, kernel=(1, 2, 0, -2, -1),
+                with_responses=False):
+
+    """ RayCaster.ray_sample for many rays at once, returns (num rays, 2) strongest kernel response along each ray,
+    and with_responses the (num rays,) responses themselves
+
+    Rays leaving the image within len(kernel) samples have response -inf, and get the point len(kernel) / 2 steps in
+    """
+
+    pts = np.empty((len(angles), 2), dtype=np.int64)
+    responses = np.empty(len(angles), dtype=np.float64)
+    _kernels['rays'](np.ascontiguousarray(intensity_img, dtype=np.int32), float(x0), float(y0),
+                     np.asarray(angles, dtype=np.float64), float(ray_start), int((ray_end - ray_start) // step_ray),
+                     float(step_ray), np.asarray(kernel, dtype=np.float64), pts, responses)
+    return (pts, responses) if with_responses else pts
+
+
+def refine_upper_eyelid_ys(filter_img, xs, ys, (search_start, search_end), max_drop):
+
+    """ Column scan of eyelid_locator.find_upper_eyelid, moves each y to the best response search_start to search_end
+    rows below it, if that is no more than max_drop weaker
+    """
+
+    new_ys = np.empty(len(xs), dtype=np.int64)
+    if len(xs) == 0: return new_ys
+    _kernels['eyelid'](filter_img, np.asarray(xs, dtype=np.int64), np.asarray(ys, dtype=np.int64),
+                       search_start, search_end, max_drop, new_ys)
+    return new_ys
+
+
+def warm_up():
+
+    """ Runs every kernel once on tiny inputs, which compiles them under Numba
+    """
+
+    tick = time()
+    img = np.arange(64, dtype=np.uint8).reshape(8, 8)
+    gradient_center_map(np.ones((8, 8)), np.zeros((8, 8)), np.ones((8, 8)))
+    linpolar_table(4, 4, 8, 8, 4, 8, np.pi / 4)
+    sample_rays(img, (4, 4), np.radians([0.0, 180.0]), 1, 4)
+    refine_upper_eyelid_ys(img, np.arange(8), np.zeros(8, dtype=int), (1, 4), 50)
+    return (time() - tick) * 1000
+
+
+if backend == 'numba': warm_up_ms = warm_up()
+
+
+#----------------------------------------
+# EXAMPLE USAGE
+#----------------------------------------
+if __name__ == '__main__':
+
+    import cv2
+    import glob
+    import eye_center_locator_gradients
+    import linpolar_transform
+    import eyelid_locator
+    from ray_casting import RayCaster
+
+    # Per-column loop find_upper_eyelid used before refine_upper_eyelid_ys
+    def refine_upper_eyelid_reference(filter_img, xs, ys, (search_start, search_end), max_drop):
+        new_ys = []
+        for i, x in enumerate(xs):
+            col = filter_img.T[x]
+            col_window = col[ys[i] + search_start:min(ys[i] + search_end, len(col) - 2)]
+            if len(col_window) and np.max(col) - np.max(col_window) < max_drop:
+                new_ys.append(np.argmax(col_window) + ys[i] + search_start)
+            else:
+                new_ys.append(ys[i])
+        return np.array(new_ys)
+
+    print 'Backend: %s (warm-up %0.1f ms)' % (backend, warm_up_ms)
+
+    eye_imgs = []
+    for path in sorted(glob.glob('eye_images/*.png')):
+        eye_img = cv2.imread(path)
+        img_h, img_w = eye_img.shape[:2]
+        eye_imgs.append(np.ascontiguousarray(eye_img[:, (img_w - img_h) / 2:(img_w + img_h) / 2]))
+
+    caster, angles = RayCaster(), np.radians(range(-60, 60, 2) + range(120, 240, 2))
+
+    # Inputs as the pipeline produces them: 25 px high red channels for centre maps, linpolar tables of
+    # find_limbus_points, rays from ROI centres as RayCaster.find_limbus_edge_pts casts them, and Gabor responses
+    small_imgs = [cv2.resize(cv2.split(eye_img)[2], (25, 25)) for eye_img in eye_imgs]
+    table_args = [(i_n / 2, j_n / 2, i_n, j_n, i_n / 2, 400, 2 * np.pi / 400) for (i_n, j_n) in [(100, 100), (120, 90)]]
+    ray_inputs = [(cv2.GaussianBlur(eye_img, (5, 5), 5), (eye_img.shape[1] / 2, eye_img.shape[0] / 2),
+                   int(eye_img.shape[0] * 0.1), int(eye_img.shape[0] * 0.4)) for eye_img in eye_imgs]
+    eyelid_inputs = []
+    for eye_img in eye_imgs:
+        filter_img = eyelid_locator.gabor_bank.filter('upper_eyelid', cv2.split(eye_img)[2])
+        ys = np.argmax(filter_img, axis=0)
+        eyelid_inputs.append((filter_img, np.arange(filter_img.shape[1])[ys > 0], ys[ys > 0], (5, 100), 50))
+
+    def compare(name, num_inputs=None):
+
+        """ Times reference and current kernels over inputs, counts inputs where outputs differ
+        """
+
+        checks = {
+            'Gradient centre map': (eye_center_locator_gradients.get_center_map_reference,
+                                    lambda img : gradient_center_map(*eye_center_locator_gradients.get_gradients(img)) /
+                                                 float(img.size),
+                                    [(img,) for img in small_imgs],
+                                    lambda ref, fast : (np.allclose(ref, fast, rtol=1e-4, atol=1e-7) and
+                                                        np.argmax(ref) == np.argmax(fast))),
+            'Linpolar table': (linpolar_transform._build_transform_reference, linpolar_table, table_args,
+                               lambda ref, fast : all(np.array_equal(r, f) for (r, f) in zip(ref, fast))),
+            'Ray sampling': (lambda img, start, r0, r1 : [caster.ray_sample(img, angle, start, r0, r1)
+                                                          for angle in angles],
+                             lambda img, start, r0, r1 : sample_rays(caster.get_intensity_img(img), start, angles,
+                                                                     r0, r1),
+                             ray_inputs, np.array_equal),
+            'Eyelid column scan': (refine_upper_eyelid_reference, refine_upper_eyelid_ys, eyelid_inputs,
+                                   np.array_equal)}
+
+        reference, fast, inputs, same = checks[name]
+        inputs = inputs[:num_inputs]
+
+        tick = time()
+        ref_outs = [reference(*args) for args in inputs]
+        ref_ms = (time() - tick) * 1000 / len(inputs)
+        tick = time()
+        fast_outs = [fast(*args) for args in inputs]
+        fast_ms = (time() - tick) * 1000 / len(inputs)
+
+        mismatches = sum(not same(ref_out, fast_out) for (ref_out, fast_out) in zip(ref_outs, fast_outs))
+        print '  %s - reference: %0.2f ms, %s: %0.2f ms, mismatches: %d/%d' % (name, ref_ms, kernels_used, fast_ms,
+                                                                              mismatches, len(inputs))
+
+    names = ['Gradient centre map', 'Linpolar table', 'Ray sampling', 'Eyelid column scan']
+
+    kernels_used = backend
+    for name in names: compare(name)
+
+    # Without Numba, loop kernels are still checked, run as plain Python on a few inputs
+    if backend == 'numpy':
+        _kernels = {'center_map': _gradient_center_map_loops, 'linpolar': _linpolar_table_loops,
+                    'rays': _sample_rays_loops, 'eyelid': _refine_upper_eyelid_loops}
+        kernels_used = 'loops as Python'
+        for name in names: compare(name, 4)
@@ -1,7 +1,7 @@
 import cv2, numpy as np
 
-from math import pi 
 from linpolar_transform import linpolar
+from gabor_filters import gabor_bank
 from image_utils import stack_imgs_horizontal, stack_imgs_vertical
 from draw_utils import draw_points
 
@@ -10,23 +10,44 @@ __limb_r_ratios = (0.15, 0.4)
 __min_limb_r = int(__fixed_width * __limb_r_ratios[0])    
 __max_limb_r = int(__fixed_width * __limb_r_ratios[1])
 
-__gabor_params = {'ksize':(7, 7),
-          'sigma':2, 'theta':pi / 2,
-          'lambd':pi * 2,
-          'gamma':2,
-          'psi':pi / 2,
-          'ktype':cv2.CV_32F}
-__gabor_kern = cv2.getGaborKernel(**__gabor_params)
+__min_band_h = 16                  # Narrowed bands are kept at least this high (polar px), well above Gabor kernel size
 
 __winname = "Limbus Points (filtered polar img)"
 __debug_imgs = {}
 
 
+def get_limb_r_range(ellipse, eye_img_shape, margin=15):
+    
+    """ Polar band (radii in fixed-size img px) around ellipse in ROI coords, for searching near a predicted limbus
+    
+    Radii from ROI centre to the ellipse lie within its semi-axes, give or take the offset between centres
+    """
+    
+    (x0, y0), (axis_1, axis_2), _ = ellipse.rotated_rect
+    img_h, img_w = eye_img_shape[:2]
+    scale = __fixed_width / float(img_h)
+    offset = np.sqrt((x0 - img_w / 2.0) ** 2 + (y0 - img_h / 2.0) ** 2)
+    
+    min_r = int((min(axis_1, axis_2) / 2 - offset) * scale) - margin
+    max_r = int((max(axis_1, axis_2) / 2 + offset) * scale) + margin
+    
+    # Never search outside the default band, and keep the band high enough to filter
+    min_r, max_r = max(min_r, __min_limb_r), min(max_r, __max_limb_r)
+    if max_r - min_r < __min_band_h:
+        mid_r = min(max((min_r + max_r) / 2, __min_limb_r + __min_band_h / 2), __max_limb_r - __min_band_h / 2)
+        min_r, max_r = mid_r - __min_band_h / 2, mid_r + __min_band_h / 2
+    
+    return min_r, max_r
+
+
 #                eye_img - bgr img of eye ROI
 #                |        phi - angle to ignore at extreme ranges (close to 90 or 270)
 #                |        |       angles considered = 360 / angle_step
-#                |        |       |
-def get_limb_pts(eye_img, phi=20, angle_step=1, debug_index=False):
+#                |        |       |                 r_range - (min, max) polar radii to search, see get_limb_r_range
+#                |        |       |                 |
+def get_limb_pts(eye_img, phi=20, angle_step=1, debug_index=False, r_range=None):
+    
+    min_limb_r, max_limb_r = (__min_limb_r, __max_limb_r) if r_range is None else r_range
     
     polar_img_w = 360 / angle_step                                      # Polar image has one column per angle of interest
     phi_range_1 = ((90 - phi) / angle_step, (90 + phi) / angle_step)    # Ranges of angles to be ignored (too close to lids)
@@ -44,8 +65,8 @@ def get_limb_pts(eye_img, phi=20, angle_step=1, debug_index=False):
     img_polar = cv2.GaussianBlur(img_polar, (5, 5), 0)
     
     # Take the segment between min & max radii and filter with Gabor kernel
-    img_polar_seg = img_polar[__min_limb_r:__max_limb_r, :]
-    filter_img = cv2.filter2D(img_polar_seg, -1, __gabor_kern)
+    img_polar_seg = img_polar[min_limb_r:max_limb_r, :]
+    filter_img = gabor_bank.filter('limbus', img_polar_seg)
     
     # Black out ignored angles
     filter_img.T[ phi_range_1[0] : phi_range_1[1] ] = 0
@@ -54,7 +75,7 @@ def get_limb_pts(eye_img, phi=20, angle_step=1, debug_index=False):
     # In polar image, x <-> theta, y <-> magnitude         
     pol_ys = np.argmax(filter_img, axis=0)                      # Take highest filter response as limbus points
     pol_xs = np.arange(filter_img.shape[1])[pol_ys > 0]
-    mags = (pol_ys + __min_limb_r)[pol_ys > 0]
+    mags = (pol_ys + min_limb_r)[pol_ys > 0]
     thts = np.radians(pol_xs * angle_step)
 
     # Translate each point back into fixed img coords
@@ -76,10 +97,10 @@ def get_limb_pts(eye_img, phi=20, angle_step=1, debug_index=False):
         
         cv2.imwrite("polar.jpg",debug_polar)
         
-        cv2.line(debug_polar, (0, __min_limb_r), (img_polar.shape[1], __min_limb_r), (255, 255, 0))
-        cv2.line(debug_polar, (0, __max_limb_r), (img_polar.shape[1], __max_limb_r), (255, 255, 0))
-        cv2.circle(debug_img, (debug_img.shape[1] / 2, debug_img.shape[0] / 2), int(debug_img.shape[0] * __limb_r_ratios[0]), (255, 255, 0))
-        cv2.circle(debug_img, (debug_img.shape[1] / 2, debug_img.shape[0] / 2), int(debug_img.shape[0] * __limb_r_ratios[1]), (255, 255, 0))
+        cv2.line(debug_polar, (0, min_limb_r), (img_polar.shape[1], min_limb_r), (255, 255, 0))
+        cv2.line(debug_polar, (0, max_limb_r), (img_polar.shape[1], max_limb_r), (255, 255, 0))
+        cv2.circle(debug_img, (debug_img.shape[1] / 2, debug_img.shape[0] / 2), int(min_limb_r * scale), (255, 255, 0))
+        cv2.circle(debug_img, (debug_img.shape[1] / 2, debug_img.shape[0] / 2), int(max_limb_r * scale), (255, 255, 0))
         
         pts_polar = np.squeeze(np.dstack([pol_xs, mags]))
         draw_points(debug_polar, pts_polar, (0, 0, 255), width=1)
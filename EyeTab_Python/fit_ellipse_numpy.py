@@ -1,63 +1,165 @@
 import numpy as np
 
-from math import degrees
-from numpy.linalg import eig, inv
-
-#### ADAPTED FROM
-#### http://nicky.vanforeest.com/misc/fitEllipse/fitEllipse.html
-
-def fit_ellipse_get_coeffs(x,y):
-    x = x[:, np.newaxis]
-    y = y[:, np.newaxis]
-    D = np.hstack((x * x, x * y, y * y, x, y, np.ones_like(x)))
-    S = np.dot(D.T, D)
-    C = np.zeros([6, 6])
-    C[0, 2] = C[2, 0] = 2; C[1, 1] = -1
-    E, V = eig(np.dot(inv(S), C))
-    n = np.argmax(np.abs(E))
-    mat = V[:, n]
-    
-    return get_coeffs(mat), get_rotated_rect(mat)
+from conic_section import conic_coeffs_to_rects, shift_conic_coeffs
+
+#### Direct least-squares ellipse fit (Fitzgibbon et al. '99), in the numerically stable form of
+#### Halir & Flusser '98, for many point sets at once
+
+__root_offsets = 2 * np.pi * np.arange(3) / 3
+
+def get_eig_vecs_3x3(mats):
+
+    """ Eigenvectors of (M, 3, 3) matrices with real eigenvalues ~ (M, 3, 3) with vectors as columns, like np.linalg.eig
+
+    Closed form: roots of the characteristic cubic (trigonometric method), then null vector of each
+    (mat - root * I) as the largest cross product of its rows. Far cheaper per matrix than LAPACK for large M
+    """
+
+    # Characteristic polynomial t^3 - tr t^2 + c t - det, depressed to s^3 + p s + q with t = s + tr / 3
+    tr = mats[:, 0, 0] + mats[:, 1, 1] + mats[:, 2, 2]
+    c = (mats[:, 0, 0] * mats[:, 1, 1] - mats[:, 0, 1] * mats[:, 1, 0] +
+         mats[:, 0, 0] * mats[:, 2, 2] - mats[:, 0, 2] * mats[:, 2, 0] +
+         mats[:, 1, 1] * mats[:, 2, 2] - mats[:, 1, 2] * mats[:, 2, 1])
+    p = c - tr * tr / 3
+    q = -2 * tr ** 3 / 27 + tr * c / 3 - np.linalg.det(mats)
+
+    # Three real roots need p <= 0, clipping keeps nearly repeated roots real
+    p = np.minimum(p, -1e-300)
+    cos_arg = np.clip(1.5 * q / p * np.sqrt(-3 / p), -1, 1)
+    roots = (2 * np.sqrt(-p / 3)[:, np.newaxis] * np.cos(np.arccos(cos_arg)[:, np.newaxis] / 3 - __root_offsets) +
+             tr[:, np.newaxis] / 3)
+
+    # Row pairs (0, 1), (0, 2), (1, 2) of (mat - root * I) for every root ~ (M, 3 roots, 3 pairs, 3)
+    rows = mats[:, np.newaxis] - roots[..., np.newaxis, np.newaxis] * np.eye(3)
+    rows_a, rows_b = rows[:, :, [0, 0, 1]], rows[:, :, [1, 2, 2]]
+    crosses = rows_a[..., [1, 2, 0]] * rows_b[..., [2, 0, 1]] - rows_a[..., [2, 0, 1]] * rows_b[..., [1, 2, 0]]
+
+    norms = np.sqrt(np.sum(crosses ** 2, axis=3)).reshape(-1, 3)
+    best = np.argmax(norms, axis=1)
+    inds = np.arange(len(best))
+    vecs = crosses.reshape(-1, 3, 3)[inds, best] / np.maximum(norms[inds, best], 1e-300)[:, np.newaxis]
+
+    return np.transpose(vecs.reshape(-1, 3, 3), (0, 2, 1))
+
+
+def fit_ellipses(point_sets, weights=None):
+
+    """ Fits an ellipse to each of M point sets ~ (M, k, 2), returns (M, 6) conic coeffs, (M, 5) rotated_rects
+    [x0, y0, w, h, angle] and validity
+
+    weights ~ (M, k) selects (0 / 1) or weights points per set, e.g. inlier masks against one shared point array
+    """
+
+    point_sets = np.asarray(point_sets, dtype=float)
+    xs, ys = point_sets[..., 0], point_sets[..., 1]
+
+    # Normalize each set to zero mean & unit spread, pixel-scale coords make the scatter matrix ill-conditioned
+    if weights is None:
+        weights = 1
+        totals = float(point_sets.shape[1])
+    else:
+        weights = np.asarray(weights, dtype=float)
+        totals = np.maximum(weights.sum(axis=1), 1e-12)
+    mean_x, mean_y = np.sum(weights * xs, axis=1) / totals, np.sum(weights * ys, axis=1) / totals
+    xs, ys = xs - mean_x[:, np.newaxis], ys - mean_y[:, np.newaxis]
+    scales = np.sqrt(np.sum(weights * (xs * xs + ys * ys), axis=1) / totals / 2)
+    scales[scales == 0] = 1
+    xs, ys = xs / scales[:, np.newaxis], ys / scales[:, np.newaxis]
+
+    # Design matrix [quadratic part D1 | linear part D2], and its scatter matrix [[S1 S2] [S2' S3]]
+    D = np.empty(xs.shape + (6,))
+    D[..., 0], D[..., 1], D[..., 2], D[..., 3], D[..., 4], D[..., 5] = xs * xs, xs * ys, ys * ys, xs, ys, 1
+    S = np.matmul(np.transpose(D * weights[..., np.newaxis] if weights is not 1 else D, (0, 2, 1)), D)
+    S1, S2, S3 = S[:, :3, :3], S[:, :3, 3:], S[:, 3:, 3:]
+
+    # Fewer than 5 points (or collinear ones) leave S3 singular
+    valid = np.abs(np.linalg.det(S3)) > 1e-9
+    S3[~valid] = np.eye(3)
+
+    # Linear part in terms of quadratic part, then reduced 3x3 eigenproblem with constraint matrix inverted by hand
+    T = -np.linalg.solve(S3, np.transpose(S2, (0, 2, 1)))
+    M = S1 + np.matmul(S2, T)
+    M = M[:, [2, 1, 0]] * [[0.5], [-1], [0.5]]
+
+    eig_vecs = get_eig_vecs_3x3(M)
+
+    # Exactly one eigenvector satisfies the ellipse constraint 4ac - b^2 > 0
+    conds = 4 * eig_vecs[:, 0] * eig_vecs[:, 2] - eig_vecs[:, 1] ** 2
+    best = np.argmax(conds, axis=1)
+    inds = np.arange(len(best))
+    valid &= conds[inds, best] > 0
+
+    a1 = eig_vecs[inds, :, best]
+    a2 = np.matmul(T, a1[..., np.newaxis])[..., 0]
+
+    # Undo normalization: scale back to px, then shift back to set's mean
+    coeffs = np.concatenate([a1, a2], axis=1) / (scales[:, np.newaxis] ** [2, 2, 2, 1, 1, 0])
+    coeffs = shift_conic_coeffs(coeffs, mean_x, mean_y)
+
+    rects, coeffs, ellipse_ok = conic_coeffs_to_rects(coeffs)
+
+    return coeffs, rects, valid & ellipse_ok
+
 
 def fitEllipse(x, y):
-    x = x[:, np.newaxis]
-    y = y[:, np.newaxis]
-    D = np.hstack((x * x, x * y, y * y, x, y, np.ones_like(x)))
-    S = np.dot(D.T, D)
-    C = np.zeros([6, 6])
-    C[0, 2] = C[2, 0] = 2; C[1, 1] = -1
-    E, V = eig(np.dot(inv(S), C))
-    n = np.argmax(np.abs(E))
-    mat = V[:, n]
-    
-    # make it look like OpenCV rotated rect
-    return get_rotated_rect(mat)
-
-def get_coeffs(mat):
-    b, c, d, f, g, a = mat[1] / 2, mat[2], mat[3] / 2, mat[4] / 2, mat[5], mat[0]
-    return a, 2*b, c, 2*d, 2*f, g
-
-def get_rotated_rect(mat):
-    return ellipse_center(mat), ellipse_axis_length(mat), degrees(ellipse_angle_of_rotation(mat)) + 90
-
-def ellipse_center(a):
-    b, c, d, f, g, a = a[1] / 2, a[2], a[3] / 2, a[4] / 2, a[5], a[0]
-    num = b * b - a * c
-    x0 = (c * d - b * f) / num
-    y0 = (a * f - b * d) / num
-    return (x0, y0)
-
-def ellipse_angle_of_rotation(a):
-    b, c, d, f, g, a = a[1] / 2, a[2], a[3] / 2, a[4] / 2, a[5], a[0]
-    return 0.5 * np.arctan(2 * b / (a - c))
-
-def ellipse_axis_length(a):
-    b, c, d, f, g, a = a[1] / 2, a[2], a[3] / 2, a[4] / 2, a[5], a[0]
-    up = 2 * (a * f * f + c * d * d + g * b * b - 2 * b * d * f - a * c * g)
-    down1 = (b * b - a * c) * ((c - a) * np.sqrt(1 + 4 * b * b / ((a - c) * (a - c))) - (c + a))
-    down2 = (b * b - a * c) * ((a - c) * np.sqrt(1 + 4 * b * b / ((a - c) * (a - c))) - (c + a))
-    res1 = np.sqrt(up / down1)
-    res2 = np.sqrt(up / down2)
-    min_axis = min(res1, res2) * 2
-    maj_axis = max(res1, res2) * 2
-    return (min_axis, maj_axis)
+
+    """ Single point set version, returns rotated_rect like cv2.fitEllipse (with w <= h)
+    """
+
+    _, rects, _ = fit_ellipses(np.column_stack([x, y])[np.newaxis])
+    x0, y0, w, h, angle = rects[0]
+    return (x0, y0), (w, h), angle
+
+
+def fit_ellipse_get_coeffs(x, y):
+
+    coeffs, rects, _ = fit_ellipses(np.column_stack([x, y])[np.newaxis])
+    x0, y0, w, h, angle = rects[0]
+    return tuple(coeffs[0]), ((x0, y0), (w, h), angle)
+
+
+#----------------------------------------
+# EXAMPLE USAGE
+#----------------------------------------
+if __name__ == '__main__':
+
+    import cv2
+    from time import time
+
+    # Six-point samples from noisy limbus-sized ellipse arcs, as RANSAC draws them
+    np.random.seed(0)
+    num_sets, k = 2000, 6
+    true_rects = np.column_stack([np.random.uniform(300, 700, num_sets), np.random.uniform(200, 500, num_sets),
+                                  np.random.uniform(25, 35, num_sets), np.random.uniform(36, 45, num_sets),
+                                  np.random.uniform(0, 180, num_sets)])
+    thetas = np.random.uniform(-np.pi / 2, np.pi / 2, (num_sets, k)) + np.where(np.arange(k) < k / 2, 0, np.pi)
+    x0, y0, w, h, angle = [c[:, np.newaxis] for c in true_rects.T]
+    us, vs = w / 2 * np.cos(thetas), h / 2 * np.sin(thetas)
+    cos_a, sin_a = np.cos(np.radians(angle)), np.sin(np.radians(angle))
+    point_sets = np.dstack([x0 + us * cos_a - vs * sin_a, y0 + us * sin_a + vs * cos_a])
+    point_sets += np.random.normal(0, 0.5, point_sets.shape)
+
+    tick = time()
+    cv_rects = [cv2.fitEllipse(point_set.astype(np.float32)) for point_set in point_sets]
+    cv_us = (time() - tick) * 1e6 / num_sets
+
+    tick = time()
+    coeffs, rects, valid = fit_ellipses(point_sets)
+    batch_us = (time() - tick) * 1e6 / num_sets
+
+    print 'Per fit - cv2.fitEllipse: %0.1f us, batched direct fit: %0.1f us (%d/%d valid)' % (cv_us, batch_us,
+                                                                                           np.sum(valid), num_sets)
+
+    cv_centres = np.array([centre for (centre, _, _) in cv_rects])
+    cv_axes = np.sort([axes for (_, axes, _) in cv_rects], axis=1)
+    for name, centres, axes in [('cv2', cv_centres, cv_axes), ('batched', rects[:, :2], rects[:, 2:4])]:
+        centre_errs = np.hypot(*(centres - true_rects[:, :2]).T)[valid]
+        axis_errs = np.abs(axes - true_rects[:, 2:4])[valid]
+        print '%s - centre error median: %0.2f px, axis error median: %0.2f px' % (name, np.median(centre_errs),
+                                                                                 np.median(axis_errs))
+
+    # Conditioning: the unnormalized formulation breaks down far from the origin
+    far_sets = point_sets[:5] + 1e4
+    _, far_rects, far_valid = fit_ellipses(far_sets)
+    print 'Shifted by 10000 px, centre drift: %0.2e px (%d/5 valid)' % (
+        np.abs(far_rects[:, :2] - 1e4 - rects[:5, :2]).max(), np.sum(far_valid))
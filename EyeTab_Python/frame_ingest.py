@@ -0,0 +1,149 @@
+import cv2
+import numpy as np
+
+def get_has_reduced_decode():
+
+    """ Reduced-scale flags need OpenCV 3+, and some versions only honour them in imread, not imdecode
+    """
+
+    if not hasattr(cv2, 'IMREAD_REDUCED_COLOR_2'): return False
+
+    test_jpeg = cv2.imencode('.jpg', np.zeros((16, 16, 3), dtype=np.uint8))[1]
+    return cv2.imdecode(test_jpeg, cv2.IMREAD_REDUCED_COLOR_2).shape[:2] == (8, 8)
+
+# Without reduced decoding, levels are decoded in full and made with pyrDown instead
+has_reduced_decode = get_has_reduced_decode()
+
+if has_reduced_decode:
+    decode_flags = {1: cv2.IMREAD_COLOR,
+                    2: cv2.IMREAD_REDUCED_COLOR_2,
+                    4: cv2.IMREAD_REDUCED_COLOR_4,
+                    8: cv2.IMREAD_REDUCED_COLOR_8}
+else:
+    decode_flags = {1: cv2.IMREAD_COLOR}
+
+
+class FrameIngest:
+
+    def __init__(self, rot90s=0, cam_mat=None, dist_coeffs=None):
+
+        """ Turns camera frames into rotated, undistorted pyramids
+
+        Undistortion maps are built once per (image shape, scale) and re-used with cv2.remap
+        """
+
+        self.rot90s = rot90s
+        self.cam_mat = cam_mat
+        self.dist_coeffs = dist_coeffs
+        self.undistort_maps = {}
+
+    def get_undistort_maps(self, img_shape, scale):
+
+        h, w = img_shape[:2]
+        if (h, w, scale) not in self.undistort_maps:
+
+            # Intrinsics are calibrated at full-res, so scale them down with the image
+            scaled_cam_mat = self.cam_mat.copy()
+            scaled_cam_mat[:2] /= scale
+
+            self.undistort_maps[(h, w, scale)] = cv2.initUndistortRectifyMap(scaled_cam_mat, self.dist_coeffs, None,
+                                                                             scaled_cam_mat, (w, h), cv2.CV_16SC2)
+        return self.undistort_maps[(h, w, scale)]
+
+    def undistort(self, img, scale=1):
+
+        """ Same result as cv2.undistort, without rebuilding the maps for every frame
+        """
+
+        if self.cam_mat is None: return img
+
+        map_1, map_2 = self.get_undistort_maps(img.shape, scale)
+        return cv2.remap(np.ascontiguousarray(img), map_1, map_2, cv2.INTER_LINEAR)
+
+    def decode(self, jpeg, scale=1):
+
+        """ Decodes a JPEG directly at 1/scale of its size, then rotates and undistorts it
+        """
+
+        img = cv2.imdecode(np.fromstring(jpeg, dtype=np.uint8), decode_flags[scale])
+        if img is None: return None
+
+        return self.undistort(np.rot90(img, self.rot90s), scale)
+
+    def make_pyramid(self, jpeg, max_depth=4):
+        return FramePyramid(self, jpeg, max_depth)
+
+
+class FramePyramid(dict):
+
+    def __init__(self, ingest, jpeg, max_depth=4):
+
+        """ Dict of scale:image like image_utils.make_gauss_pyr, but each level is only made when first used
+
+        Eye detection only looks at the 1/4 level, so the full-res frame is not decoded when no eyes are found
+        """
+
+        dict.__init__(self)
+        self.ingest = ingest
+        self.jpeg = jpeg
+        self.scales = [2 ** i for i in range(max_depth)]
+
+    def __missing__(self, scale):
+
+        if scale not in self.scales: raise KeyError(scale)
+
+        if scale in decode_flags:
+            img = self.ingest.decode(self.jpeg, scale)
+        else:
+            img = cv2.pyrDown(self[scale / 2])
+
+        self[scale] = img
+        return img
+
+    def keys(self):
+        return list(self.scales)
+
+
+#----------------------------------------
+# EXAMPLE USAGE
+#----------------------------------------
+if __name__ == '__main__':
+
+    import glob
+    import image_utils
+    from time import time
+    from device_constants import cam_mat_n7, dist_coefs_n7
+
+    ingest = FrameIngest(rot90s=-1, cam_mat=cam_mat_n7, dist_coeffs=dist_coefs_n7)
+
+    # Stand-in for 720p landscape camera frames
+    frames = [cv2.resize(cv2.imread(path), (1280, 720)) for path in glob.glob('eye_images/*.png')]
+    jpegs = [cv2.imencode('.jpg', frame)[1].tostring() for frame in frames]
+    num_iters = 10
+
+    tick = time()
+    for _ in range(num_iters):
+        for jpeg in jpegs:
+            frame = cv2.imdecode(np.fromstring(jpeg, dtype=np.uint8), cv2.IMREAD_COLOR)
+            frame = cv2.undistort(np.rot90(frame, -1).copy(), cam_mat_n7, dist_coefs_n7)
+            frame_pyr = image_utils.make_gauss_pyr(frame, 4)
+    full_ms = (time() - tick) * 1000 / (num_iters * len(jpegs))
+
+    tick = time()
+    for _ in range(num_iters):
+        for jpeg in jpegs:
+            frame_pyr = ingest.make_pyramid(jpeg)
+            frame_pyr[4]
+    reduced_ms = (time() - tick) * 1000 / (num_iters * len(jpegs))
+
+    print 'Full decode + undistort + pyramid: %0.2f ms' % full_ms
+    print 'Reduced decode of detection level only: %0.2f ms (reduced decode available: %s)' % (reduced_ms,
+                                                                                             has_reduced_decode)
+
+    # Compare against full-res pipeline for each level
+    frame = cv2.undistort(np.rot90(cv2.imdecode(np.fromstring(jpegs[0], dtype=np.uint8), cv2.IMREAD_COLOR), -1).copy(),
+                          cam_mat_n7, dist_coefs_n7)
+    ref_pyr, frame_pyr = image_utils.make_gauss_pyr(frame, 4), ingest.make_pyramid(jpegs[0])
+    for scale in sorted(ref_pyr.keys()):
+        diff = np.abs(ref_pyr[scale].astype(float) - frame_pyr[scale]).mean()
+        print 'Scale 1/%d: %s, mean abs difference %0.2f' % (scale, frame_pyr[scale].shape, diff)
@@ -0,0 +1,182 @@
+import cv2
+import numpy as np
+
+BLINK = 'blink'
+FIXATION = 'fixation'
+
+stat_size = (32, 32)            # ROIs are shrunk to this before measuring contrast
+closed_contrast_ratio = 0.5     # Closed once contrast drops below this fraction of the eye's open baseline
+baseline_len = 30               # Recent open-eye contrasts the baseline is the median of
+baseline_len_min = 5            # Never report closed before this many open frames
+closed_checks_max = 10          # Consecutive closed checks longer than any blink, the contrast change is taken as
+                                # lighting instead and becomes the new baseline
+min_eyelid_sep = 0.15           # Eyelid separation at ROI centre (fraction of ROI height), open eyes are > 0.25
+
+blink_decimation = 3            # While eyes are closed, process every nth frame to catch them reopening
+fixation_decimation = 2         # While gaze is fixed, process every nth frame
+fixation_frames_min = 10        # Consecutive fixed frames before fixation decimation starts
+
+
+class BlinkDetector:
+
+    def __init__(self, closed_ratio=closed_contrast_ratio, min_eyelid_sep=min_eyelid_sep):
+
+        """ Closed-eye tests cheap enough to run before the heavy per-eye stages
+
+        Contrast of the red channel drops with no dark iris in view, compared against each eye's own recent baseline
+        """
+
+        self.closed_ratio = closed_ratio
+        self.min_eyelid_sep = min_eyelid_sep
+        self.open_contrasts = [[], []]
+        self.closed_contrasts = [[], []]        # of the current run of closed checks
+        self.eyes_closed = [False, False]
+
+    def new_frame(self):
+        self.eyes_closed = [False, False]
+
+    def get_contrast(self, eye_img_bgr):
+
+        eye_img_r = cv2.resize(cv2.split(eye_img_bgr)[2], stat_size, interpolation=cv2.INTER_AREA)
+        return cv2.meanStdDev(eye_img_r)[1][0, 0]
+
+    def is_closed(self, eye_index, eye_img_bgr):
+
+        """ Compares ROI contrast with the eye's open baseline, only open eyes update the baseline
+
+        A closed run outlasting any blink (closed_checks_max) restarts the baseline from that run's contrasts, so a
+        lasting drop in contrast (e.g. lighting) can't keep the eye closed
+        """
+
+        contrast = self.get_contrast(eye_img_bgr)
+        open_contrasts, closed_contrasts = self.open_contrasts[eye_index], self.closed_contrasts[eye_index]
+
+        closed = (len(open_contrasts) >= baseline_len_min and
+                  contrast < self.closed_ratio * np.median(open_contrasts))
+
+        if closed:
+            closed_contrasts.append(contrast)
+            if len(closed_contrasts) >= closed_checks_max:
+                open_contrasts[:] = closed_contrasts
+                closed_contrasts[:] = []
+                closed = False
+        else:
+            closed_contrasts[:] = []
+            open_contrasts.append(contrast)
+            del open_contrasts[:-baseline_len]
+
+        self.eyes_closed[eye_index] = closed
+        return closed
+
+    def eyelids_closed(self, eye_index, u_eyelid, l_eyelid, eye_img):
+
+        """ Once both eyelids are found, their separation at ROI centre (where the pupil was placed)
+        """
+
+        if u_eyelid is None or l_eyelid is None: return False
+
+        x = eye_img.shape[1] / 2.0
+        u_a, u_b, u_c = u_eyelid
+        l_a, l_b = l_eyelid
+        separation = ((l_a * x + l_b) - (u_a * x ** 2 + u_b * x + u_c)) / eye_img.shape[0]
+
+        closed = separation < self.min_eyelid_sep
+        self.eyes_closed[eye_index] = self.eyes_closed[eye_index] or closed
+        return closed
+
+
+class FrameScheduler:
+
+    def __init__(self, blink_decimation=blink_decimation, fixation_decimation=fixation_decimation,
+                 fixation_frames_min=fixation_frames_min):
+
+        """ Decides which frames get processed, decimating while eyes are closed or gaze is fixed
+
+        Only processed frames update the state, so it keeps sampling often enough to notice when either ends
+        """
+
+        self.decimations = {BLINK: blink_decimation, FIXATION: fixation_decimation}
+        self.fixation_frames_min = fixation_frames_min
+
+        self.mode = None                # BLINK, FIXATION or None (process every frame)
+        self.frames_since_processed = 0
+
+        self.frames_seen = 0
+        self.frames_skipped = dict((mode, 0) for mode in self.decimations.keys())
+
+    def should_process(self):
+
+        self.frames_seen += 1
+
+        if self.mode is not None and self.frames_since_processed + 1 < self.decimations[self.mode]:
+            self.frames_since_processed += 1
+            self.frames_skipped[self.mode] += 1
+            return False
+
+        self.frames_since_processed = 0
+        return True
+
+    def update(self, eyes_closed, fixed_frames):
+
+        """ Called after each processed frame. eyes_closed - all eyes found were closed
+        """
+
+        if eyes_closed:
+            self.mode = BLINK
+        elif fixed_frames >= self.fixation_frames_min:
+            self.mode = FIXATION
+        else:
+            self.mode = None
+
+    def get_skip_rate(self):
+        return sum(self.frames_skipped.values()) / float(max(self.frames_seen, 1))
+
+    def get_summary(self):
+
+        return '%d/%d frames skipped (%0.1f%%, blink: %d, fixation: %d)' % (sum(self.frames_skipped.values()),
+                                                                            self.frames_seen,
+                                                                            self.get_skip_rate() * 100,
+                                                                            self.frames_skipped[BLINK],
+                                                                            self.frames_skipped[FIXATION])
+
+
+#----------------------------------------
+# EXAMPLE USAGE
+#----------------------------------------
+if __name__ == '__main__':
+
+    import glob
+    from time import time
+
+    eye_imgs = []
+    for path in sorted(glob.glob('eye_images/*.png')):
+        eye_img = cv2.imread(path)
+        img_h, img_w = eye_img.shape[:2]
+        eye_imgs.append(np.ascontiguousarray(eye_img[:, (img_w - img_h) / 2:(img_w + img_h) / 2]))
+
+    # Stand-in for a closed eye: no dark iris, only smooth skin-toned shading
+    close_eye = lambda eye_img : cv2.addWeighted(cv2.GaussianBlur(eye_img, (0, 0), 15), 0.5,
+                                                 np.full_like(eye_img, int(np.median(eye_img))), 0.5, 0)
+
+    closed_imgs = [close_eye(eye_img) for eye_img in eye_imgs]
+
+    detector = BlinkDetector()
+    false_closed, missed_closed, tick = 0, 0, time()
+    for eye_img, closed_img in zip(eye_imgs, closed_imgs):
+        for _ in range(baseline_len_min): detector.is_closed(0, eye_img)            # Open baseline for this eye
+        false_closed += detector.is_closed(0, eye_img)
+        missed_closed += not detector.is_closed(0, closed_img)
+        detector.open_contrasts[0] = []
+    ms = (time() - tick) * 1000 / (len(eye_imgs) * (baseline_len_min + 2))
+
+    print 'Contrast test: %0.3f ms, open eyes called closed: %d/%d, closed eyes missed: %d/%d' % (
+        ms, false_closed, len(eye_imgs), missed_closed, len(eye_imgs))
+
+    # Simulated session: 300 frames at ~15 fps, blinks of 4 frames every 60, and a long fixation mid-way
+    scheduler, fixed_frames = FrameScheduler(), 0
+    for frame_id in range(300):
+        if not scheduler.should_process(): continue
+        fixed_frames = fixed_frames + 1 if 100 <= frame_id < 200 else 0
+        scheduler.update(frame_id % 60 < 4, fixed_frames)
+
+    print scheduler.get_summary()
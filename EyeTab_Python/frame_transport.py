@@ -0,0 +1,251 @@
+import cv2
+import ctypes
+import multiprocessing
+import numpy as np
+
+import frame_ingest
+
+from time import time
+
+num_slots_default = 8                   # Frames in flight, a producer blocks (or drops frames) beyond this
+slot_shape_default = (1280, 720, 3)     # 720p BGR frame in either orientation, anything up to its size fits
+
+header_len = 6                          # Ints per slot: generation, is_jpeg, ndim, shape (unused dims are 1)
+
+attached_ring = None                    # Ring of this process, when started by a pool with attach as initializer
+
+
+class NoFreeSlot(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+
+class FrameTooLarge(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+
+class StaleFrame(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+
+class FrameHandle:
+
+    def __init__(self, slot, generation, shape, is_jpeg=False):
+
+        """ What is sent to workers in place of a frame, a few ints however large the frame
+        """
+
+        self.slot = slot
+        self.generation = generation        # of the slot when written, tells a recycled slot from this frame
+        self.shape = shape
+        self.is_jpeg = is_jpeg              # slot holds an MJPEG stream's JPEG bytes rather than pixels
+
+
+class FrameRing:
+
+    def __init__(self, num_slots=num_slots_default, slot_shape=slot_shape_default):
+
+        """ Ring of preallocated uint8 frame slots in shared memory, passed to workers as FrameHandles
+
+        Each slot is reference counted, put waits for a slot nobody holds, consumers map it without copying and
+        release it when done. Buffers are inherited, not pickled, so create the ring before the pool and hand it to
+        workers through the pool's initializer (see attach)
+        """
+
+        self.num_slots = num_slots
+        self.slot_bytes = int(np.prod(slot_shape))
+
+        self.buffer = multiprocessing.RawArray(ctypes.c_uint8, num_slots * self.slot_bytes)
+        self.headers = multiprocessing.RawArray(ctypes.c_int, num_slots * header_len)
+        self.refcounts = multiprocessing.RawArray(ctypes.c_int, num_slots)
+        self.cond = multiprocessing.Condition()         # guards refcounts & headers, notified as slots free up
+
+        self.next_slot = 0
+
+        # Counted in the producing process only
+        self.frames_put = 0
+        self.waits = 0
+
+    def get_slot_array(self, slot, shape):
+
+        """ shape view of slot's memory, no copy
+        """
+
+        offset = slot * self.slot_bytes
+        return np.frombuffer(self.buffer, np.uint8, int(np.prod(shape)), offset).reshape(shape)
+
+    def acquire_slot(self, num_refs, timeout):
+
+        """ Index of a free slot (starting after the last one used) now held num_refs times, and its generation
+        """
+
+        deadline = None if timeout is None else time() + timeout
+        with self.cond:
+            waited = False
+            while True:
+                for i in range(self.num_slots):
+                    slot = (self.next_slot + i) % self.num_slots
+                    if self.refcounts[slot] == 0: break
+                else:
+                    slot = None
+
+                if slot is not None: break
+
+                remaining = None if deadline is None else deadline - time()
+                if remaining is not None and remaining <= 0:
+                    raise NoFreeSlot('All %d frame slots held' % self.num_slots)
+                waited = True
+                self.cond.wait(remaining)
+
+            self.waits += waited
+            self.refcounts[slot] = num_refs
+            self.headers[slot * header_len] += 1
+            self.next_slot = (slot + 1) % self.num_slots
+            return slot, self.headers[slot * header_len]
+
+    def put(self, frame, num_refs=1, timeout=None, is_jpeg=False):
+
+        """ Copies frame (uint8, up to 3 dims) into a free slot, returns its FrameHandle
+
+        The slot is freed once release has been called num_refs times. Waits up to timeout s for a slot (forever if
+        None), then raises NoFreeSlot, so live streams can drop the frame with timeout=0
+        """
+
+        if frame.nbytes > self.slot_bytes:
+            raise FrameTooLarge('Frame of %s is larger than slots of %d bytes' % (frame.shape, self.slot_bytes))
+
+        slot, generation = self.acquire_slot(num_refs, timeout)
+
+        # Rotated frames are views, copying them in makes them contiguous at no extra cost
+        self.get_slot_array(slot, frame.shape)[...] = frame
+
+        header = [generation, int(is_jpeg), frame.ndim] + list(frame.shape) + [1] * (3 - frame.ndim)
+        self.headers[slot * header_len:(slot + 1) * header_len] = header
+
+        self.frames_put += 1
+        return FrameHandle(slot, generation, frame.shape, is_jpeg)
+
+    def get(self, handle):
+
+        """ Read-only view of handle's frame, valid until the handle is released
+        """
+
+        if self.headers[handle.slot * header_len] != handle.generation:
+            raise StaleFrame('Slot %d was recycled, its frame was released too often' % handle.slot)
+
+        frame = self.get_slot_array(handle.slot, handle.shape)
+        frame.flags.writeable = False
+        return frame
+
+    def retain(self, handle, num_refs=1):
+
+        """ Adds holders of handle's slot, e.g. before passing it on to more workers
+        """
+
+        with self.cond:
+            self.refcounts[handle.slot] += num_refs
+
+    def release(self, handle):
+
+        with self.cond:
+            self.refcounts[handle.slot] -= 1
+            if self.refcounts[handle.slot] <= 0:
+                self.refcounts[handle.slot] = 0
+                self.cond.notify_all()
+
+    def get_num_held(self):
+        with self.cond:
+            return sum(refcount > 0 for refcount in self.refcounts)
+
+    # --------------------- Frames of main.read_frame ---------------------
+
+    def put_frame(self, frame, num_refs=1, timeout=None):
+
+        """ put for what main.read_frame returns, FramePyramids of network streams are sent as their JPEG
+        """
+
+        if isinstance(frame, frame_ingest.FramePyramid):
+            return self.put(np.fromstring(frame.jpeg, dtype=np.uint8), num_refs, timeout, is_jpeg=True)
+        return self.put(frame, num_refs, timeout)
+
+    def get_frame(self, handle, ingest):
+
+        """ Frame of put_frame for GazeSystem.get_gaze_from_frame, JPEGs become lazy FramePyramids of ingest
+        """
+
+        if handle.is_jpeg:
+            return ingest.make_pyramid(self.get(handle).tostring())
+        return self.get(handle)
+
+    def get_summary(self):
+        return '%d frames put in %d slots, waited for a free slot %d times' % (self.frames_put, self.num_slots,
+                                                                              self.waits)
+
+
+def attach(ring):
+
+    """ Pool initializer, multiprocessing.Pool(initializer=attach, initargs=(ring,)) makes ring attached_ring in
+    every worker
+    """
+
+    global attached_ring
+    attached_ring = ring
+
+
+def get_level_mean(frame):
+
+    """ Mean of the 1/4 level, stand-in for a worker's per-frame task
+    """
+
+    return cv2.resize(frame, None, fx=0.25, fy=0.25, interpolation=cv2.INTER_AREA).mean()
+
+
+def get_level_mean_shared(handle):
+
+    try:
+        return get_level_mean(attached_ring.get(handle))
+    finally:
+        attached_ring.release(handle)
+
+
+#----------------------------------------
+# EXAMPLE USAGE
+#----------------------------------------
+if __name__ == '__main__':
+
+    import glob
+
+    num_workers = 4
+    num_frames = 400
+
+    # Stand-in for 720p frames, rotated to portrait as read_frame does
+    frames = [np.rot90(cv2.resize(cv2.imread(path), (1280, 720)), -1) for path in sorted(glob.glob('eye_images/*.png'))]
+
+    ring = FrameRing(num_slots=2 * num_workers)
+    pool = multiprocessing.Pool(num_workers, initializer=attach, initargs=(ring,))
+
+    try:
+        # Workers do what eye detection does first, so the transport is most of the cost
+        tick = time()
+        results = [pool.apply_async(get_level_mean, (frames[i % len(frames)],)) for i in range(num_frames)]
+        pickled = [result.get() for result in results]
+        pickle_ms = (time() - tick) * 1000 / num_frames
+
+        # The producer blocks in put whenever all slots are in flight, workers release them as they finish
+        tick = time()
+        results = [pool.apply_async(get_level_mean_shared, (ring.put_frame(frames[i % len(frames)]),))
+                   for i in range(num_frames)]
+        shared = [result.get() for result in results]
+        shared_ms = (time() - tick) * 1000 / num_frames
+    finally:
+        pool.close()
+        pool.join()
+
+    print '%d workers, %d frames of %s' % (num_workers, num_frames, frames[0].shape)
+    print 'Pickled frames: %0.2f ms per frame (%0.0f fps)' % (pickle_ms, 1000 / pickle_ms)
+    print 'Shared frame ring: %0.2f ms per frame (%0.0f fps), %0.2fx' % (shared_ms, 1000 / shared_ms,
+                                                                        pickle_ms / shared_ms)
+    print 'Same results: %s, slots still held: %d' % (pickled == shared, ring.get_num_held())
+    print ring.get_summary()
@@ -0,0 +1,194 @@
+import cv2
+import threading
+import numpy as np
+
+from math import pi
+from time import time
+from time_profiler import TimeProfiler
+
+SPATIAL = 0x1               # cv2.filter2D with full kernel
+SEPARABLE = 0x2             # cv2.sepFilter2D with rank-1 (SVD) approximation of kernel
+DFT = 0x3                   # Multiplication of spectra, worth it for large kernels only
+
+method_names = {SPATIAL: 'spatial', SEPARABLE: 'separable', DFT: 'dft'}
+
+#                     kernel name - also the stage its timings are recorded under
+#                     |
+kernel_params = {'limbus': {'ksize':(7, 7),
+                            'sigma':2,
+                            'theta':pi / 2,
+                            'lambd':pi * 2,
+                            'gamma':2,
+                            'psi':pi / 2,
+                            'ktype':cv2.CV_32F},
+                 'upper_eyelid': {'ksize':(7, 7),
+                                  'sigma':3,
+                                  'theta':-pi / 2,
+                                  'lambd':pi * 3,
+                                  'gamma':2,
+                                  'psi':pi / 2,
+                                  'ktype':cv2.CV_32F},
+                 'lower_eyelid_l': {'ksize':(5, 5),
+                                    'sigma':3,
+                                    'theta':pi / 4,
+                                    'lambd':pi * 2,
+                                    'gamma':2,
+                                    'psi':pi / 2,
+                                    'ktype':cv2.CV_32F}}
+
+# Kernels made by horizontally flipping another
+flipped_kernels = {'lower_eyelid_r': 'lower_eyelid_l'}
+
+# Kernels filtered other than by SPATIAL, for OpenCV builds where that is faster (time them with EXAMPLE USAGE). With
+# OpenCV 4.2, filter2D is fastest for every kernel here, it switches to DFT by itself past 11x11
+kernel_methods = {}
+
+max_separable_err = 1e-3    # Max relative (Frobenius) error of rank-1 approximation to count as separable
+
+
+class GaborBank:
+
+    def __init__(self, kernel_params=kernel_params, flipped_kernels=flipped_kernels, kernel_methods=kernel_methods):
+
+        """ Builds all named Gabor kernels once, and filters images with each kernel's method from kernel_methods
+
+        Kernels not in kernel_methods (all of them by default) are filtered SPATIAL, SEPARABLE & DFT only run when set
+        there. Nothing is chosen by timing, so filter outputs are the same on every run, as checkpointed stages need
+        """
+
+        self.kernels = {}
+        for name, params in kernel_params.items():
+            self.kernels[name] = cv2.getGaborKernel(**params)
+        for name, src_name in flipped_kernels.items():
+            self.kernels[name] = cv2.flip(self.kernels[src_name], 1)
+
+        # Rank-1 factors (kernel_x, kernel_y) of kernels that are separable, e.g. axis-aligned Gabors
+        self.separable_factors = {}
+        for name, kernel in self.kernels.items():
+            factors = get_separable_factors(kernel)
+            if factors is not None: self.separable_factors[name] = factors
+
+        # SEPARABLE is only exact enough for separable kernels, others stay SPATIAL
+        self.methods = dict((name, SPATIAL) for name in self.kernels)
+        for name, method in kernel_methods.items():
+            if method != SEPARABLE or name in self.separable_factors: self.methods[name] = method
+
+        self.dft_kernels = {}       # (name, dft shape) : kernel spectrum
+        self.timings = TimeProfiler()
+
+        # The bank is shared by every GazeSystem, so its caches & timings are only updated under the lock
+        self.lock = threading.Lock()
+
+    def filter(self, name, img, method=None):
+
+        """ Same result as cv2.filter2D(img, -1, kernel) (to within rounding), timed under name
+        """
+
+        # Empty windows come through as None, let filter2D raise its usual error for them
+        if method is None: method = SPATIAL if img is None else self.methods[name]
+
+        tick = time()
+        filter_img = self.apply(name, img, method)
+        with self.lock:
+            self.timings.sections[name] = self.timings.sections.get(name, 0) + (time() - tick) * 1000
+
+        return filter_img
+
+    def apply(self, name, img, method):
+
+        if method == SEPARABLE:
+            kernel_x, kernel_y = self.separable_factors[name]
+            return cv2.sepFilter2D(img, -1, kernel_x, kernel_y)
+        elif method == DFT:
+            return self.filter_dft(name, img)
+        else:
+            return cv2.filter2D(img, -1, self.kernels[name])
+
+    def filter_dft(self, name, img):
+
+        """ Correlation via DFT, with same anchor and reflected border as cv2.filter2D
+        """
+
+        kernel = self.kernels[name]
+        kernel_h, kernel_w = kernel.shape
+        anchor_y, anchor_x = kernel_h / 2, kernel_w / 2
+
+        padded_img = cv2.copyMakeBorder(img, anchor_y, kernel_h - 1 - anchor_y, anchor_x, kernel_w - 1 - anchor_x,
+                                        cv2.BORDER_REFLECT_101)
+        padded_h, padded_w = padded_img.shape[:2]
+        dft_shape = cv2.getOptimalDFTSize(padded_h), cv2.getOptimalDFTSize(padded_w)
+
+        # Correlation is convolution with flipped kernel
+        if (name, dft_shape) not in self.dft_kernels:
+            dft_kernel = np.zeros(dft_shape, dtype=np.float32)
+            dft_kernel[:kernel_h, :kernel_w] = kernel[::-1, ::-1]
+            dft_kernel = cv2.dft(dft_kernel, flags=cv2.DFT_COMPLEX_OUTPUT)
+            with self.lock: self.dft_kernels[(name, dft_shape)] = dft_kernel
+
+        dft_img = np.zeros(dft_shape, dtype=np.float32)
+        dft_img[:padded_h, :padded_w] = padded_img
+        spectrum = cv2.mulSpectrums(cv2.dft(dft_img, flags=cv2.DFT_COMPLEX_OUTPUT), self.dft_kernels[(name, dft_shape)], 0)
+        conv_img = cv2.idft(spectrum, flags=cv2.DFT_SCALE | cv2.DFT_REAL_OUTPUT)
+
+        filter_img = conv_img[kernel_h - 1:kernel_h - 1 + img.shape[0], kernel_w - 1:kernel_w - 1 + img.shape[1]]
+        if img.dtype == np.uint8:
+            return np.clip(np.round(filter_img), 0, 255).astype(np.uint8)
+        return filter_img.astype(img.dtype)
+
+    def get_timings(self):
+
+        """ Returns dict of kernel name : total time (ms) spent filtering with it
+        """
+
+        return dict(self.timings.sections)
+
+
+def get_separable_factors(kernel, max_err=max_separable_err):
+
+    """ Returns (kernel_x, kernel_y) with outer(kernel_y, kernel_x) ~ kernel, or None if kernel is not close to rank-1
+    """
+
+    u, s, vt = np.linalg.svd(kernel.astype(float))
+    if s[0] == 0 or np.sqrt(np.sum(s[1:] ** 2)) / np.sqrt(np.sum(s ** 2)) > max_err: return None
+
+    kernel_y = (u[:, 0] * np.sqrt(s[0])).astype(np.float32)
+    kernel_x = (vt[0] * np.sqrt(s[0])).astype(np.float32)
+    return kernel_x, kernel_y
+
+
+# Shared by all stages, so kernels are only ever built once
+gabor_bank = GaborBank()
+
+
+#----------------------------------------
+# EXAMPLE USAGE
+#----------------------------------------
+if __name__ == '__main__':
+
+    import glob
+
+    eye_imgs = [cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2GRAY) for path in glob.glob('eye_images/*.png')]
+    num_iters = 200
+
+    for name in sorted(gabor_bank.kernels.keys()):
+        print '%s: kernel %s, separable: %s' % (name, gabor_bank.kernels[name].shape, name in gabor_bank.separable_factors)
+
+        # Time every method, to see which are worth setting in kernel_methods
+        for method, method_name in sorted(method_names.items()):
+            if method == SEPARABLE and name not in gabor_bank.separable_factors: continue
+
+            max_diff, tick = 0, time()
+            for img in eye_imgs:
+                for _ in range(num_iters):
+                    filter_img = gabor_bank.filter(name, img, method)
+                max_diff = max(max_diff, np.abs(filter_img.astype(int) - cv2.filter2D(img, -1, gabor_bank.kernels[name])).max())
+            ms = (time() - tick) * 1000 / (num_iters * len(eye_imgs))
+
+            print '    %s: %0.3f ms, max abs difference from filter2D %d' % (method_name, ms, max_diff)
+
+        print '    chosen: %s' % method_names[gabor_bank.methods[name]]
+
+    gabor_bank.timings.reset()
+    for img in eye_imgs:
+        for name in gabor_bank.kernels.keys(): gabor_bank.filter(name, img)
+    print 'Time per stage (ms): %s' % gabor_bank.get_timings()
@@ -1,9 +1,8 @@
-import visual as vpy
 import numpy as np
 import anatomical_constants
 
 from math import sin, cos, acos, atan, radians, sqrt
-from conic_section import Ellipse
+from conic_section import EllipseBatch
 
 cam_mat_n7 = np.array([[1062.348, 0.0     , 344.629],
                        [0.0     , 1065.308, 626.738],
@@ -40,9 +39,7 @@ def ellipse_to_limbuses_persp_geom(ellipse, device):
     
     limbus_center = (iris_x_mm, iris_y_mm, iris_z_mm)
     
-    (ell_x0, ell_y0), (ell_w, ell_h), angle = ellipse.rotated_rect                           
-    new_rotated_rect = (ell_x0 - prin_point_x, ell_y0 - prin_point_y), (ell_w, ell_h), angle 
-    ell = Ellipse(new_rotated_rect)                                                         
+    ell = ellipse.shifted(-prin_point_x, -prin_point_y)
     
     f = focal_len_z_px;
     
@@ -50,11 +47,8 @@ def ellipse_to_limbuses_persp_geom(ellipse, device):
                   [ell.B / 2.0, ell.C, ell.E / (2.0 * f)],
                   [ell.D / (2.0 * f), ell.E / (2.0 * f), ell.F / (f * f)]])
     
-    eig_vals, eig_vecs = np.linalg.eig(Z)
-    
-    idx = eig_vals.argsort()   
-    eig_vals = eig_vals[idx]
-    eig_vecs = eig_vecs[:, idx]
+    # Z is symmetric, so eigh gives real eigenvalues already in ascending order
+    eig_vals, eig_vecs = np.linalg.eigh(Z)
     
     L1, L2, L3 = eig_vals[2], eig_vals[1], eig_vals[0]
     R = np.vstack([eig_vecs[:, 2], eig_vecs[:, 1], eig_vecs[:, 0]])
@@ -76,11 +70,81 @@ def ellipse_to_limbuses_persp_geom(ellipse, device):
 
     return Limbus(limbus_center, [nx, ny, nz], ellipse)
 
+
+def ellipses_to_limbuses(ellipses, device):
+    
+    """ Batched ellipse_to_limbuses_persp_geom, returns one Limbus per ellipse
+    """
+    
+    if len(ellipses) == 0: return []
+    
+    centres_mm, normals = ellipses_to_limbus_arrays(EllipseBatch.from_ellipses(ellipses), device)
+    
+    return [Limbus(tuple(c), list(n), ellipse) for (c, n, ellipse) in zip(centres_mm, normals, ellipses)]
+
+
+def ellipses_to_limbus_arrays(rotated_rects, device):
+    
+    """ Back-projects N ellipses at once, returns (N, 3) limbus centres (mm) and (N, 3) normals
+    
+    rotated_rects may be an EllipseBatch, a list of rotated_rects or an (N, 5) array of [x0, y0, w, h, angle]
+    """
+    
+    ellipses = rotated_rects if isinstance(rotated_rects, EllipseBatch) else EllipseBatch(rotated_rects)
+    rects = ellipses.rects
+    
+    limbus_r_mm = anatomical_constants.limbus_r_mm
+    focal_len_x_px, focal_len_y_px, prin_point_x, prin_point_y = device.get_intrisic_cam_params()
+    focal_len_z_px = (focal_len_x_px + focal_len_y_px) / 2
+    
+    x0_px, y0_px, maj_axis_px = rects[:, 0], rects[:, 1], rects[:, 3]
+    
+    # Using iris_r_px / focal_len_px = iris_r_mm / distance_to_iris_mm
+    iris_z_mm = (limbus_r_mm * 2 * focal_len_z_px) / maj_axis_px
+    
+    # Using (x_screen_px - prin_point) / focal_len_px = x_world / z_world
+    iris_x_mm = -iris_z_mm * (x0_px - prin_point_x) / focal_len_x_px
+    iris_y_mm = iris_z_mm * (y0_px - prin_point_y) / focal_len_y_px
+    
+    centres_mm = np.column_stack([iris_x_mm, iris_y_mm, iris_z_mm])
+    
+    # Conic of each ellipse with origin shifted to the principal point
+    A, B, C, D, E, F = ellipses.shifted(-prin_point_x, -prin_point_y).coeffs.T
+    
+    f = focal_len_z_px
+    
+    Z = np.empty((len(rects), 3, 3))
+    Z[:, 0, 0], Z[:, 1, 1], Z[:, 2, 2] = A, C, F / (f * f)
+    Z[:, 0, 1] = Z[:, 1, 0] = B / 2.0
+    Z[:, 0, 2] = Z[:, 2, 0] = D / (2.0 * f)
+    Z[:, 1, 2] = Z[:, 2, 1] = E / (2.0 * f)
+    
+    # Z is symmetric, so eigh gives real eigenvalues already in ascending order
+    eig_vals, eig_vecs = np.linalg.eigh(Z)
+    L3, L2, L1 = eig_vals[:, 0], eig_vals[:, 1], eig_vals[:, 2]
+    
+    g = np.sqrt((L2 - L3) / (L1 - L3))
+    h = np.sqrt((L1 - L2) / (L1 - L3))
+    
+    # Normal is R.dot([h, 0, -+g]) where rows of R are eigenvectors by descending eigenvalue
+    g = np.where(iris_x_mm > 0, -g, g)
+    normals = h[:, np.newaxis] * eig_vecs[:, 0, ::-1] + g[:, np.newaxis] * eig_vecs[:, 2, ::-1]
+    nx, ny, nz = normals[:, 0], normals[:, 1], normals[:, 2]
+    
+    # Constraints
+    normals[nz > 0] *= -1
+    ny[ny * nz < 0] *= -1
+    nx[:] = np.where(iris_x_mm > 0, -np.abs(nx), np.abs(nx))
+    
+    return centres_mm, normals
+
 def ellipse_to_limbuses_approx(ellipse, device):
     
     """ Returns 2 ambiguous limbuses
     """
     
+    import visual as vpy                        # Only needed here, keeps compute core free of VPython
+    
     limbus_r_mm = anatomical_constants.limbus_r_mm
     focal_len_x_px, focal_len_y_px, prin_point_x, prin_point_y = device.get_intrisic_cam_params()
     focal_len_z_px = (focal_len_x_px + focal_len_y_px) / 2
@@ -139,6 +203,16 @@ def get_gaze_point_mm(limbus):
     x_screen_mm, y_screen_mm = x0 + dx * t, y0 + dy * t
 
     return x_screen_mm, y_screen_mm
+
+
+def get_gaze_points_mm(centres_mm, normals):
+    
+    """ Array version of get_gaze_point_mm for (..., 3) arrays of limbus centres and normals, returns (..., 2)
+    """
+    
+    t = -centres_mm[..., 2] / normals[..., 2]
+    
+    return centres_mm[..., :2] + normals[..., :2] * t[..., np.newaxis]
   
     
 def convert_gaze_pt_mm_to_px((x_screen_mm, y_screen_mm), device):
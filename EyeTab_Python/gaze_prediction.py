@@ -0,0 +1,113 @@
+import csv
+
+from math import sqrt
+from time import time
+from gaze_smoothing import fixation_thresh_min_mm, fixation_thresh_max_mm
+
+FIXATION = 0x1
+PURSUIT = 0x2
+SACCADE = 0x3
+
+class GazePredictor:
+
+    def __init__(self, hist_len=4, latency_s=0.1, latency_weight=0.1):
+
+        """ Extrapolates smoothed gaze forward in time to hide the capture-to-send delay
+        """
+
+        self.hist_len = hist_len
+        self.history = []                       # [(timestamp, (x_mm, y_mm)), ...] oldest first
+        self.latency_s = latency_s              # running estimate of pipeline delay
+        self.latency_weight = latency_weight    # weight of each new latency measurement
+        self.movement = FIXATION
+
+    def update_latency(self, latency_s):
+
+        """ Folds a measured capture-to-send delay (s) into the running estimate
+        """
+
+        self.latency_s += self.latency_weight * (latency_s - self.latency_s)
+
+    def classify_movement(self):
+
+        """ Labels recent gaze as fixation, pursuit or saccade from distance travelled in history
+        """
+
+        (_, (x_old, y_old)), (_, (x_new, y_new)) = self.history[0], self.history[-1]
+        dist_mm = sqrt((x_new - x_old) ** 2 + (y_new - y_old) ** 2)
+
+        if dist_mm < fixation_thresh_min_mm: return FIXATION
+        elif dist_mm < fixation_thresh_max_mm: return PURSUIT
+        else: return SACCADE
+
+    def get_velocity(self):
+
+        """ Least-squares gaze velocity (mm/s) over history
+        """
+
+        ts = [t for (t, _) in self.history]
+        t_mean = sum(ts) / len(ts)
+        x_mean = sum([x for (_, (x, _)) in self.history]) / len(ts)
+        y_mean = sum([y for (_, (_, y)) in self.history]) / len(ts)
+
+        var_t = sum([(t - t_mean) ** 2 for t in ts])
+        if var_t == 0: return 0, 0
+
+        vel_x = sum([(t - t_mean) * (x - x_mean) for (t, (x, _)) in self.history]) / var_t
+        vel_y = sum([(t - t_mean) * (y - y_mean) for (t, (_, y)) in self.history]) / var_t
+        return vel_x, vel_y
+
+    def predict_gaze(self, gaze_pt_mm, timestamp=None):
+
+        """ Returns gaze point (mm) predicted for when it will reach the device
+        """
+
+        if gaze_pt_mm is None: return None
+        if timestamp is None: timestamp = time()
+
+        self.history.append((timestamp, gaze_pt_mm))
+        self.history = self.history[-self.hist_len:]
+
+        if len(self.history) < 2: return gaze_pt_mm
+
+        # Never extrapolate during fixation, it only adds jitter
+        self.movement = self.classify_movement()
+        if self.movement == FIXATION: return gaze_pt_mm
+
+        vel_x, vel_y = self.get_velocity()
+        dx, dy = vel_x * self.latency_s, vel_y * self.latency_s
+
+        # Saccades are ballistic and land soon, so clamp extrapolation to avoid overshooting
+        extrap_mm = sqrt(dx ** 2 + dy ** 2)
+        if self.movement == SACCADE and extrap_mm > fixation_thresh_max_mm:
+            dx, dy = dx * fixation_thresh_max_mm / extrap_mm, dy * fixation_thresh_max_mm / extrap_mm
+
+        x_mm, y_mm = gaze_pt_mm
+        return x_mm + dx, y_mm + dy
+
+
+def summarize_eval_file(filename):
+
+    """ Mean error (mm) of smoothed and predicted gaze against markers in a Visualizer3d evaluation csv
+    """
+
+    smoothed_errs, predicted_errs = [], []
+
+    with open(filename + '.csv') as eval_file:
+        for row in csv.reader(eval_file):
+            smoothed_errs.append(float(row[6]))
+            if len(row) > 9: predicted_errs.append(float(row[11]))
+
+    mean = lambda errs : sum(errs) / len(errs) if errs else None
+    return mean(smoothed_errs), mean(predicted_errs)
+
+
+#----------------------------------------
+# EXAMPLE USAGE
+#----------------------------------------
+if __name__ == '__main__':
+
+    import sys
+
+    smoothed_err, predicted_err = summarize_eval_file(sys.argv[1])
+    print 'Mean error smoothed: %s mm, predicted: %s mm' % (smoothed_err, predicted_err)
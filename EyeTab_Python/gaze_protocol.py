@@ -0,0 +1,232 @@
+import errno
+import socket
+import struct
+
+from collections import namedtuple
+
+TEXT_MODE = 0x1             # Original '%d %d \n' lines, for older device apps
+BINARY_MODE = 0x2
+
+#                          magic - marks start of packet
+#                          | version
+#                          | | number of messages in packet
+#                          | | |
+header_struct = struct.Struct('<2sBB')
+header_magic = 'GZ'
+header_version = 1
+
+#                           frame id
+#                           | capture timestamp (s)
+#                           | | gaze x, y (px), NaN when no gaze
+#                           | | |  eye bits (1 - user's right valid, 2 - user's left valid,
+#                           | | |  |           4 - right, 8 - left only reusing its previous limbus)
+#                           | | |  | confidence
+#                           | | |  | |
+message_struct = struct.Struct('<IdffBf')
+
+max_batch_len = 255         # Messages per packet, the header counts them in one byte
+max_buffer_len = 64 * 1024  # Stop queueing packets if device falls this far behind
+max_pending_len = 4 * max_batch_len     # Without coalescing, oldest messages are dropped beyond this backlog
+
+GazeMessage = namedtuple('GazeMessage', ['frame_id', 'capture_time', 'x', 'y', 'eyes_valid', 'confidence'])
+
+
+def make_message(frame_id, capture_time, gaze_pt, eyes_valid=(True, True), confidence=1.0, eyes_reused=(False, False)):
+
+    """ Builds a GazeMessage, packing per-eye validity and reuse into bits
+    """
+
+    x, y = (float('nan'), float('nan')) if gaze_pt is None else gaze_pt
+    eyes_valid_bits = sum([1 << i for (i, valid) in enumerate(eyes_valid) if valid])
+    eyes_valid_bits += sum([4 << i for (i, reused) in enumerate(eyes_reused) if reused])
+    return GazeMessage(frame_id, capture_time, x, y, eyes_valid_bits, confidence)
+
+
+def encode_binary(messages):
+
+    """ Packs up to max_batch_len messages into one framed packet
+    """
+
+    packet = header_struct.pack(header_magic, header_version, len(messages))
+    return packet + ''.join([message_struct.pack(*message) for message in messages])
+
+
+def encode_text(messages):
+
+    return ''.join(['%d %d \n' % (int(m.x), int(m.y)) for m in messages if m.x == m.x and m.y == m.y])
+
+
+class GazeDecoder:
+
+    def __init__(self):
+
+        """ Reference decoder for binary packets, accepts data in arbitrary chunks
+        """
+
+        self.buffer = ''
+        self.bad_packets = 0        # headers of unsupported versions skipped
+
+    def feed(self, data):
+
+        """ Returns list of all GazeMessages completed by data, packets of other versions are skipped
+        """
+
+        self.buffer += data
+        messages = []
+
+        while len(self.buffer) >= header_struct.size:
+
+            # Re-synchronise on next magic if stream is corrupt
+            if not self.buffer.startswith(header_magic):
+                next_start = self.buffer.find(header_magic, 1)
+                self.buffer = self.buffer[next_start:] if next_start >= 0 else self.buffer[-1:]
+                continue
+
+            _, version, num_messages = header_struct.unpack_from(self.buffer)
+            # Their length can't be trusted, so re-synchronise on the next magic, keeping what was decoded
+            if version != header_version:
+                self.buffer = self.buffer[len(header_magic):]
+                self.bad_packets += 1
+                continue
+
+            packet_len = header_struct.size + num_messages * message_struct.size
+            if len(self.buffer) < packet_len: break
+
+            for i in range(num_messages):
+                offset = header_struct.size + i * message_struct.size
+                messages.append(GazeMessage(*message_struct.unpack_from(self.buffer, offset)))
+
+            self.buffer = self.buffer[packet_len:]
+
+        return messages
+
+
+class GazeSender:
+
+    def __init__(self, sock, mode=BINARY_MODE, batch_len=1, coalesce=True):
+
+        """ Non-blocking sender for gaze messages
+
+        batch_len - number of messages to collect into each packet
+        coalesce - while the socket is backed up, only keep the newest message
+        """
+
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.mode = mode
+        self.batch_len = min(batch_len, max_batch_len)
+        self.coalesce = coalesce
+
+        self.pending = []
+        self.out_buffer = ''
+        self.messages_dropped = 0       # beyond max_pending_len while the socket was backed up
+
+    def send(self, message):
+
+        """ Queues a message, sending once a batch is complete. Raises socket.error if connection is lost
+        """
+
+        if self.coalesce and self.out_buffer:
+            self.pending = [message]            # Older gaze is stale by the time it would arrive
+        else:
+            self.pending.append(message)
+
+        if len(self.pending) > max_pending_len:
+            self.messages_dropped += len(self.pending) - max_pending_len
+            self.pending = self.pending[-max_pending_len:]
+
+        if len(self.pending) >= self.batch_len:
+            self.flush()
+        else:
+            self.send_buffered()
+
+    def flush(self):
+
+        self.send_buffered()
+
+        # Packets hold at most max_batch_len messages, the rest wait while the device is behind
+        encode = encode_binary if self.mode == BINARY_MODE else encode_text
+        while self.pending and not (self.coalesce and self.out_buffer) and len(self.out_buffer) < max_buffer_len:
+            self.out_buffer += encode(self.pending[:max_batch_len])
+            self.pending = self.pending[max_batch_len:]
+
+        self.send_buffered()
+
+    def send_buffered(self):
+
+        if not self.out_buffer: return
+
+        try:
+            bytes_sent = self.sock.send(self.out_buffer)
+            self.out_buffer = self.out_buffer[bytes_sent:]
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK): raise
+
+    def close(self):
+
+        self.sock.close()
+
+
+def run_loopback_server(port=9999, mode=BINARY_MODE, on_message=None, server_sock=None):
+
+    """ Stand-in for the device app: accepts one connection at a time and decodes gaze messages
+    """
+
+    if on_message is None:
+        def on_message(message): print message
+
+    if server_sock is None:
+        server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server_sock.bind(('127.0.0.1', port))
+        server_sock.listen(1)
+
+    while True:
+        conn, _ = server_sock.accept()
+        decoder, text_buffer = GazeDecoder(), ''
+
+        while True:
+            data = conn.recv(4096)
+            if not data: break
+
+            if mode == BINARY_MODE:
+                map(on_message, decoder.feed(data))
+            else:
+                text_buffer += data
+                lines = text_buffer.split('\n')
+                text_buffer = lines.pop()
+                for line in lines:
+                    x, y = line.split()
+                    on_message(GazeMessage(0, 0, float(x), float(y), 0, 0))
+
+        conn.close()
+
+
+#----------------------------------------
+# EXAMPLE USAGE
+#----------------------------------------
+if __name__ == '__main__':
+
+    import threading
+    from time import time, sleep
+
+    server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server_sock.bind(('127.0.0.1', 0))
+    server_sock.listen(1)
+
+    received = []
+    server_thread = threading.Thread(target=run_loopback_server,
+                                     kwargs={'server_sock': server_sock, 'on_message': received.append})
+    server_thread.daemon = True
+    server_thread.start()
+
+    sender = GazeSender(socket.create_connection(server_sock.getsockname()), BINARY_MODE, batch_len=4)
+    for frame_id in range(20):
+        sender.send(make_message(frame_id, time(), (400.25 + frame_id, 640.5), (True, True), 0.5,
+                                 (False, frame_id % 2 == 1)))
+    sender.flush()
+    sleep(0.5)
+
+    print 'Sent 20 messages, received %d' % len(received)
+    print received[-1]
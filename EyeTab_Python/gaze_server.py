@@ -0,0 +1,276 @@
+import cv2
+import numpy as np
+import socket
+import threading
+import traceback
+import gaze_system
+import gaze_protocol
+import frame_ingest
+import device_constants
+
+from mjpeg_reader import MjpegReader
+
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+from time import time, sleep
+
+reconnect_delay_s = 5.0         # Wait before re-opening a failed stream or control connection
+
+
+class StreamMetrics:
+
+    def __init__(self, ema_weight=0.1):
+
+        self.ema_weight = ema_weight
+        self.frames_read = 0
+        self.frames_processed = 0
+        self.frames_dropped = 0
+        self.frames_failed = 0      # raised in a worker, the stream carries on with its next frame
+        self.fps = 0.0
+        self.latency_ms = 0.0
+        self.last_tick = None
+
+    def frame_processed(self, latency_s):
+
+        tick = time()
+        if self.last_tick is not None and tick > self.last_tick:
+            self.fps += self.ema_weight * (1.0 / (tick - self.last_tick) - self.fps)
+        self.latency_ms += self.ema_weight * (latency_s * 1000 - self.latency_ms)
+        self.last_tick = tick
+        self.frames_processed += 1
+
+    def get_summary(self):
+
+        return {'fps': self.fps,
+                'latency_ms': self.latency_ms,
+                'frames_read': self.frames_read,
+                'frames_processed': self.frames_processed,
+                'frames_dropped': self.frames_dropped,
+                'frames_failed': self.frames_failed}
+
+
+class GazeStream:
+
+    def __init__(self, name, source, device, control_addr=None, realtime=True, protocol_mode=gaze_protocol.BINARY_MODE):
+
+        """ One camera stream with its own GazeSystem state
+
+        source - MJPEG url (read with MjpegReader) or path of a local video file standing in for a camera
+        control_addr - (host, port) of the device control socket to push gaze points to
+        realtime - play local files back at their recorded frame-rate
+        protocol_mode - gaze_protocol.BINARY_MODE or TEXT_MODE for older device apps
+        """
+
+        self.name = name
+        self.source = source
+        self.device = device
+        self.control_addr = control_addr
+        self.realtime = realtime
+        self.protocol_mode = protocol_mode
+
+        self.g_sys = gaze_system.GazeSystem(device, init_vpython=False, display=False)
+        self.metrics = StreamMetrics()
+
+        self.gaze_sender = None
+        self.last_connect_attempt = 0
+        self.running = False
+
+        # Only the newest frame waits for a worker, older ones are dropped
+        self.lock = threading.Lock()
+        self.pending_frame = None
+        self.busy = False
+
+    def connect_control(self):
+
+        if self.control_addr is None or time() - self.last_connect_attempt < reconnect_delay_s: return
+        self.last_connect_attempt = time()
+
+        try:
+            control_socket = socket.create_connection(self.control_addr, timeout=reconnect_delay_s)
+            self.gaze_sender = gaze_protocol.GazeSender(control_socket, self.protocol_mode)
+        except socket.error:
+            self.gaze_sender = None
+
+    def send_gaze(self, frame_id, capture_time, gaze_pt):
+
+        if self.gaze_sender is None: self.connect_control()
+        if self.gaze_sender is None: return
+
+        try:
+            self.gaze_sender.send(gaze_protocol.make_message(frame_id, capture_time, gaze_pt, self.g_sys.eyes_valid,
+                                                             self.g_sys.confidence, self.g_sys.eyes_reused))
+        except socket.error:
+            self.gaze_sender.close()
+            self.gaze_sender = None
+
+    def process_frame(self, frame_id, frame, capture_time, pool):
+
+        """ Runs in a pool worker, frame is a FramePyramid of an MJPEG stream or an unrotated local video frame
+
+        Nothing collects the async results, so failures are logged & counted here rather than lost
+        """
+
+        try:
+            if not isinstance(frame, frame_ingest.FramePyramid): frame = np.rot90(frame, self.device.rot90s)
+            gaze_pt = self.g_sys.get_gaze_from_frame(frame, capture_time)
+            self.send_gaze(frame_id, capture_time, gaze_pt)
+
+            latency_s = time() - capture_time
+            self.g_sys.update_latency(latency_s)
+            self.metrics.frame_processed(latency_s)
+
+        except Exception:
+            self.metrics.frames_failed += 1
+            print '%s: frame %d failed @ %s' % (self.name, frame_id, datetime.now().strftime('%X'))
+            traceback.print_exc()
+
+        finally:
+            # Hand the newest waiting frame (if any) back to the pool
+            with self.lock:
+                next_frame, self.pending_frame = self.pending_frame, None
+                self.busy = next_frame is not None
+            if next_frame is not None:
+                pool.apply_async(self.process_frame, next_frame + (pool,))
+
+    def schedule_frame(self, frame, capture_time, pool):
+
+        with self.lock:
+            frame_id = self.metrics.frames_read
+            self.metrics.frames_read += 1
+            if self.busy:
+                if self.pending_frame is not None: self.metrics.frames_dropped += 1
+                self.pending_frame = (frame_id, frame, capture_time)
+                return
+            self.busy = True
+
+        pool.apply_async(self.process_frame, (frame_id, frame, capture_time, pool))
+
+    def read_frames(self, pool):
+
+        """ Reads frames until stopped, re-opening the capture whenever it fails
+        """
+
+        if self.source.startswith('http'):
+            self.read_jpegs(pool)
+            return
+
+        while self.running:
+
+            vc = cv2.VideoCapture(self.source)
+            stream_open, frame = vc.read()
+
+            if not stream_open:
+                print '%s: failed to open stream @ %s' % (self.name, datetime.now().strftime('%X'))
+                sleep(reconnect_delay_s)
+                continue
+
+            print '%s: successfully opened stream @ %s' % (self.name, datetime.now().strftime('%X'))
+
+            fps = vc.get(cv2.cv.CV_CAP_PROP_FPS)
+            frame_interval_s = 1.0 / fps if (self.realtime and fps > 0) else 0
+            next_frame_time = time()
+
+            while self.running and stream_open:
+                self.schedule_frame(frame, time(), pool)
+
+                # Pace local files as if they were live cameras
+                next_frame_time += frame_interval_s
+                sleep(max(0, next_frame_time - time()))
+
+                stream_open, frame = vc.read()
+
+            vc.release()
+            print '%s: stream interrupted @ %s' % (self.name, datetime.now().strftime('%X'))
+
+    def read_jpegs(self, pool):
+
+        """ Network streams only hand on their newest JPEG as a lazy FramePyramid, the reader reconnects by itself
+        """
+
+        mjpeg_reader = MjpegReader(self.source).start()
+        try:
+            while self.running:
+                stream_open, jpeg, capture_time = mjpeg_reader.read_jpeg()
+                if stream_open: self.schedule_frame(self.g_sys.ingest.make_pyramid(jpeg), capture_time, pool)
+        finally:
+            mjpeg_reader.stop()
+
+
+class GazeServer:
+
+    def __init__(self, streams, num_workers=4):
+
+        """ Runs many GazeStreams in one process, sharing a pool of worker threads
+
+        Each stream has its own GazeSystem and is only ever processed by one worker at a time. Module-level state
+        shared between streams is thread-safe: cascades are loaded per thread, the Gabor bank and specular
+        PreProcessors lock their caches & counters
+        """
+
+        self.streams = streams
+        self.num_workers = num_workers
+        self.pool = None
+        self.reader_threads = []
+
+    def start(self):
+
+        self.pool = ThreadPool(self.num_workers)
+
+        for stream in self.streams:
+            stream.running = True
+            thread = threading.Thread(target=stream.read_frames, args=(self.pool,), name=stream.name)
+            thread.daemon = True
+            thread.start()
+            self.reader_threads.append(thread)
+
+    def stop(self):
+
+        for stream in self.streams:
+            stream.running = False
+        for thread in self.reader_threads:
+            thread.join()
+
+        self.pool.close()
+        self.pool.join()
+
+        for stream in self.streams:
+            if stream.gaze_sender is not None: stream.gaze_sender.close()
+
+    def get_metrics(self):
+
+        """ Returns dict of stream name : metrics summary
+        """
+
+        return dict([(stream.name, stream.metrics.get_summary()) for stream in self.streams])
+
+    def run(self, report_interval_s=5.0):
+
+        self.start()
+
+        try:
+            while True:
+                sleep(report_interval_s)
+                for name, metrics in sorted(self.get_metrics().items()):
+                    print '%s: %0.1f fps, %d ms latency, %d/%d dropped, %d failed' % (
+                        name, metrics['fps'], metrics['latency_ms'], metrics['frames_dropped'], metrics['frames_read'],
+                        metrics['frames_failed'])
+        except KeyboardInterrupt:
+            self.stop()
+
+
+#----------------------------------------
+# EXAMPLE USAGE
+#----------------------------------------
+if __name__ == '__main__':
+
+    hosts = ['192.168.137.195', '192.168.137.196']
+    camera_stream_port = 8080
+    device_control_port = 9999
+
+    streams = [GazeStream(name=host,
+                          source='http://%s:%d/' % (host, camera_stream_port),
+                          device=device_constants.Device(device_constants.NEXUS_7_INV),
+                          control_addr=(host, device_control_port))
+               for host in hosts]
+
+    GazeServer(streams, num_workers=4).run()
@@ -15,6 +15,9 @@ class GazeSmoother:
         self.weights = weight_makers[weight_type](hist_len)
         self.weights = [w / float(sum(self.weights)) for w in self.weights]
         self.gaze_histories = [ [(0, 0)] * hist_len, [(0, 0)] * hist_len ]
+        
+        self.gaze_is_fixed = False
+        self.fixed_frames = 0           # consecutive frames gaze has been fixed for
 
     def remove_inaccurate_pts_on_fixation(self, gaze_pts):
 
@@ -32,6 +35,9 @@ class GazeSmoother:
                 weighted_gaze_dists[gaze_pt] = reduce(lambda (w1, d1), (w2, d2) : (1, (w1 * d1 + w2 * d2)), zipped)[1]
                 gaze_is_fixed = (weighted_gaze_dists[gaze_pt] < fixation_thresh_min_mm)
 
+        self.gaze_is_fixed = gaze_is_fixed
+        self.fixed_frames = self.fixed_frames + 1 if gaze_is_fixed else 0
+        
         # Filter out gaze points that differ wildly from their histories if gaze is fixed
         if gaze_is_fixed:
             return [None if (g is None or weighted_gaze_dists[g] > fixation_thresh_max_mm) else g for g in gaze_pts]
@@ -4,18 +4,21 @@ import image_utils
 import draw_utils
 
 import eye_extractor
-import pre_processing
-import eye_center_locator_combined
 import eyelid_locator 
 import ransac_ellipse
 import gaze_geometry
 import gaze_smoothing
+import gaze_prediction
+import frame_ingest
+import quality_gate
+import frame_scheduler
+import limbus_tracking
+import stage_registry
+import checkpoint_store
+import gabor_filters
 
-from eyelid_locator import find_eyelids
-from find_limbus_points import get_limb_pts
-
-import visualize_in_3d
-from conic_section import Ellipse
+from ransac_stats import RansacStats
+from time import time
 
 import limbus_outlier_removal
 
@@ -41,44 +44,215 @@ cam_mat_n7 = np.array([[1062.348, 0.0     , 344.629],
                        [0.0     , 1065.308, 626.738],
                        [0.0     , 0.0     , 1.0]])
 
+# Per-eye stage settings, GazeSystem(params={...}) overrides any of them
+default_params = {'fast_width_grads': 25.0,         # Width (px) ROIs are shrunk to for the gradient centre map
+                  'fast_width_iso': 80.0,           # and for the isophote centre map
+                  'phi': 20,                        # Limbus rays within phi degrees of vertical are ignored (lids)
+                  'angle_step': 1,                  # Degrees between limbus rays
+                  'ransac_iters_max': 5,
+                  'refine_iters_max': 3,
+                  'max_err': 3}                     # Sampson distance (px) of ellipse inliers
+
+# Checkpointed stages in pipeline order, with the modules whose code each depends on
+checkpoint_stages = [('rois', ['eye_extractor', 'frame_ingest', 'image_utils']),
+                     ('specular', ['pre_processing']),
+                     ('pupil', ['eye_center_locator_combined', 'eye_center_locator_gradients',
+                                'eye_center_locator_isophote', 'fast_kernels']),
+                     ('eyelids', ['eyelid_locator', 'ransac_eyelids', 'gabor_filters', 'fast_kernels']),
+                     ('limbus_pts', ['find_limbus_points', 'linpolar_transform', 'gabor_filters', 'ray_casting',
+                                     'fast_kernels'])]
+
 class GazeSystem:
 
-    def __init__(self, device, debug=False, recording=False, init_vpython=True, filename=None):
+    def __init__(self, device, debug=False, recording=False, init_vpython=True, filename=None, predict_gaze=True,
+                 display=True, gate_quality=True, skip_frames=True, warm_start=True, backends=None, params=None,
+                 checkpoints=None):
 
         self.device = device
         self.cam_mat = device.get_intrisic_cam_params()
         self.dist_coeffs = device.get_dist_coeffs()
         
         self.debug = debug
+        self.display = display
         
         self.recording = False
         if self.recording: self.vid_writer = make_vid_writer_gaze_sys()
         
-        self.visualizer3d = visualize_in_3d.Visualizer3d(win_size=(700, 640),
-                                                         device=device,
-                                                         filename=filename)
+        # VPython is only imported when a 3D visualizer is requested, so headless use never loads it
+        self.visualizer3d = None
+        if init_vpython:
+            import visualize_in_3d
+            self.visualizer3d = visualize_in_3d.Visualizer3d(win_size=(700, 640),
+                                                             device=device,
+                                                             filename=filename)
         
-        self.pre_proc = pre_processing.PreProcessor()
+        # Implementation of each per-eye stage, {stage: backend name} picks faster ones (see stage_registry)
+        self.backends = stage_registry.get_backends(backends)
+        self.backend_names = stage_registry.get_backend_config(backends)
+        self.params = dict(default_params, **(params or {}))
         self.smoother = gaze_smoothing.GazeSmoother(8, gaze_smoothing.TRIANGLE_WEIGHTS)
+        self.outlier_filter = limbus_outlier_removal.LimbusOutlierFilter(device)
+        
+        # With gating off, thresholds of 0 pass everything and closed eyes aren't gated either (blinks are still
+        # detected for the scheduler), but stage timings are still recorded
+        self.gate_quality = gate_quality
+        self.gate = quality_gate.QualityGate() if gate_quality else quality_gate.QualityGate(0, 0, 0, 0)
+        
+        # Frames are decimated during blinks and long fixations, skipped frames repeat the last gaze point
+        self.blink_detector = frame_scheduler.BlinkDetector()
+        self.scheduler = frame_scheduler.FrameScheduler() if skip_frames else frame_scheduler.FrameScheduler(1, 1)
+        self.last_gaze_pt = None
+        
+        # Limbus fits start from the previous frame's ellipse, searching only a narrow band around it
+        self.tracker = limbus_tracking.LimbusTracker(warm_start)
+        
+        self.predict_gaze = predict_gaze
+        
+        # Per-eye validity and overall confidence of latest gaze point, confidence only counts freshly fitted eyes
+        self.eyes_valid = [False, False]
+        self.eyes_reused = [False, False]       # valid eyes standing in with their previous limbus, after being gated
+        self.confidence = 0.0
+        self.predictor = gaze_prediction.GazePredictor()
+        
+        # Undistortion maps are cached here, callers with JPEGs can use it to make lazy frame pyramids
+        self.ingest = frame_ingest.FrameIngest(device.rot90s, cam_mat_n7, dist_coefs_n7)
+        
+        # Optional checkpoint_store.CheckpointStore, stage outputs found there for a frame are not recomputed
+        self.checkpoints = checkpoints
+        self.frame_index = -1               # of latest call to get_gaze_from_frame, skipped frames included
+        self.checkpoint_saved_ms = 0.0      # compute time of stages read back, less the time spent reading them
+        if checkpoints is not None: self.open_checkpoints()
+        
+    def open_checkpoints(self):
+        
+        """ Keys each stage's checkpoints on its settings, backend and code, and on the stages before it
+        """
+        
+        stage_params = {'rois': {'recording': self.checkpoints.recording,
+                                 'angles_to_try': eye_extractor.angles_to_try,
+                                 'eye_part_ratios': eye_extractor.eye_part_ratios,
+                                 'rot90s': self.ingest.rot90s, 'cam_mat': self.ingest.cam_mat,
+                                 'dist_coeffs': self.ingest.dist_coeffs},
+                        'pupil': {'fast_width_grads': self.params['fast_width_grads'],
+                                  'fast_width_iso': self.params['fast_width_iso']},
+                        'eyelids': {'gabor_methods': sorted(gabor_filters.gabor_bank.methods.items())},
+                        'limbus_pts': {'phi': self.params['phi'], 'angle_step': self.params['angle_step'],
+                                       'gabor_methods': sorted(gabor_filters.gabor_bank.methods.items())}}
+        
+        upstream = {'specular': 'rois', 'pupil': 'specular', 'eyelids': 'pupil', 'limbus_pts': 'pupil'}
+        for stage, modules in checkpoint_stages:
+            params = dict(stage_params.get(stage, {}), backend=self.backend_names.get(stage))
+            self.checkpoints.open_stage(stage, params, modules, upstream.get(stage))
+    
+    def run_checkpointed(self, stage, part, compute):
+        
+        """ Record ~ {name: value} of stage for this frame, from its checkpoint if there is one, else compute()
+        
+        Records keep their compute time as 'ms', so reruns can tell what a cold run would have cost
+        """
+        
+        if self.checkpoints is None: return compute()
+        
+        checkpoint = self.checkpoints.stages[stage]
+        tick = time()
+        record = checkpoint.get(self.frame_index, part)
+        if record is None:
+            tick = time()
+            record = compute()
+            record['ms'] = (time() - tick) * 1000
+            checkpoint.put(self.frame_index, record, part)
+        elif record.get('ms') is not None:
+            self.checkpoint_saved_ms += float(record['ms']) - (time() - tick) * 1000
+        return record
+    
+    def find_eye_rois(self, frame_pyr):
+        
+        if frame_pyr is None: raise checkpoint_store.CheckpointMiss('No eye ROIs for frame %d' % self.frame_index)
+        
+        try:
+            eye_rois = eye_extractor.get_eye_rois(frame_pyr, 4, debug=self.debug, device=self.device)
+        except eye_extractor.NoEyesFound as e:
+            return {'found': False, 'msg': e.msg}
+        
+        record = {'found': True}
+        for i, eye_roi in enumerate(eye_rois):
+            record['pos_%d' % i], record['img_%d' % i] = (eye_roi.roi_x0, eye_roi.roi_y0), eye_roi.img
+        return record
+    
+    def find_pupil(self, eye_roi, full_frame, debug_index):
+        
+        """ Pupil (x0, y0, confidence), and the ROI re-centred on it (refined ROI only used past the pupil gate)
+        """
+        
+        if full_frame is None: raise checkpoint_store.CheckpointMiss('No pupil for frame %d' % self.frame_index)
+        
+        pupil = self.backends['pupil'](eye_roi.img,
+                                       fast_width_grads=self.params['fast_width_grads'],
+                                       fast_width_iso=self.params['fast_width_iso'],
+                                       debug_index=debug_index)
+        
+        refined_roi = eye_extractor.EyeRoi((eye_roi.roi_x0, eye_roi.roi_y0), eye_roi.img)
+        refined_roi.refine_pupil(pupil[:2], full_frame)
+        return {'pupil': pupil, 'img': refined_roi.img,
+                'roi': (refined_roi.roi_x0, refined_roi.roi_y0, refined_roi.roi_w, refined_roi.roi_h)}
+    
+    def find_limb_pts(self, eye_index, eye_img, debug_index=False, r_range=None):
+        
+        """ Limbus points of full polar band, or of narrowed band r_range. Both are checkpointed, under different parts
+        """
+        
+        part = ('e%d' % eye_index) if r_range is None else ('e%d_r%d_%d' % (eye_index, r_range[0], r_range[1]))
+        compute = lambda: {'pts': self.backends['limbus_pts'](eye_img=eye_img,
+                                                             phi=self.params['phi'],
+                                                             angle_step=self.params['angle_step'],
+                                                             debug_index=debug_index,
+                                                             r_range=r_range)}
+        return self.run_checkpointed('limbus_pts', part, compute)['pts']
         
     def activate_marker(self, marker_index):
-        self.visualizer3d.activate_marker(marker_index)
+        if self.visualizer3d is not None:
+            self.visualizer3d.activate_marker(marker_index)
+
+    def update_latency(self, latency_s):
+        self.predictor.update_latency(latency_s)
 
-    def get_gaze_from_frame(self, frame):
+    def get_gaze_from_frame(self, frame, capture_time=None):
+        
+        """ Takes a rotated BGR frame, or a frame_ingest.FramePyramid which only decodes levels as they are used
         
-        frame = cv2.undistort(frame, cam_mat_n7, dist_coefs_n7)
+        With checkpoints, frame may be None to rerun from them alone (nothing is drawn), CheckpointMiss is raised
+        if a stage needing the frame is missing
+        """
         
-        frame_pyr = image_utils.make_gauss_pyr(frame, 4)
-        full_frame = frame_pyr[1].copy()
-        half_frame = frame_pyr[2].copy()
+        # Skipped frames are never decoded or undistorted. Only processed frames start decimation, so a gaze point exists
+        self.frame_index += 1
+        if not self.scheduler.should_process(): return self.last_gaze_pt
+        self.blink_detector.new_frame()
+        
+        if frame is None:
+            frame_pyr = None
+        elif isinstance(frame, frame_ingest.FramePyramid):
+            frame_pyr = frame
+        else:
+            frame_pyr = image_utils.make_gauss_pyr(self.ingest.undistort(frame), 4)
+        
+        # Only shown or recorded, headless runs don't draw on it
+        half_frame = frame_pyr[2].copy() if frame_pyr is not None and (self.display or self.recording) else None
+        full_frame = None
         
         limbuses = [None, None]
-        gaze_pts_mm = [None, None]
         gaze_pts_px = [None, None]
+        self.eyes_reused = [False, False]
+        eye_rois_found = [False, False]
         
         try:
             sub_img_cx0, sub_img_cy0 = None, None
-            eye_r_roi, eye_l_roi = eye_extractor.get_eye_rois(frame_pyr, 4, debug=self.debug, device=self.device)
+            record = self.run_checkpointed('rois', '', lambda: self.find_eye_rois(frame_pyr))
+            if not record['found']: raise eye_extractor.NoEyesFound(str(record['msg']))
+            
+            eye_r_roi, eye_l_roi = [eye_extractor.EyeRoi(record['pos_%d' % i], record['img_%d' % i]) for i in range(2)]
+            eye_rois_found = [eye_r_roi.img is not None, eye_l_roi.img is not None]
+            if frame_pyr is not None: full_frame = frame_pyr[1].copy()
             
             for i, eye_roi in enumerate([eye_r_roi, eye_l_roi]):
                 
@@ -88,37 +262,78 @@ class GazeSystem:
                     # Gives unique winnames for each ROI
                     debug_index = ((i + 1) if self.debug else False)  
             
-                    eye_roi.img = self.pre_proc.erase_specular(eye_roi.img, debug=debug_index)
+                    # Closed eyes are also blurry, so check for them first for the scheduler to see blinks
+                    self.gate.start_eye()
+                    eye_closed = self.blink_detector.is_closed(i, eye_roi.img)
+                    if self.gate_quality: self.gate.check_open(eye_closed)
+                    
+                    record = self.run_checkpointed('specular', 'e%d' % i, lambda: {
+                        'img': self.backends['specular'](eye_roi.img, debug=debug_index)})
+                    eye_roi.img = record['img']
+                    self.gate.check_blur(eye_roi.img)
             
-                    pupil_x0, pupil_y0 = eye_center_locator_combined.find_pupil(eye_roi.img,
-                                                                                fast_width_grads=25.0,
-                                                                                fast_width_iso=80.0,
-                                                                                weight_grads=0.8,
-                                                                                weight_iso=0.2,
-                                                                                debug_index=debug_index)
-                    eye_roi.refine_pupil((pupil_x0, pupil_y0), full_frame)
+                    self.gate.start('pupil')
+                    record = self.run_checkpointed('pupil', 'e%d' % i,
+                                                   lambda: self.find_pupil(eye_roi, full_frame, debug_index))
+                    self.gate.stop()
+                    eye_roi.pupil_conf = self.gate.check_pupil_conf(record['pupil'][2])
+                    
+                    eye_roi.roi_x0, eye_roi.roi_y0, eye_roi.roi_w, eye_roi.roi_h = map(int, record['roi'])
+                    eye_roi.img = record['img']
                     roi_x0, roi_y0, roi_w, roi_h = eye_roi.roi_x0, eye_roi.roi_y0, eye_roi.roi_w, eye_roi.roi_h
                     
-                    u_eyelid, l_eyelid = find_eyelids(eye_roi.img, debug_index)
+                    self.gate.start('eyelids')
+                    record = self.run_checkpointed('eyelids', 'e%d' % i, lambda: dict(
+                        zip(['upper', 'lower'], self.backends['eyelids'](eye_roi.img, debug_index))))
+                    u_eyelid, l_eyelid = record['upper'], record['lower']
+                    self.gate.stop()
+                    eye_closed = self.blink_detector.eyelids_closed(i, u_eyelid, l_eyelid, eye_roi.img)
+                    if self.gate_quality: self.gate.check_open(eye_closed, 'limbus_pts')
+                    
+                    # Last frame's ellipse (if any) narrows the search to a band around it
+                    prior = self.tracker.get_prior(i, (roi_x0, roi_y0))
                     
-                    pts_found = get_limb_pts(eye_img=eye_roi.img,
-                                             phi=20,
-                                             angle_step=1,
-                                             debug_index=debug_index)
+                    self.gate.start('limbus_pts')
+                    pts_found = self.find_limb_pts(i, eye_roi.img, debug_index, self.tracker.get_r_range(prior, eye_roi.img))
                     pts_found = eyelid_locator.filter_limbus_pts(u_eyelid, l_eyelid, pts_found)
+                    self.gate.stop()
+                    self.gate.check_limbus_pts(pts_found)
                     
-                    ellipse = ransac_ellipse.ransac_ellipse_fit(points=pts_found,
-                                                                bgr_img=eye_roi.img,
-                                                                roi_pos=(roi_x0, roi_y0),
-                                                                ransac_iters_max=5,
-                                                                refine_iters_max=3,
-                                                                max_err=1,
-                                                                debug=False)
+                    self.gate.start('ellipse')
+                    try:
+                        ransac_stats = RansacStats(sample_size=6, iters_max=self.params['ransac_iters_max'])
+                        ellipse, fell_back = None, False
+                        
+                        # Prediction is refined in place of RANSAC while it keeps its support & coverage
+                        if prior is not None:
+                            ellipse = ransac_ellipse.fit_from_prior(prior, pts_found, eye_roi.img,
+                                                                    refine_iters_max=self.params['refine_iters_max'],
+                                                                    max_err=self.params['max_err'])
+                            
+                            # Narrow band only held points near the prediction, so search the full band again
+                            fell_back = ellipse is None
+                            if fell_back:
+                                pts_found = self.find_limb_pts(i, eye_roi.img)
+                                pts_found = eyelid_locator.filter_limbus_pts(u_eyelid, l_eyelid, pts_found)
+                        
+                        warm = ellipse is not None
+                        if not warm:
+                            ellipse = self.backends['ellipse'](points=pts_found,
+                                                               bgr_img=eye_roi.img,
+                                                               roi_pos=(roi_x0, roi_y0),
+                                                               ransac_iters_max=self.params['ransac_iters_max'],
+                                                               refine_iters_max=self.params['refine_iters_max'],
+                                                               max_err=self.params['max_err'],
+                                                               debug=False,
+                                                               stats=ransac_stats)
+                        self.tracker.record_fit(ransac_stats, warm, fell_back)
+                    finally:
+                        self.gate.stop()
                     
                     # Shift 2D limbus ellipse and points to account for eye ROI coords
-                    (ell_x0, ell_y0), (ell_w, ell_h), angle = ellipse.rotated_rect               
-                    new_rotated_rect = (roi_x0 + ell_x0, roi_y0 + ell_y0), (ell_w, ell_h), angle
-                    ellipse = Ellipse(new_rotated_rect)                                                                                
+                    (ell_x0, ell_y0) = ellipse.rotated_rect[0]
+                    ellipse = ellipse.shifted(roi_x0, roi_y0)
+                    self.tracker.update(i, ellipse, warm)
                     pts_found_to_draw = [(px + roi_x0, py + roi_y0) for (px, py) in pts_found]
                     
                     # Correct coords when extracting eye for half-frame
@@ -127,64 +342,96 @@ class GazeSystem:
                     # Ignore incorrect limbus
                     limbus = gaze_geometry.ellipse_to_limbuses_persp_geom(ellipse, self.device)
                     limbuses[i] = limbus
+                    self.gate.update_limbus(i, limbus)
+                    
+                    # Draw eye features onto debug image, unless rerunning from checkpoints without frames
+                    if full_frame is not None:
+                        draw_utils.draw_limbus(full_frame, limbus, color=debug_colors[i], scale=1)
+                        draw_utils.draw_points(full_frame, pts_found_to_draw, color=debug_colors[i], width=1, thickness=2)
+                        draw_utils.draw_normal(full_frame, limbus, self.device, color=debug_colors[i], scale=1)
+                        if half_frame is not None:
+                            draw_utils.draw_normal(half_frame, limbus, self.device, color=debug_colors[i], scale=0.5,
+                                                   arrow_len_mm=20)
+                        eye_img = full_frame[eye_roi.roi_y0:(eye_roi.roi_y0 + eye_roi.roi_h),
+                                             eye_roi.roi_x0:(eye_roi.roi_x0 + eye_roi.roi_w)]
+                        draw_utils.draw_eyelids(u_eyelid, l_eyelid, eye_img)
                     
-                    # Draw eye features onto debug image
-                    draw_utils.draw_limbus(full_frame, limbus, color=debug_colors[i], scale=1)
-                    draw_utils.draw_points(full_frame, pts_found_to_draw, color=debug_colors[i], width=1, thickness=2)
-                    draw_utils.draw_normal(full_frame, limbus, self.device, color=debug_colors[i], scale=1)
-                    draw_utils.draw_normal(half_frame, limbus, self.device, color=debug_colors[i], scale=0.5, arrow_len_mm=20)
-                    eye_img = full_frame[eye_roi.roi_y0:(eye_roi.roi_y0 + eye_roi.roi_h),
-                                         eye_roi.roi_x0:(eye_roi.roi_x0 + eye_roi.roi_w)]
-                    draw_utils.draw_eyelids(u_eyelid, l_eyelid, eye_img)
+                except quality_gate.LowQuality as e:
+                    if self.debug: print 'Eye Gated : %s' % e.msg
+                    limbuses[i] = self.gate.get_fallback_limbus(i)
+                    self.eyes_reused[i] = limbuses[i] is not None
+                    if full_frame is not None:
+                        cv2.rectangle(full_frame, (eye_roi.roi_x0, eye_roi.roi_y0),
+                                      (eye_roi.roi_x0 + eye_roi.roi_w, eye_roi.roi_y0 + eye_roi.roi_h), (0, 128, 255),
+                                      thickness=4)
                     
                 except ransac_ellipse.NoEllipseFound:
                     if self.debug: print 'No Ellipse Found'
-                    cv2.rectangle(full_frame, (roi_x0, roi_y0), (roi_x0 + roi_w, roi_y0 + roi_h), (0, 0, 255), thickness=4)
+                    self.tracker.update(i, None)
+                    if full_frame is not None: cv2.rectangle(full_frame, (roi_x0, roi_y0), (roi_x0 + roi_w, roi_y0 + roi_h), (0, 0, 255), thickness=4)
                     
                 except ransac_ellipse.CoverageTooLow as e:
                     if self.debug: print 'Ellipse Coverage Too Low : %s' % e.msg
-                    cv2.rectangle(full_frame, (roi_x0, roi_y0), (roi_x0 + roi_w, roi_y0 + roi_h), (0, 0, 255), thickness=4)
+                    self.tracker.update(i, None)
+                    if full_frame is not None: cv2.rectangle(full_frame, (roi_x0, roi_y0), (roi_x0 + roi_w, roi_y0 + roi_h), (0, 0, 255), thickness=4)
                     
                 finally:
                     
-                    # Extract only eye_roi block after other drawing methods
-                    if sub_img_cx0 is not None: 
-                        eye_img = full_frame[sub_img_cy0 - 60:sub_img_cy0 + 60,
-                                             sub_img_cx0 - 60:sub_img_cx0 + 60]
-                    else:
-                        eye_img = full_frame[eye_roi.roi_y0:(eye_roi.roi_y0 + eye_roi.roi_h),
-                                             eye_roi.roi_x0:(eye_roi.roi_x0 + eye_roi.roi_w)]
-                    
-                    # Transfer eye_img block to section of half_frame
-                    half_frame[half_frame.shape[0] - eye_img.shape[0]:half_frame.shape[0],
-                               (half_frame.shape[1] - eye_img.shape[1]) * i: half_frame.shape[1] if i else eye_img.shape[1]] = eye_img
+                    # Extract only eye_roi block after other drawing methods (there are none without frames)
+                    if full_frame is not None and half_frame is not None:
+                        if sub_img_cx0 is not None: 
+                            eye_img = full_frame[sub_img_cy0 - 60:sub_img_cy0 + 60,
+                                                 sub_img_cx0 - 60:sub_img_cx0 + 60]
+                        else:
+                            eye_img = full_frame[eye_roi.roi_y0:(eye_roi.roi_y0 + eye_roi.roi_h),
+                                                 eye_roi.roi_x0:(eye_roi.roi_x0 + eye_roi.roi_w)]
+                        
+                        # Transfer eye_img block to section of half_frame
+                        half_frame[half_frame.shape[0] - eye_img.shape[0]:half_frame.shape[0],
+                                   (half_frame.shape[1] - eye_img.shape[1]) * i: half_frame.shape[1] if i else eye_img.shape[1]] = eye_img
                                
         except eye_extractor.NoEyesFound as e:
             if self.debug: print 'No Eyes Found: %s' % e.msg
             
-        # Remove any extreme outliers
-        limbuses = limbus_outlier_removal.remove_outliers(limbuses)
+        # Remove any extreme outliers, getting gaze points of remaining limbuses
+        limbuses, gaze_pts_mm = self.outlier_filter.remove_outliers(limbuses)
+        self.eyes_valid = [limbus is not None for limbus in limbuses]
+        self.eyes_reused = [valid and reused for (valid, reused) in zip(self.eyes_valid, self.eyes_reused)]
+        
+        # Reused limbuses are last frame's, they keep gaze going but don't count towards confidence
+        eyes_fresh = [valid and not reused for (valid, reused) in zip(self.eyes_valid, self.eyes_reused)]
+        self.confidence = sum(eyes_fresh) / 2.0
         
-        # Get gaze points
         for i, limbus in enumerate(limbuses):
             if limbus is None: continue
-            gaze_pts_mm[i] = gaze_geometry.get_gaze_point_mm(limbus)
             gaze_pts_px[i] = gaze_geometry.convert_gaze_pt_mm_to_px(gaze_pts_mm[i], self.device)
         
         smoothed_gaze_pt_mm = self.smoother.smooth_gaze(gaze_pts_mm)
+        
+        # Blink only if every eye found was closed, with no eyes found there is nothing to decimate for
+        eyes_closed = [closed for (closed, roi_found) in zip(self.blink_detector.eyes_closed, eye_rois_found) if roi_found]
+        self.scheduler.update(len(eyes_closed) > 0 and all(eyes_closed), self.smoother.fixed_frames)
         smoothed_gaze_pt_px = gaze_geometry.convert_gaze_pt_mm_to_px(smoothed_gaze_pt_mm, self.device)
         
+        # Extrapolate smoothed gaze to compensate for pipeline latency
+        predicted_gaze_pt_mm = self.predictor.predict_gaze(smoothed_gaze_pt_mm, capture_time)
+        predicted_gaze_pt_px = gaze_geometry.convert_gaze_pt_mm_to_px(predicted_gaze_pt_mm, self.device)
+        
         # Visualize in 2D and 3D
-        cv2.imshow('gaze system', half_frame)
-        self.visualizer3d.update_vis(limbuses, smoothed_gaze_pt_mm)
+        if self.display and half_frame is not None:
+            cv2.imshow('gaze system', half_frame)
+        if self.visualizer3d is not None:
+            self.visualizer3d.update_vis(limbuses, smoothed_gaze_pt_mm,
+                                         predicted_gaze_pt_mm if self.predict_gaze else None)
         
         # If recording, take a screenshot of vpython and add to vid. capture
-        if self.recording:
+        if self.recording and self.visualizer3d is not None and half_frame is not None:
             vis_screen = self.visualizer3d.take_screenshot()
             stacked_imgs = image_utils.stack_imgs_horizontal([vis_screen, half_frame])
             self.vid_writer.write(stacked_imgs)
             
-        return smoothed_gaze_pt_px
+        self.last_gaze_pt = predicted_gaze_pt_px if self.predict_gaze else smoothed_gaze_pt_px
+        return self.last_gaze_pt
     
 
 #----------------------------------------
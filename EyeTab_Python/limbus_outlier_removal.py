@@ -1,50 +1,103 @@
 import gaze_geometry
 import math
+import numpy as np
 
-# Screen size constants
-screen_w_mm_n7, screen_h_mm_n7 = 94, 151
-screen_w_px_n7, screen_h_px_n7 = 800, 1280
+max_limb_dist_mm = 80                   # Maximum plausible distance between limbuses (pupillary distance)
 
-__last_pos = [0, 0, 0]
+class LimbusOutlierFilter:
+
+    def __init__(self, device):
+
+        self.screen_w_mm, self.screen_h_mm = device.screen_size_mm
+        self.last_pos = [0, 0, 0]       # Last accepted mid-point between both limbuses
+
+    def gaze_pt_in_range(self, gaze_pts_mm_x, gaze_pts_mm_y):
+
+        """ Works on scalars or Numpy arrays of gaze point coords
+        """
+
+        return ((-self.screen_w_mm <= gaze_pts_mm_x) & (gaze_pts_mm_x <= self.screen_w_mm) &
+                (-self.screen_h_mm * 3 / 2 <= gaze_pts_mm_y) & (gaze_pts_mm_y <= 0))
+
+    def remove_outliers(self, limbuses):
+
+        """ Returns limbuses with outliers set to None, and gaze points (mm) of the limbuses kept
+        """
+
+        limbuses_to_return = [limbuses[0], limbuses[1]]
+        gaze_pts_mm = [None, None]
+
+        for i, limbus in enumerate(limbuses):
+
+            # Remove limbuses that point widly out of frame
+            if limbus is None:
+                limbuses_to_return[i] = None
+                continue
+
+            gaze_pts_mm_x, gaze_pts_mm_y = gaze_geometry.get_gaze_point_mm(limbus)
+            if not self.gaze_pt_in_range(gaze_pts_mm_x, gaze_pts_mm_y):
+                limbuses_to_return[i] = None
+                continue
+            else:
+                limbuses_to_return[i] = limbus
+                gaze_pts_mm[i] = gaze_pts_mm_x, gaze_pts_mm_y
+
+        # Remove limbuses that are too far from eachother (Pupilary Distance)
+        if limbuses_to_return[0] is not None and limbuses_to_return[1] is not None:
+
+            l1x, l1y, l1z = limbuses_to_return[0].center_mm
+            l2x, l2y, l2z = limbuses_to_return[1].center_mm
+            limb_dist = math.sqrt((l1x - l2x) ** 2 + (l1y - l2y) ** 2 + (l1z - l2z) ** 2)
+
+            last_x, last_y, last_z = self.last_pos
+
+            if limb_dist > max_limb_dist_mm:
+                dist_1 = (last_x - l1x) ** 2 + (last_y - l1y) ** 2 + (last_z - l1z) ** 2
+                dist_2 = (last_x - l2x) ** 2 + (last_y - l2y) ** 2 + (last_z - l2z) ** 2
+                i_to_remove = 1 if dist_1 < dist_2 else 0
+                limbuses_to_return[i_to_remove], gaze_pts_mm[i_to_remove] = None, None
+
+            else: self.last_pos = [(l1x + l2x) / 2, (l1y + l2y) / 2, (l1z + l2z) / 2]
+
+        return limbuses_to_return, gaze_pts_mm
+
+    def remove_outliers_arrays(self, centres_mm, normals, valid=None):
+
+        """ Vectorized remove_outliers for a whole recorded session
+
+        centres_mm, normals ~ (N, 2, 3) arrays, for each frame and eye
+        valid ~ (N, 2) bool array of limbuses found, defaults to all
+
+        Returns (N, 2) bool array of limbuses kept and their (N, 2, 2) gaze points (mm)
+        """
+
+        centres_mm, normals = np.asarray(centres_mm, dtype=float), np.asarray(normals, dtype=float)
+        valid = np.ones(centres_mm.shape[:2], dtype=bool) if valid is None else np.array(valid, dtype=bool)
 
-def remove_outliers(limbuses):
-    
-    limbuses_to_return = [limbuses[0], limbuses[1]]
-    
-    for i, limbus in enumerate(limbuses):
-        
         # Remove limbuses that point widly out of frame
-        if limbus is None:
-            limbuses_to_return[i] = None
-            continue
-        
-        gaze_pts_mm_x, gaze_pts_mm_y = gaze_geometry.get_gaze_point_mm(limbus)
-        if gaze_pts_mm_x < -screen_w_mm_n7 or gaze_pts_mm_x > screen_w_mm_n7:
-            limbuses_to_return[i] = None
-            continue
-        elif gaze_pts_mm_y < (-screen_h_mm_n7 * 3 / 2) or (gaze_pts_mm_y > 0):
-            limbuses_to_return[i] = None
-            continue
-        else: limbuses_to_return[i] = limbus
-    
-        
-    # Remove limbuses that are too far from eachother (Pupilary Distance)
-    if limbuses_to_return[0] is not None and limbuses_to_return[1] is not None:
-        
-        l1x, l1y, l1z = limbuses_to_return[0].center_mm
-        l2x, l2y, l2z = limbuses_to_return[1].center_mm
-        limb_dist = math.sqrt((l1x - l2x) ** 2 + (l1y - l2y) ** 2 + (l1z - l2z) ** 2)
-        
-        last_x, last_y, last_z = __last_pos
-
-        if limb_dist > 80:
-            dist_1 = (last_x - l1x) ** 2 + (last_y - l1y) ** 2 + (last_z - l1z) ** 2
-            dist_2 = (last_x - l2x) ** 2 + (last_y - l2y) ** 2 + (last_z - l2z) ** 2
-            if dist_1 < dist_2:
-                limbuses_to_return[1] = None
-            else : limbuses_to_return[0] = None
-            
-        else: __last_pos[0], __last_pos[1], __last_pos[2] = (l1x + l2x) / 2, (l1y + l2y) / 2, (l1z + l2z) / 2
-    
-    return limbuses_to_return
+        with np.errstate(divide='ignore', invalid='ignore'):
+            gaze_pts_mm = gaze_geometry.get_gaze_points_mm(centres_mm, normals)
+            valid &= self.gaze_pt_in_range(gaze_pts_mm[..., 0], gaze_pts_mm[..., 1])
+
+        # Pairs which pass the pupillary distance test update the last position for later frames
+        both_valid = valid[:, 0] & valid[:, 1]
+        limb_dists = np.sqrt(np.sum((centres_mm[:, 0] - centres_mm[:, 1]) ** 2, axis=1))
+        pairs_ok = both_valid & (limb_dists <= max_limb_dist_mm)
+        mid_pts = (centres_mm[:, 0] + centres_mm[:, 1]) / 2
+
+        # Index of latest accepted pair strictly before each frame (-1 if none)
+        ok_inds = np.maximum.accumulate(np.where(pairs_ok, np.arange(len(pairs_ok)), -1))
+        prev_ok_inds = np.concatenate([[-1], ok_inds[:-1]])
+        last_pos = np.where((prev_ok_inds >= 0)[:, np.newaxis], mid_pts[prev_ok_inds], self.last_pos)
+
+        # Where too far apart, remove whichever limbus is further from last position
+        too_far = both_valid & ~pairs_ok
+        dists_1 = np.sum((last_pos - centres_mm[:, 0]) ** 2, axis=1)
+        dists_2 = np.sum((last_pos - centres_mm[:, 1]) ** 2, axis=1)
+        valid[too_far & (dists_1 < dists_2), 1] = False
+        valid[too_far & ~(dists_1 < dists_2), 0] = False
+
+        if len(ok_inds) > 0 and ok_inds[-1] >= 0:
+            self.last_pos = list(mid_pts[ok_inds[-1]])
 
+        return valid, gaze_pts_mm
@@ -0,0 +1,138 @@
+import numpy as np
+
+from find_limbus_points import get_limb_r_range
+
+band_margin = 15                # Polar px (of 400) searched either side of predicted limbus, ~4 px in a typical ROI
+max_warm_frames = 30            # Full search is forced after this many warm-started frames in a row, to catch drift
+
+
+class LimbusTracker:
+
+    def __init__(self, enabled=True, band_margin=band_margin, max_warm_frames=max_warm_frames):
+
+        """ Keeps each eye's last limbus ellipse (full-frame coords) so the next frame's fit can start from it
+
+        Records RANSAC iterations for every fit, warm-started fits use none
+        """
+
+        self.enabled = enabled
+        self.band_margin = band_margin
+        self.max_warm_frames = max_warm_frames
+
+        self.last_ellipses = [None, None]
+        self.warm_frames = [0, 0]
+
+        self.fits = 0
+        self.warm_fits = 0
+        self.fallbacks = 0          # predictions that lost support, so full RANSAC ran after all
+        self.ransac_iters = []      # per fit, 0 for warm-started ones
+
+    def get_prior(self, eye_index, (roi_x0, roi_y0)):
+
+        """ Last ellipse of eye in ROI coords, or None if there is none to start from
+        """
+
+        ellipse = self.last_ellipses[eye_index]
+        if not self.enabled or ellipse is None or self.warm_frames[eye_index] >= self.max_warm_frames: return None
+
+        return ellipse.shifted(-roi_x0, -roi_y0)
+
+    def get_r_range(self, prior, eye_img):
+
+        if prior is None: return None
+        return get_limb_r_range(prior, eye_img.shape, self.band_margin)
+
+    def record_fit(self, stats, warm, fell_back=False):
+
+        self.fits += 1
+        self.warm_fits += warm
+        self.fallbacks += fell_back
+        self.ransac_iters.append(0 if warm else stats.iters)
+
+    def update(self, eye_index, ellipse, warm=False):
+
+        """ ellipse - in full-frame coords, or None when eye was lost and next fit must start from scratch
+        """
+
+        self.last_ellipses[eye_index] = ellipse
+        self.warm_frames[eye_index] = self.warm_frames[eye_index] + 1 if (warm and ellipse is not None) else 0
+
+    def get_summary(self):
+
+        mean_iters = np.mean(self.ransac_iters) if self.ransac_iters else 0
+        return '%d fits, %d warm-started, %d fell back, %0.2f RANSAC iters per fit' % (self.fits, self.warm_fits,
+                                                                                       self.fallbacks, mean_iters)
+
+
+#----------------------------------------
+# EXAMPLE USAGE
+#----------------------------------------
+if __name__ == '__main__':
+
+    import cv2
+    import glob
+    import random
+    import ransac_ellipse
+    from find_limbus_points import get_limb_pts
+    from ransac_stats import RansacStats
+    from time import time
+
+    eye_imgs = []
+    for path in sorted(glob.glob('eye_images/*.png')):
+        eye_img = cv2.imread(path)
+        img_h, img_w = eye_img.shape[:2]
+        eye_imgs.append(np.ascontiguousarray(eye_img[:, (img_w - img_h) / 2:(img_w + img_h) / 2]))
+
+    # Steady tracking: each eye image is a short sequence, jittering by a few px per frame as the ROI would
+    num_frames = 10
+    random.seed(0)
+    sequences = []
+    for eye_img in eye_imgs:
+        shifts = [(random.randint(-2, 2), random.randint(-2, 2)) for _ in range(num_frames)]
+        sequences.append([cv2.warpAffine(eye_img, np.float32([[1, 0, dx], [0, 1, dy]]), eye_img.shape[1::-1],
+                                         borderMode=cv2.BORDER_REPLICATE) for (dx, dy) in shifts])
+
+    def track(tracker):
+
+        centres = []
+        for frames in sequences:
+            tracker.update(0, None)
+            for frame in frames:
+                prior = tracker.get_prior(0, (0, 0))
+                stats = RansacStats(sample_size=6, iters_max=5)
+                ellipse, fell_back = None, False
+                try:
+                    pts = get_limb_pts(frame, phi=20, angle_step=1, r_range=tracker.get_r_range(prior, frame))
+                    if prior is not None:
+                        ellipse = ransac_ellipse.fit_from_prior(prior, pts, frame, refine_iters_max=3, max_err=3)
+                        fell_back = ellipse is None
+                        if fell_back: pts = get_limb_pts(frame, phi=20, angle_step=1)
+                    warm = ellipse is not None
+                    if not warm:
+                        ellipse = ransac_ellipse.ransac_ellipse_fit(pts, frame, (0, 0), 5, 3, 3, stats=stats)
+                    tracker.record_fit(stats, warm, fell_back)
+                    tracker.update(0, ellipse, warm)
+                    centres.append(ellipse.rotated_rect[0])
+                except (ransac_ellipse.NoEllipseFound, ransac_ellipse.CoverageTooLow):
+                    tracker.update(0, None)
+                    centres.append(None)
+        return centres
+
+    results = {}
+    for enabled in [False, True]:
+        random.seed(0)
+        tracker = LimbusTracker(enabled)
+        tick = time()
+        results[enabled] = track(tracker)
+        ms = (time() - tick) * 1000 / (len(sequences) * num_frames)
+        print '%s: %0.2f ms per frame, %s' % ('Warm-started' if enabled else 'Cold', ms, tracker.get_summary())
+
+    # Cold fits with another seed, for how much RANSAC alone varies
+    random.seed(1)
+    results['reseeded'] = track(LimbusTracker(False))
+
+    for name, key in [('warm', True), ('cold, reseeded', 'reseeded')]:
+        dists = [np.sqrt((c1[0] - c2[0]) ** 2 + (c1[1] - c2[1]) ** 2) for (c1, c2) in zip(results[False], results[key])
+                 if c1 and c2]
+        print 'Limbus centre, %s vs cold (px) - median: %0.2f, 90th percentile: %0.2f' % (name, np.median(dists),
+                                                                                         np.percentile(dists, 90))
@@ -1,4 +1,5 @@
 import numpy as np
+import fast_kernels
 
 from math import ceil, pi, cos, sin
 
@@ -24,6 +25,34 @@ along with PLPTR. If not, see <http://www.gnu.org/licenses/>.
 
 _transforms = {}
 
+def _build_transform_reference(i_0, j_0, i_n, j_n, p_n, t_n, t_s):
+    
+    # Reference version of fast_kernels.linpolar_table.
+    i_k = []
+    j_k = []
+    p_k = []
+    t_k = []
+
+    # Scans the transform across its coordinate axes. At each step
+    # calculates the reverse transform back into the cartesian coordinate
+    # system, and if the coordinates fall within the boundaries of the
+    # input image, records both coordinate sets.
+    for p in range(0, p_n):
+        for t in range(0, t_n):
+            t_rad = t * t_s
+
+            i = int(i_0 + p * sin(t_rad))
+            j = int(j_0 + p * cos(t_rad))
+
+            if 0 <= i < i_n and 0 <= j < j_n:
+                i_k.append(i)
+                j_k.append(j)
+                p_k.append(p)
+                t_k.append(t)
+
+    return np.array(p_k), np.array(t_k), np.array(i_k), np.array(j_k)
+
+
 def _get_transform(i_0, j_0, i_n, j_n, p_n, t_n, p_s, t_s):
     
     # Checks if this transform has been requested before.
@@ -31,31 +60,11 @@ def _get_transform(i_0, j_0, i_n, j_n, p_n, t_n, p_s, t_s):
 
     # If the transform is not found...
     if transform == None:
-        i_k = []
-        j_k = []
-        p_k = []
-        t_k = []
-
-        # Scans the transform across its coordinate axes. At each step
-        # calculates the reverse transform back into the cartesian coordinate
-        # system, and if the coordinates fall within the boundaries of the
-        # input image, records both coordinate sets.
-        for p in range(0, p_n):
-            for t in range(0, t_n):
-                t_rad = t * t_s
-
-                i = int(i_0 + p * sin(t_rad))
-                j = int(j_0 + p * cos(t_rad))
-
-                if 0 <= i < i_n and 0 <= j < j_n:
-                    i_k.append(i)
-                    j_k.append(j)
-                    p_k.append(p)
-                    t_k.append(t)
+        p_k, t_k, i_k, j_k = fast_kernels.linpolar_table(i_0, j_0, i_n, j_n, p_n, t_n, t_s)
 
         # Creates a set of two "fancy-indices", one for retrieving pixels from
         # the input image, and other for assigning them to the transform.
-        transform = ((np.array(p_k), np.array(t_k)), (np.array(i_k), np.array(j_k)))
+        transform = ((p_k, t_k), (i_k, j_k))
         _transforms[i_0, j_0, i_n, j_n, p_n, t_n] = transform
 
     return transform
@@ -3,17 +3,24 @@ import numpy as np
 import os
 import socket
 import gaze_system as gaze_system
+import gaze_protocol
 import device_constants
+import checkpoint_store
+
+from markers import marker_flags_ms
+from mjpeg_reader import MjpegReader
 
 from datetime import datetime
+from time import time
 
 host = '192.168.137.195'
 camera_stream_port = 8080
 device_control_port = 9999
 
-# Dummy parameter '?dummy=video.mjpg' is used to trick OpenCV into opening stream
-# see: http://stackoverflow.com/q/14204185/2023516
-mjpg_stream_url = 'http://%s:%d/?dummy=param.mjpg' % (host, camera_stream_port)
+# Older device apps only understand the text protocol
+gaze_protocol_mode = gaze_protocol.TEXT_MODE
+
+mjpg_stream_url = 'http://%s:%d/' % (host, camera_stream_port)
 
 vid_path = 'C:\\Users\\Erroll\\Documents\\Part 3 Project (local)\\Gaze Data\\P03\\P03_L2_D2_20130517_161358.mp4'
 
@@ -24,15 +31,44 @@ use_local_video = not (use_network_stream or use_webcam)
 debug = False
 recording = False
 
-marker_flags_ms = [3500] + [x for x in range(7500, 50000, 4000)]
+# Per-stage outputs of local videos are kept under here when set (a directory per video), re-runs only recompute
+# stages whose settings changed
+checkpoint_path = None
+
+def read_frame(vc, ingest, rot90s):
+    
+    """ Returns (stream_open, rotated frame, capture_time)
+    
+    Network JPEGs become lazy FramePyramids, so the full-res frame is only decoded if eyes are found
+    """
+    
+    if isinstance(vc, MjpegReader):
+        stream_open, jpeg, capture_time = vc.read_jpeg()
+        return stream_open, (ingest.make_pyramid(jpeg) if stream_open else None), capture_time
+    
+    stream_open, frame = vc.read()
+    return stream_open, (np.rot90(frame, rot90s) if stream_open else None), time()
 
 if __name__ == '__main__':
     
     paused = False;
     
+    # Gaze system and cascades are kept across stream reconnects
+    device = device_constants.Device(device_constants.WEBCAM if use_webcam else device_constants.NEXUS_7_INV)
+    checkpoints = None
+    if use_local_video and checkpoint_path is not None:
+        checkpoints = checkpoint_store.CheckpointStore(checkpoint_store.get_session_path(checkpoint_path, vid_path),
+                                                       recording=checkpoint_store.get_recording_id(vid_path))
+    g_sys = gaze_system.GazeSystem(device, debug, recording, checkpoints=checkpoints)
+    
+    # Reconnects with backoff by itself, in the background
+    if use_network_stream:
+        mjpeg_reader = MjpegReader(mjpg_stream_url).start()
+    
     while True:
         
         device_control_socket = None
+        gaze_sender = None
         stream_open = False
         
         while stream_open is False:
@@ -42,7 +78,7 @@ if __name__ == '__main__':
                 vc.set(cv2.cv.CV_CAP_PROP_FRAME_WIDTH, 1280) # Try to force HD resolution
                 vc.set(cv2.cv.CV_CAP_PROP_FRAME_HEIGHT, 720) # No success with Microsoft Lifecam on Win8
             elif use_network_stream:
-                vc = cv2.VideoCapture(mjpg_stream_url)
+                vc = mjpeg_reader
             elif use_local_video:
                 vc = cv2.VideoCapture(vid_path)
                 
@@ -51,47 +87,50 @@ if __name__ == '__main__':
                 if abs(48-frames / fps) > 3:
                     print 'WARNING - VARIABLE FRAME RATE'
                 
-            stream_open, frame = vc.read()
+            stream_open, frame, capture_time = read_frame(vc, g_sys.ingest, device.rot90s)
             
-            if not stream_open:
+            if not stream_open and not use_network_stream:
                 print 'Failed to open stream @ %s' % datetime.now().strftime('%X')
                 cv2.waitKey(5000)   # Wait 5s before trying to open VideoCapture again
 
         # VideoCapture is open from now onwards
         print 'Successfully opened stream @ %s' % datetime.now().strftime('%X')
         
+        # Checkpoints are addressed by frame number, which restarts with the video
+        if checkpoints is not None: g_sys.frame_index = -1
+        
         # For managing marker movement
         if use_local_video:
             active_marker_ind = 0
-        
-        device = device_constants.Device(device_constants.WEBCAM if use_webcam else device_constants.NEXUS_7_INV)
+            g_sys.activate_marker(active_marker_ind)
         
         if use_network_stream:
             device_control_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             device_control_socket.connect((host, device_control_port))
-            
-        g_sys = gaze_system.GazeSystem(device, debug, recording)
+            gaze_sender = gaze_protocol.GazeSender(device_control_socket, gaze_protocol_mode)
         
-        # Activate 1st marker
-        g_sys.activate_marker(active_marker_ind)                                    
+        frame_id = 0
         
         while stream_open:
             
-            frame = np.rot90(frame, device.rot90s)
-            
             # Increment activated marker
-            ms_passed = vc.get(cv2.cv.CV_CAP_PROP_POS_MSEC)
-            if(ms_passed >= marker_flags_ms[active_marker_ind]):
-                active_marker_ind += 1
-                g_sys.activate_marker(active_marker_ind)
+            if use_local_video:
+                ms_passed = vc.get(cv2.cv.CV_CAP_PROP_POS_MSEC)
+                if(ms_passed >= marker_flags_ms[active_marker_ind]):
+                    active_marker_ind += 1
+                    g_sys.activate_marker(active_marker_ind)
+            
+            gaze_pt = g_sys.get_gaze_from_frame(frame, capture_time)
             
-            gaze_pt = g_sys.get_gaze_from_frame(frame)
+            if use_network_stream:
+                gaze_sender.send(gaze_protocol.make_message(frame_id, capture_time, gaze_pt, g_sys.eyes_valid,
+                                                            g_sys.confidence, g_sys.eyes_reused))
             
-            if use_network_stream and gaze_pt is not None:
-                (x, y) = gaze_pt
-                device_control_socket.sendall('%d %d \n' % (int(x), int(y)))
+            # Measure capture-to-send delay for gaze prediction
+            g_sys.update_latency(time() - capture_time)
             
-            stream_open, frame = vc.read()
+            stream_open, frame, capture_time = read_frame(vc, g_sys.ingest, device.rot90s)
+            frame_id += 1
             
             # Pause on pressing P, p or [space]
             key = cv2.waitKey(5)
@@ -99,5 +138,12 @@ if __name__ == '__main__':
         
         # Stream is now closed, clean up
         print 'Stream interrupted @ %s' % datetime.now().strftime('%X')
+        print 'Quality gate: %s' % g_sys.gate.get_summary()
+        print 'Frame scheduler: %s' % g_sys.scheduler.get_summary()
+        print 'Limbus tracking: %s' % g_sys.tracker.get_summary()
+        
+        if checkpoints is not None:
+            checkpoints.flush()
+            print 'Checkpoints: %s' % checkpoints.get_summary()
         
         if device_control_socket is not None: device_control_socket.close()
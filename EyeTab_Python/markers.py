@@ -0,0 +1,3 @@
+# Times (ms into a recording) at which the marker procedure moves on to the next gaze marker, the same schedule for
+# every recorded session
+marker_flags_ms = [3500] + [x for x in range(7500, 50000, 4000)]
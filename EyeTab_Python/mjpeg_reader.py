@@ -0,0 +1,229 @@
+import cv2
+import httplib
+import numpy as np
+import socket
+import threading
+import urllib2
+
+from datetime import datetime
+from time import time, sleep
+
+
+class BadStream(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+
+class MjpegReader:
+
+    def __init__(self, url, timeout_s=5.0, backoff_min_s=0.5, backoff_max_s=30.0):
+
+        """ Reads an MJPEG-over-HTTP stream in a background thread, keeping only the newest JPEG
+
+        Reconnects with exponential backoff (backoff_min_s doubling up to backoff_max_s) when the stream fails
+        """
+
+        self.url = url
+        self.timeout_s = timeout_s
+        self.backoff_min_s = backoff_min_s
+        self.backoff_max_s = backoff_max_s
+
+        self.cond = threading.Condition()
+        self.latest_jpeg = None
+        self.latest_time = None
+        self.latest_id = 0          # id of newest jpeg received
+        self.last_read_id = 0       # id of newest jpeg returned by read
+
+        self.frames_received = 0
+        self.frames_skipped = 0     # stale frames never decoded because a newer one arrived
+        self.reconnects = 0
+
+        self.running = False
+        self.thread = None
+
+    def start(self):
+
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='MjpegReader %s' % self.url)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+
+        self.running = False
+        with self.cond:
+            self.cond.notify_all()
+
+    def read_jpeg(self, timeout_s=None):
+
+        """ Waits for a JPEG newer than the last one read, returns (ok, jpeg_bytes, capture_time)
+        """
+
+        timeout_s = self.timeout_s if timeout_s is None else timeout_s
+        end_time = time() + timeout_s
+
+        with self.cond:
+            while self.running and self.latest_id == self.last_read_id and time() < end_time:
+                self.cond.wait(end_time - time())
+
+            if self.latest_id == self.last_read_id: return False, None, None
+
+            self.frames_skipped += self.latest_id - self.last_read_id - 1
+            self.last_read_id = self.latest_id
+            return True, self.latest_jpeg, self.latest_time
+
+    def read(self, timeout_s=None):
+
+        """ Same interface as cv2.VideoCapture.read, only ever decodes the newest JPEG
+        """
+
+        ok, jpeg, _ = self.read_jpeg(timeout_s)
+        if not ok: return False, None
+
+        frame = cv2.imdecode(np.fromstring(jpeg, dtype=np.uint8), cv2.IMREAD_COLOR)
+        return frame is not None, frame
+
+    def run(self):
+
+        backoff_s = self.backoff_min_s
+
+        while self.running:
+            try:
+                response = urllib2.urlopen(self.url, timeout=self.timeout_s)
+                boundary = get_boundary(response.info().getheader('Content-Type', ''))
+
+                for jpeg in read_parts(response, boundary):
+                    with self.cond:
+                        self.latest_jpeg, self.latest_time = jpeg, time()
+                        self.latest_id += 1
+                        self.frames_received += 1
+                        self.cond.notify_all()
+
+                    backoff_s = self.backoff_min_s      # Only reset once frames actually arrive
+                    if not self.running: break
+
+            # Truncated or malformed responses (e.g. IncompleteRead, bad Content-Length) reconnect like lost ones
+            except (urllib2.URLError, socket.error, httplib.HTTPException, ValueError, BadStream) as e:
+                print 'MJPEG stream failed (%s) @ %s' % (getattr(e, 'msg', e), datetime.now().strftime('%X'))
+
+            if not self.running: break
+
+            # Wait before reconnecting, doubling each consecutive failure
+            sleep(backoff_s)
+            backoff_s = min(backoff_s * 2, self.backoff_max_s)
+            self.reconnects += 1
+
+
+def get_boundary(content_type):
+
+    """ Extracts boundary from a 'multipart/x-mixed-replace; boundary=...' header
+    """
+
+    for param in content_type.split(';')[1:]:
+        key, _, value = param.strip().partition('=')
+        if key.lower() == 'boundary':
+            return value.strip('"').lstrip('-')
+
+    raise BadStream('No multipart boundary in Content-Type: %s' % content_type)
+
+
+def read_parts(stream, boundary):
+
+    """ Yields the body of each part of a multipart stream
+    """
+
+    is_boundary = lambda line : line.startswith('--') and line.strip().strip('-') == boundary
+
+    line = stream.readline()
+    while line and not is_boundary(line): line = stream.readline()
+
+    while line:
+
+        # Part headers end at first blank line
+        headers = {}
+        line = stream.readline()
+        while line.strip():
+            key, _, value = line.partition(':')
+            headers[key.strip().lower()] = value.strip()
+            line = stream.readline()
+        if not line: break
+
+        if 'content-length' in headers:
+            body = stream.read(int(headers['content-length']))
+            line = stream.readline()
+            while line and not is_boundary(line): line = stream.readline()
+        else:
+            body_lines = []
+            line = stream.readline()
+            while line and not is_boundary(line):
+                body_lines.append(line)
+                line = stream.readline()
+            body = ''.join(body_lines)[:-2]     # Strip CRLF before boundary
+
+        if not line: break
+        yield body
+
+    raise BadStream('Stream ended')
+
+
+def run_stand_in_server(jpegs, port=8080, fps=30, boundary='eyetabframe', frames_per_connection=None):
+
+    """ Local stand-in for the device camera, serving jpegs over HTTP as MJPEG in a loop
+
+    frames_per_connection - drop each connection after this many frames, for testing reconnects
+    """
+
+    import BaseHTTPServer
+
+    class MjpegHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=%s' % boundary)
+            self.end_headers()
+
+            frames_sent = 0
+            try:
+                while frames_per_connection is None or frames_sent < frames_per_connection:
+                    jpeg = jpegs[frames_sent % len(jpegs)]
+                    self.wfile.write('--%s\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n' % (boundary, len(jpeg)))
+                    self.wfile.write(jpeg + '\r\n')
+                    frames_sent += 1
+                    sleep(1.0 / fps)
+            except socket.error:
+                pass
+
+        def log_message(self, format, *args):
+            pass
+
+    BaseHTTPServer.HTTPServer(('127.0.0.1', port), MjpegHandler).serve_forever()
+
+
+#----------------------------------------
+# EXAMPLE USAGE
+#----------------------------------------
+if __name__ == '__main__':
+
+    import glob
+
+    jpegs = [cv2.imencode('.jpg', cv2.imread(path))[1].tostring() for path in glob.glob('eye_images/*.png')]
+
+    server_thread = threading.Thread(target=run_stand_in_server,
+                                     kwargs={'jpegs': jpegs, 'port': 8081, 'fps': 60, 'frames_per_connection': 100})
+    server_thread.daemon = True
+    server_thread.start()
+
+    reader = MjpegReader('http://127.0.0.1:8081/', backoff_min_s=0.1).start()
+
+    tick, frames_read = time(), 0
+    while time() - tick < 5:
+        ok, frame = reader.read()
+        if ok: frames_read += 1
+        sleep(0.03)                                 # Slower consumer than stream, so frames are skipped
+
+    print 'Received: %d, read: %d, skipped: %d, reconnects: %d' % (reader.frames_received, frames_read,
+                                                                   reader.frames_skipped, reader.reconnects)
+    reader.stop()
+    reader.thread.join()
@@ -0,0 +1,324 @@
+import cv2
+import itertools
+import math
+import multiprocessing
+import random
+import numpy as np
+
+import device_constants
+import eye_extractor
+import gaze_system
+import checkpoint_store
+
+from markers import marker_flags_ms
+from time import time
+
+try:
+    import marker_manager
+    get_marker_id_for_vis = marker_manager.get_marker_id_for_vis
+except ImportError:
+    get_marker_id_for_vis = lambda marker_ind : marker_ind   # Markers looked at in creation order
+
+# VPYTHON : GAZETRACKER, as in visualize_in_3d, so evaluation rows match its .csv files
+cvt_pt = lambda x, y, z : (x, -y, z)
+
+# 4x3 gaze markers (vpython coords) in creation order, as drawn by Visualizer3d.draw_device_screen
+marker_pts = [(j * 31 - 31, i * 35 + 40, 0) for i in range(4) for j in range(3)]
+
+marker_switch_cooldown = 4          # Frames not evaluated after the active marker changes
+
+# Settings changing what is checkpointed, combinations sharing them share one recording's cached stages
+upstream_names = ['angles_to_try', 'fast_width_grads', 'fast_width_iso', 'phi', 'angle_step', 'backends']
+
+default_angles_to_try = list(eye_extractor.angles_to_try)
+
+#              settings swept by default, see expand_grid
+default_grid = {'ransac_iters_max': [2, 5, 10],
+                'refine_iters_max': [1, 3],
+                'fast_width_grads': [15.0, 25.0],
+                'fast_width_iso': [50.0, 80.0],
+                'angle_step': [1, 2, 4],
+                'angles_to_try': [default_angles_to_try, [0]]}
+
+
+class MarkerEvaluator:
+
+    def __init__(self, filename=None):
+
+        """ Stands in for visualize_in_3d.Visualizer3d as GazeSystem.visualizer3d, keeping the same evaluation rows
+        against the active marker without VPython, so recordings can be scored headless
+        """
+
+        self.active_marker_ind = 0
+        self.active_marker_vpy_id = 0
+        self.marker_switch_cooldown = 0
+
+        # Last centre found for each eye, the Visualizer3d limbus circles also stay put while an eye is lost
+        self.limb_centres = [np.zeros(3), np.zeros(3)]
+        self.rows = []
+
+        self.eval_file = open(filename + '.csv', 'a') if filename is not None else None
+
+    def activate_marker(self, marker_ind):
+
+        self.active_marker_ind = marker_ind
+        vis_marker_id = get_marker_id_for_vis(marker_ind)
+
+        if self.active_marker_vpy_id == vis_marker_id: return
+        self.active_marker_vpy_id = vis_marker_id
+        self.marker_switch_cooldown = marker_switch_cooldown
+
+    def update_vis(self, limbuses, smoothed_gaze_pt_mm=None, predicted_gaze_pt_mm=None):
+
+        for i, limbus in enumerate(limbuses):
+            if limbus is not None: self.limb_centres[i] = np.array(cvt_pt(*limbus.center_mm), float)
+
+        if smoothed_gaze_pt_mm is None or self.active_marker_vpy_id >= len(marker_pts): return
+
+        # Only record gaze-data after short cooldown
+        if self.marker_switch_cooldown > 0:
+            self.marker_switch_cooldown -= 1
+            return
+
+        correct_pos = np.array(marker_pts[self.active_marker_vpy_id], float)
+        gaze_pos = np.array(cvt_pt(smoothed_gaze_pt_mm[0], smoothed_gaze_pt_mm[1], 0), float)
+        limb_mid_pt = (self.limb_centres[0] + self.limb_centres[1]) / 2
+
+        # marker x,y, gaze x,y, dist to eye-pair, dist_err, dist_err_x, angle_err
+        row = [correct_pos[0], correct_pos[1], gaze_pos[0], gaze_pos[1], np.linalg.norm(limb_mid_pt),
+               np.linalg.norm(correct_pos - gaze_pos), abs(correct_pos[0] - gaze_pos[0]),
+               get_angle_deg(correct_pos - limb_mid_pt, gaze_pos - limb_mid_pt)]
+
+        # Optionally followed by predicted gaze x,y, predicted dist_err
+        if predicted_gaze_pt_mm is not None:
+            pred_pos = np.array(cvt_pt(predicted_gaze_pt_mm[0], predicted_gaze_pt_mm[1], 0), float)
+            row += [pred_pos[0], pred_pos[1], np.linalg.norm(correct_pos - pred_pos)]
+
+        self.rows.append([self.active_marker_ind] + row)
+        if self.eval_file is not None:
+            self.eval_file.write(','.join([str(self.active_marker_ind)] + ['%.4f' % x for x in row]) + '\n')
+
+    def get_errors(self):
+
+        """ Mean (dist_err mm, angle_err deg) over rows written, None if there are none
+        """
+
+        if not self.rows: return None
+        return np.mean([row[6] for row in self.rows]), np.mean([row[8] for row in self.rows])
+
+
+def get_angle_deg(vec_1, vec_2):
+
+    """ Angle between vectors, 0 if either has no length (as VPython's diff_angle)
+    """
+
+    norms = np.linalg.norm(vec_1) * np.linalg.norm(vec_2)
+    if norms == 0: return 0.0
+    return math.degrees(math.acos(np.clip(np.dot(vec_1, vec_2) / norms, -1, 1)))
+
+
+def expand_grid(grid):
+
+    """ Every combination ~ {name: value} of grid ~ {name: [values]}, names being GazeSystem params, plus
+    angles_to_try (eye_extractor) and backends ({stage: backend name}, see stage_registry)
+    """
+
+    names = sorted(grid.keys())
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+
+
+def get_upstream_id(combination):
+    return repr([(name, combination.get(name)) for name in upstream_names])
+
+
+#                      vid_path - recorded session, markers shown on marker_flags_ms schedule
+#                      |         combination - settings, see expand_grid
+#                      |         |            device_name - of device_constants
+#                      |         |            |            checkpoint_root - stages cached in a directory per recording
+#                      |         |            |            |
+def run_recording(job):
+
+    """ (vid_path, combination, device_name, checkpoint_root) -> (errors or None, ms per frame, frames), run in
+    pool workers
+
+    Time per frame adds back what stages read from checkpoints took when they were computed, so it is what a run
+    without checkpoints would take
+    """
+
+    vid_path, combination, device_name, checkpoint_root = job
+
+    params = dict(combination)
+    eye_extractor.angles_to_try = params.pop('angles_to_try', default_angles_to_try)
+    backends = params.pop('backends', None)
+
+    device = device_constants.Device(device_name)
+    checkpoints = checkpoint_store.CheckpointStore(checkpoint_store.get_session_path(checkpoint_root, vid_path),
+                                                   recording=checkpoint_store.get_recording_id(vid_path))
+    g_sys = gaze_system.GazeSystem(device, init_vpython=False, display=False, backends=backends, params=params,
+                                   checkpoints=checkpoints)
+    evaluator = g_sys.visualizer3d = MarkerEvaluator()
+
+    # RANSAC draws from both, so every combination sees the same samples
+    random.seed(0)
+    np.random.seed(0)
+
+    vc = cv2.VideoCapture(vid_path)
+    pos_msec_prop = cv2.CAP_PROP_POS_MSEC if hasattr(cv2, 'CAP_PROP_POS_MSEC') else cv2.cv.CV_CAP_PROP_POS_MSEC
+
+    active_marker_ind = 0
+    g_sys.activate_marker(active_marker_ind)
+
+    num_frames, total_ms = 0, 0.0
+    stream_open, frame = vc.read()
+    while stream_open:
+
+        ms_passed = vc.get(pos_msec_prop)
+        if active_marker_ind < len(marker_flags_ms) and ms_passed >= marker_flags_ms[active_marker_ind]:
+            active_marker_ind += 1
+            g_sys.activate_marker(active_marker_ind)
+
+        # Video time stands in for capture time, so gaze prediction doesn't depend on how fast frames are processed
+        frame = np.rot90(frame, device.rot90s)
+        tick = time()
+        g_sys.get_gaze_from_frame(frame, ms_passed / 1000.0)
+        total_ms += (time() - tick) * 1000
+        num_frames += 1
+
+        stream_open, frame = vc.read()
+
+    checkpoints.flush()
+
+    ms_per_frame = (total_ms + g_sys.checkpoint_saved_ms) / max(num_frames, 1)
+    return evaluator.get_errors(), ms_per_frame, num_frames
+
+
+class SweepResult:
+
+    def __init__(self, combination, errors, ms_per_frame, processes=1):
+
+        self.combination = combination
+        self.dist_err = np.mean([dist_err for (dist_err, _) in errors]) if errors else np.inf   # mm, over recordings
+        self.angle_err = np.mean([angle_err for (_, angle_err) in errors]) if errors else np.inf  # deg
+        self.ms_per_frame = ms_per_frame
+        self.processes = processes      # Runs sharing the CPU while ms_per_frame was measured
+        self.pareto = False
+
+    def dominates(self, other):
+        return (self.dist_err <= other.dist_err and self.ms_per_frame <= other.ms_per_frame and
+                (self.dist_err < other.dist_err or self.ms_per_frame < other.ms_per_frame))
+
+    def get_summary(self):
+        return '%s %6.2f mm %6.2f deg %7.2f ms (%d procs)  %s' % ('*' if self.pareto else ' ', self.dist_err,
+                                                                  self.angle_err, self.ms_per_frame, self.processes,
+                                                                  self.combination)
+
+
+def mark_pareto_front(results):
+
+    """ Flags results no other is both at least as accurate (dist_err) and as fast as, returns them fastest first
+    """
+
+    for result in results:
+        result.pareto = not any(other.dominates(result) for other in results)
+    return sorted([result for result in results if result.pareto], key=lambda result: result.ms_per_frame)
+
+
+def sweep(vid_paths, grid=None, device_name=device_constants.NEXUS_7_INV, checkpoint_root='sweep_checkpoints',
+          processes=None):
+
+    """ SweepResult of every combination of grid (see expand_grid) over recordings vid_paths, Pareto front marked
+
+    One combination per recording & upstream settings runs first, filling that recording's checkpoints, so the rest
+    (in parallel) mostly only redo the ellipse fits
+
+    Times per frame are measured with processes runs competing for the CPU (default one per core), so only compare
+    results of the same processes. processes=1 runs every combination in turn in this process, timing it alone
+    """
+
+    combinations = expand_grid(grid or default_grid)
+    jobs = [(vid_path, combination, device_name, checkpoint_root)
+            for combination in combinations for vid_path in vid_paths]
+
+    # Job indices of the first run of each recording & upstream settings, and of the rest
+    warm_ids, warm_jobs, other_jobs = set(), [], []
+    for (job_index, (vid_path, combination, _, _)) in enumerate(jobs):
+        warm_id = (vid_path, get_upstream_id(combination))
+        (other_jobs if warm_id in warm_ids else warm_jobs).append(job_index)
+        warm_ids.add(warm_id)
+
+    processes = processes or multiprocessing.cpu_count()
+
+    outputs = [None] * len(jobs)
+    pool = multiprocessing.Pool(processes) if processes > 1 else None
+    try:
+        for job_indices in [warm_jobs, other_jobs]:
+            job_outputs = (pool.map(run_recording, [jobs[j] for j in job_indices]) if pool is not None else
+                           [run_recording(jobs[j]) for j in job_indices])
+            for job_index, output in zip(job_indices, job_outputs):
+                outputs[job_index] = output
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    results = []
+    for (i, combination) in enumerate(combinations):
+        job_outputs = outputs[i * len(vid_paths):(i + 1) * len(vid_paths)]
+        errors = [errs for (errs, _, _) in job_outputs if errs is not None]
+
+        # Frame-weighted, so long recordings count for more
+        num_frames = sum(frames for (_, _, frames) in job_outputs)
+        ms_per_frame = sum(ms * frames for (_, ms, frames) in job_outputs) / max(num_frames, 1)
+        results.append(SweepResult(combination, errors if len(errors) == len(job_outputs) else None, ms_per_frame,
+                                   processes))
+
+    mark_pareto_front(results)
+    return results
+
+
+def write_results(results, filename):
+
+    names = sorted(results[0].combination.keys())
+    with open(filename, 'w') as results_file:
+        results_file.write(','.join(names + ['dist_err', 'angle_err', 'ms_per_frame', 'processes', 'pareto']) + '\n')
+        for result in results:
+            values = [repr(result.combination[name]).replace(',', ';') for name in names]
+            values += ['%.4f' % result.dist_err, '%.4f' % result.angle_err, '%.4f' % result.ms_per_frame,
+                       str(result.processes), str(int(result.pareto))]
+            results_file.write(','.join(values) + '\n')
+
+
+#----------------------------------------
+# EXAMPLE USAGE
+#----------------------------------------
+if __name__ == '__main__':
+
+    import glob
+
+    # Recordings of the marker procedure, as evaluated by main.py with the 3D visualizer
+    vid_paths = sorted(glob.glob('recordings/*.mp4'))
+
+    # A small grid, default_grid has 144 combinations
+    grid = {'ransac_iters_max': [2, 5],
+            'refine_iters_max': [1, 3],
+            'angle_step': [1, 2]}
+
+    # Accuracy over every core first, then the Pareto front timed again one combination at a time
+    tick = time()
+    results = sweep(vid_paths, grid)
+    print 'Swept %d combinations over %d recordings in %0.1f s\n' % (len(results), len(vid_paths), time() - tick)
+
+    print '  dist err  angle err  ms/frame  (* Pareto front)'
+    for result in sorted(results, key=lambda result: result.ms_per_frame):
+        print result.get_summary()
+
+    # Checkpoints are filled by now, so this mostly redoes the fits
+    front = [sweep(vid_paths, dict((name, [value]) for (name, value) in result.combination.items()), processes=1)[0]
+             for result in mark_pareto_front(results)]
+
+    print '\nPareto front, timed alone:'
+    for result in mark_pareto_front(front):
+        print result.get_summary()
+
+    write_results(results, 'sweep_results.csv')
+    write_results(front, 'sweep_front.csv')
@@ -1,26 +1,35 @@
 import cv2
+import threading
 import numpy as np
 import image_utils
 import eye_extractor
 
 winname = 'Pre Processing'
 
+TELEA = 0x1             # Inpaint specularities with cv2.inpaint (slow, reference)
+FAST = 0x2              # Fill specularities from surrounding pixels with a normalized box blur
+
+# Connected components with stats need OpenCV 3+, otherwise fast mode finds specularities from contours
+has_connected_components = hasattr(cv2, 'connectedComponentsWithStats')
+
+morph_kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
+
 class PreProcessor:
     
-    def __init__(self):
+    def __init__(self, specular_mode=TELEA):
         self.full_debug_img = None
+        self.specular_mode = specular_mode
+        self.specular_skipped = 0           # ROIs where no specularity was found, so nothing was filled
+        self.lock = threading.Lock()        # instances are shared by every GazeSystem (see stage_registry)
 
-    def erase_specular(self, eye_img, debug=False):
-    
-        # Rather arbitrary decision on how large a specularity may be
-        max_specular_contour_area = sum(eye_img.shape[:2])/2
-    
-        # Extract top 50% of intensities
-        eye_img_grey = cv2.cvtColor(eye_img, cv2.COLOR_BGR2GRAY)
+    def get_thresh_img(self, eye_img_grey):
+        
+        """ Extracts top 50% of intensities
+        """
+        
         eye_img_grey_blur = cv2.GaussianBlur(eye_img_grey, (5, 5), 0)
         
         # Close to suppress eyelashes
-        morph_kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
         eye_img_grey_blur = cv2.morphologyEx(eye_img_grey_blur, cv2.MORPH_CLOSE, morph_kernel)
         
         if eye_img_grey_blur is None:
@@ -29,6 +38,17 @@ class PreProcessor:
         thresh_val = int(np.percentile(eye_img_grey_blur, 50))
         
         _, thresh_img = cv2.threshold(eye_img_grey_blur, thresh_val, 255, cv2.THRESH_BINARY)
+        return thresh_img
+
+    def erase_specular(self, eye_img, debug=False):
+        
+        if self.specular_mode == FAST: return self.erase_specular_fast(eye_img, debug)
+    
+        # Rather arbitrary decision on how large a specularity may be
+        max_specular_contour_area = sum(eye_img.shape[:2])/2
+    
+        eye_img_grey = cv2.cvtColor(eye_img, cv2.COLOR_BGR2GRAY)
+        thresh_img = self.get_thresh_img(eye_img_grey)
         
         # Find all contours and throw away the big ones
         contours, _ = cv2.findContours(np.copy(thresh_img), cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
@@ -46,14 +66,152 @@ class PreProcessor:
             cv2.drawContours(thresh_hierarchy, contours, -1, (0, 0, 255), -1)
             thresh_hierarchy = cv2.add(thresh_hierarchy, cv2.cvtColor(small_contours_mask_dilated, cv2.COLOR_GRAY2BGR))
             cv2.drawContours(thresh_hierarchy, small_contours, -1, (255, 0, 0), -1)
-            stacked_imgs = np.concatenate([eye_img, thresh_hierarchy, removed_specular_img],axis=1)
+            self.show_debug(debug, [eye_img, thresh_hierarchy, removed_specular_img])
+        
+        return removed_specular_img
+    
+    def get_specular_mask(self, thresh_img, max_area):
+        
+        """ Returns mask of bright blobs smaller than max_area, their bounding box (x0, y0, x1, y1) and the
+        largest width or height of any of them. Box is None if there are none
+        """
+        
+        if not has_connected_components:
+            contours, _ = cv2.findContours(np.copy(thresh_img), cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+            small_contours = [contour for contour in contours if cv2.contourArea(contour) < max_area]
+            if len(small_contours) == 0: return None, None, 0
+            
+            specular_mask = np.zeros_like(thresh_img)
+            cv2.drawContours(specular_mask, small_contours, -1, 255, -1)
+            rects = np.array([cv2.boundingRect(contour) for contour in small_contours])
+        
+        else:
+            _, labels, stats, _ = cv2.connectedComponentsWithStats(thresh_img, connectivity=8)
+            
+            # Label 0 is background
+            is_small = stats[:, cv2.CC_STAT_AREA] < max_area
+            is_small[0] = False
+            if not np.any(is_small): return None, None, 0
+            
+            # Few blobs are large, so remove those rather than gathering all the small ones
+            specular_mask = thresh_img.copy()
+            for label in np.nonzero(~is_small)[0][1:]:
+                specular_mask[cv2.compare(labels, float(label), cv2.CMP_EQ) > 0] = 0
             
-            if debug == 1:
-                self.full_debug_img = stacked_imgs
-            elif debug == 2:
-                self.full_debug_img = image_utils.stack_imgs_vertical([self.full_debug_img, stacked_imgs])
-                cv2.imshow(winname, self.full_debug_img)
-            elif debug == 3:
-                cv2.imshow(winname, stacked_imgs);
+            rects = stats[is_small][:, [cv2.CC_STAT_LEFT, cv2.CC_STAT_TOP, cv2.CC_STAT_WIDTH, cv2.CC_STAT_HEIGHT]]
+        
+        xs, ys, ws, hs = rects.T
+        bbox = xs.min(), ys.min(), (xs + ws).max(), (ys + hs).max()
+        return specular_mask, bbox, max(ws.max(), hs.max())
+    
+    def erase_specular_fast(self, eye_img, debug=False):
+        
+        """ Same detection as erase_specular, but each specularity is filled with the mean of the pixels around it
+        (normalized convolution) instead of inpainting. ROIs without specularities are returned as they are
+        """
+        
+        max_specular_area = sum(eye_img.shape[:2]) / 2
+        
+        eye_img_grey = cv2.cvtColor(eye_img, cv2.COLOR_BGR2GRAY)
+        thresh_img = self.get_thresh_img(eye_img_grey)
+        specular_mask, bbox, max_size = self.get_specular_mask(thresh_img, max_specular_area)
+        
+        if specular_mask is None:
+            with self.lock: self.specular_skipped += 1
+            if debug: self.show_debug(debug, [eye_img, cv2.cvtColor(eye_img_grey, cv2.COLOR_GRAY2BGR), eye_img])
+            return eye_img
+        
+        # Box must reach past the widest (dilated) specularity to always find some valid pixels
+        box_r = max_size + morph_kernel.shape[0]
+        box_size = (2 * box_r + 1, 2 * box_r + 1)
+        
+        # Only filter the part of the ROI around specularities
+        bbox_x0, bbox_y0, bbox_x1, bbox_y1 = bbox
+        y0, y1 = max(bbox_y0 - box_r, 0), min(bbox_y1 + box_r, eye_img.shape[0])
+        x0, x1 = max(bbox_x0 - box_r, 0), min(bbox_x1 + box_r, eye_img.shape[1])
+        window_mask = cv2.dilate(specular_mask[y0:y1, x0:x1], morph_kernel)
+        window_img = eye_img[y0:y1, x0:x1]
+        
+        # Normalized convolution - sum of valid pixels in box around each pixel, divided by their number
+        valid = (window_mask == 0).astype(np.uint8)
+        valid_sums = cv2.boxFilter(cv2.bitwise_and(window_img, window_img, mask=valid), cv2.CV_32F, box_size,
+                                   normalize=False)
+        valid_counts = cv2.boxFilter(valid, cv2.CV_32F, box_size, normalize=False)
+        
+        # Only divide where needed
+        fill_inds = window_mask > 0
+        fill_vals = valid_sums[fill_inds] / np.maximum(valid_counts[fill_inds], 1)[:, np.newaxis]
+        
+        removed_specular_img = eye_img.copy()
+        removed_specular_img[y0:y1, x0:x1][fill_inds] = np.round(fill_vals).astype(np.uint8)
+        
+        if debug:
+            thresh_mask = cv2.cvtColor(eye_img_grey, cv2.COLOR_GRAY2BGR)
+            thresh_mask[y0:y1, x0:x1][fill_inds] = (255, 0, 0)
+            self.show_debug(debug, [eye_img, thresh_mask, removed_specular_img])
         
         return removed_specular_img
+    
+    def show_debug(self, debug, imgs):
+        
+        stacked_imgs = np.concatenate(imgs, axis=1)
+        
+        if debug == 1:
+            self.full_debug_img = stacked_imgs
+        elif debug == 2:
+            self.full_debug_img = image_utils.stack_imgs_vertical([self.full_debug_img, stacked_imgs])
+            cv2.imshow(winname, self.full_debug_img)
+        elif debug == 3:
+            cv2.imshow(winname, stacked_imgs);
+
+
+#----------------------------------------
+# EXAMPLE USAGE
+#----------------------------------------
+if __name__ == '__main__':
+    
+    import glob
+    import random
+    import eye_center_locator_combined
+    import ransac_ellipse
+    from find_limbus_points import get_limb_pts
+    from time import time
+    
+    # Square eye ROIs, as GazeSystem uses after pupil refinement
+    eye_imgs = []
+    for path in glob.glob('eye_images/*.png'):
+        eye_img = cv2.imread(path)
+        img_h, img_w = eye_img.shape[:2]
+        eye_imgs.append(np.ascontiguousarray(eye_img[:, (img_w - img_h) / 2:(img_w + img_h) / 2]))
+    
+    results = {}
+    for mode, mode_name in [(TELEA, 'Telea'), (FAST, 'fast')]:
+        
+        pre_proc = PreProcessor(mode)
+        
+        tick = time()
+        for _ in range(10):
+            erased_imgs = [pre_proc.erase_specular(eye_img) for eye_img in eye_imgs]
+        print '%s: %0.2f ms per ROI, %d/%d skipped' % (mode_name, (time() - tick) * 100 / len(eye_imgs),
+                                                        pre_proc.specular_skipped / 10, len(eye_imgs))
+        
+        # Downstream pupil and limbus centre for each ROI
+        results[mode] = []
+        for erased_img in erased_imgs:
+            pupil = eye_center_locator_combined.find_pupil(erased_img, 25.0, 80.0, 0.8, 0.2)
+            try:
+                random.seed(0)
+                pts = get_limb_pts(erased_img, phi=20, angle_step=1)
+                limbus_centre = ransac_ellipse.ransac_ellipse_fit(pts, erased_img, (0, 0), 5, 3, 3).rotated_rect[0]
+            except (ransac_ellipse.NoEllipseFound, ransac_ellipse.CoverageTooLow):
+                limbus_centre = None
+            results[mode].append((pupil, limbus_centre))
+    
+    dist = lambda (x1, y1), (x2, y2) : np.sqrt((x1 - x2) ** 2 + (y1 - y2) ** 2)
+    pupil_dists = [dist(p1, p2) for ((p1, _), (p2, _)) in zip(results[TELEA], results[FAST])]
+    limbus_dists = [dist(l1, l2) for ((_, l1), (_, l2)) in zip(results[TELEA], results[FAST]) if l1 and l2]
+    
+    print 'Pupil moved (px) - median: %0.2f, max: %0.2f' % (np.median(pupil_dists), np.max(pupil_dists))
+    print 'Limbus centre moved (px) - median: %0.2f, max: %0.2f, fits found %d (Telea) %d (fast)' % (
+        np.median(limbus_dists), np.max(limbus_dists),
+        sum([l is not None for (_, l) in results[TELEA]]), sum([l is not None for (_, l) in results[FAST]]))
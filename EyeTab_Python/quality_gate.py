@@ -0,0 +1,193 @@
+import image_utils
+
+from time_profiler import TimeProfiler
+
+# Per-eye stages in order, a gate failing before a stage skips it and all later ones
+#         gated on blur (after specular removal)
+#         |         gated on pupil confidence
+#         |         |           gated on limbus point count
+#         |         |           |
+stages = ['pupil', 'eyelids', 'limbus_pts', 'ellipse']
+
+min_blur_LoG = 800          # Sharp ROIs score ~1600-6700 with image_utils.measure_blurriness_LoG, < 800 once
+                            # blurred by a Gaussian of sigma ~3 px
+min_pupil_conf = 0.01       # Centre map peak barely stands out from the runner-up below this
+min_limbus_pts = 30         # Too few left after filter_limbus_pts for a reliable fit
+max_reuse_frames = 5        # Consecutive frames an eye's previous limbus may stand in for a gated one
+
+
+class LowQuality(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+
+class QualityGate:
+
+    def __init__(self, min_blur=min_blur_LoG, min_pupil_conf=min_pupil_conf, min_limbus_pts=min_limbus_pts,
+                 max_reuse_frames=max_reuse_frames):
+
+        """ Cheap quality checks between the per-eye stages of GazeSystem, which stop the chain early on bad ROIs
+
+        Gated eyes reuse their previous limbus for a few frames. Stage timings estimate the compute saved
+        """
+
+        self.min_blur = min_blur
+        self.min_pupil_conf = min_pupil_conf
+        self.min_limbus_pts = min_limbus_pts
+        self.max_reuse_frames = max_reuse_frames
+
+        self.last_limbuses = [None, None]
+        self.reuse_counts = [0, 0]          # consecutive frames each eye's last limbus has been reused
+
+        self.timings = TimeProfiler()
+        self.stage_runs = dict((stage, 0) for stage in stages)
+        self.stages_skipped = dict((stage, 0) for stage in stages)
+        self.gated = {'blur': 0, 'closed': 0, 'pupil_conf': 0, 'limbus_pts': 0}
+        self.eyes_checked = 0
+        self.limbuses_reused = 0
+
+    def start(self, stage):
+
+        self.timings.start(stage)
+        self.stage_runs[stage] += 1
+
+    def stop(self):
+        self.timings.stop()
+
+    def reject(self, gate, next_stage, msg):
+
+        self.gated[gate] += 1
+        for stage in stages[stages.index(next_stage):]: self.stages_skipped[stage] += 1
+        raise LowQuality(msg)
+
+    def start_eye(self):
+        self.eyes_checked += 1
+
+    def check_blur(self, eye_img):
+
+        blur = image_utils.measure_blurriness_LoG(eye_img)
+        if not blur > 0: blur = 0           # NaN for flat ROIs, which have no edges at all
+        if blur < self.min_blur: self.reject('blur', 'pupil', 'Eye ROI too blurred (%d)' % blur)
+        return blur
+
+    def check_open(self, eye_closed, next_stage='pupil'):
+
+        """ Closed eyes (frame_scheduler.BlinkDetector) have no limbus to find
+        """
+
+        if eye_closed: self.reject('closed', next_stage, 'Eye closed')
+
+    def check_pupil_conf(self, pupil_conf):
+
+        if pupil_conf < self.min_pupil_conf:
+            self.reject('pupil_conf', 'eyelids', 'Pupil centre ambiguous (%0.3f)' % pupil_conf)
+        return pupil_conf
+
+    def check_limbus_pts(self, pts):
+
+        if len(pts) < self.min_limbus_pts:
+            self.reject('limbus_pts', 'ellipse', 'Too few limbus points (%d)' % len(pts))
+        return len(pts)
+
+    def update_limbus(self, eye_index, limbus):
+
+        self.last_limbuses[eye_index] = limbus
+        self.reuse_counts[eye_index] = 0
+
+    def get_fallback_limbus(self, eye_index):
+
+        """ Previous limbus of gated eye, or None once it has stood in for max_reuse_frames in a row
+        """
+
+        if self.last_limbuses[eye_index] is None or self.reuse_counts[eye_index] >= self.max_reuse_frames:
+            self.last_limbuses[eye_index] = None
+            return None
+
+        self.reuse_counts[eye_index] += 1
+        self.limbuses_reused += 1
+        return self.last_limbuses[eye_index]
+
+    def get_mean_ms(self, stage):
+
+        if not self.stage_runs[stage]: return 0.0
+        return self.timings.sections.get(stage, 0.0) / self.stage_runs[stage]
+
+    def get_saved_ms(self):
+
+        """ Estimated time (ms) saved, from mean run time of each stage skipped
+        """
+
+        return sum(self.stages_skipped[stage] * self.get_mean_ms(stage) for stage in stages)
+
+    def get_summary(self):
+
+        gated = ', '.join('%s: %d' % (gate, count) for gate, count in sorted(self.gated.items()))
+        return '%d/%d eyes gated (%s), %d limbuses reused, ~%d ms saved' % (sum(self.gated.values()),
+                                                                            self.eyes_checked, gated,
+                                                                            self.limbuses_reused, self.get_saved_ms())
+
+
+#----------------------------------------
+# EXAMPLE USAGE
+#----------------------------------------
+if __name__ == '__main__':
+
+    import cv2
+    import glob
+    import random
+    import numpy as np
+    import eye_center_locator_combined
+    import eyelid_locator
+    import ransac_ellipse
+    from find_limbus_points import get_limb_pts
+    from time import time
+
+    # Square eye ROIs, with every third one degraded as in a blink or motion blur
+    eye_imgs = []
+    for i, path in enumerate(sorted(glob.glob('eye_images/*.png'))):
+        eye_img = cv2.imread(path)
+        img_h, img_w = eye_img.shape[:2]
+        eye_img = np.ascontiguousarray(eye_img[:, (img_w - img_h) / 2:(img_w + img_h) / 2])
+        if i % 3 == 2: eye_img = cv2.GaussianBlur(eye_img, (0, 0), 10)
+        eye_imgs.append(eye_img)
+
+    def run_eye(eye_img, gate=None):
+
+        random.seed(0)
+        if gate: gate.start_eye(); gate.check_blur(eye_img)
+
+        if gate: gate.start('pupil')
+        _, _, pupil_conf = eye_center_locator_combined.find_pupil_fused(eye_img)
+        if gate: gate.stop(); gate.check_pupil_conf(pupil_conf)
+
+        if gate: gate.start('eyelids')
+        u_eyelid, l_eyelid = eyelid_locator.find_eyelids(eye_img, False)
+        if gate: gate.stop(); gate.start('limbus_pts')
+        pts = eyelid_locator.filter_limbus_pts(u_eyelid, l_eyelid, get_limb_pts(eye_img, phi=20, angle_step=1))
+        if gate: gate.stop(); gate.check_limbus_pts(pts)
+
+        if gate: gate.start('ellipse')
+        try:
+            return ransac_ellipse.ransac_ellipse_fit(pts, eye_img, (0, 0), 5, 3, 3)
+        except (ransac_ellipse.NoEllipseFound, ransac_ellipse.CoverageTooLow):
+            return None
+        finally:
+            if gate: gate.stop()
+
+    tick = time()
+    ungated_fits = [run_eye(eye_img) for eye_img in eye_imgs]
+    ungated_ms = (time() - tick) * 1000 / len(eye_imgs)
+
+    gate, gated_fits = QualityGate(), []
+    tick = time()
+    for eye_img in eye_imgs:
+        try:
+            gated_fits.append(run_eye(eye_img, gate))
+        except LowQuality:
+            gated_fits.append(None)
+    gated_ms = (time() - tick) * 1000 / len(eye_imgs)
+
+    print 'Ungated: %0.2f ms per eye, %d fits' % (ungated_ms, sum(f is not None for f in ungated_fits))
+    print 'Gated: %0.2f ms per eye, %d fits' % (gated_ms, sum(f is not None for f in gated_fits))
+    print gate.get_summary()
+    print 'Mean stage times (ms): %s' % ', '.join('%s: %0.2f' % (stage, gate.get_mean_ms(stage)) for stage in stages)
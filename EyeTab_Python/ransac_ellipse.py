@@ -1,9 +1,11 @@
 import cv2, numpy as np, random
 
-from math import sin, cos, atan2, radians, degrees
-from conic_section import Ellipse, BadEllipseShape
+from conic_section import Ellipse, EllipseBatch, BadEllipseShape
+from fit_ellipse_numpy import fit_ellipses
 from gaze_geometry import get_gaze_point_px
 from draw_utils import draw_cross, draw_points, draw_normal, draw_gaze
+from ransac_stats import RansacStats
+from ellipse_scoring import get_sampson_distances, get_coverage, get_image_grads_at, score_ellipse
 
 write_text = lambda x, y : cv2.putText(x, y, (10, 20), cv2.FONT_HERSHEY_PLAIN, 1, (255, 255, 255))
 winname = 'Ransac ellipse fit'
@@ -11,6 +13,8 @@ image_aware_support = True
 
 max_axis_ratio = 3 
 min_coverage = 25
+prior_min_inlier_ratio = 0.6    # Predicted ellipse is only kept while it explains this many of the points
+hyps_per_batch = 16             # Hypotheses drawn at once by ransac_ellipse_fit_batched, between termination checks
 
 prin_point_x = 344.629
 prin_point_y = 626.738
@@ -42,42 +46,80 @@ def fit_ellipse(ellipse_points, (img_h, img_w)):
     return Ellipse(rotated_rect)
 
 
-def get_err_scale(ellipse):
+def check_shapes(rects, (img_h, img_w)):
     
-    (x0, y0), (_, maj_axis), angle = ellipse.rotated_rect
-    min_axis_x, min_axis_y = -sin(radians(angle)), cos(radians(angle))
-    min_axis_plus_1px = x0 + (maj_axis / 2 + 1) * min_axis_x, y0 + (maj_axis / 2 + 1) * min_axis_y
-    err_of_1px = ellipse.distance(min_axis_plus_1px)
+    """ Vectorized fit_ellipse checks for (N, 5) rotated_rects with w <= h, returns which pass
+    """
     
-    if err_of_1px == 0:
-        raise BadEllipseShape('Error scale = 0')
-        
-    return 1 / err_of_1px
+    x0, y0, min_axis, maj_axis, _ = rects.T
+    
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return ((min_axis * maj_axis > 0) & (maj_axis / min_axis <= max_axis_ratio) &
+                (0 < x0) & (x0 < img_w) & (0 < y0) & (y0 < img_h))
 
 
 def calculate_coverage(ellipse, inliers, step=5):
     
     '''Calculates percentage of ellipse edge covered by its inliers
     '''
-
-    coverage = {}
-    for angle in range(-180, 180, step):
-        coverage[angle] = 0
     
+    inliers = np.asarray(inliers, dtype=float).reshape(-1, 2)
     (x0, y0) = ellipse.rotated_rect[0]
-    for (x, y) in inliers:
-        dx, dy = x - x0, y - y0
-        angle = degrees(atan2(dy, dx))
-        angle_rounded = int(angle / step) * step
-        coverage[angle_rounded] = 1
+    return get_coverage(x0, y0, inliers[:, 0], inliers[:, 1], step)
 
-    return sum(coverage.values()) / (360.0 / step) * 100
+
+def refine_ellipse(ellipse, points, img_shape, refine_iters_max, max_err):
+    
+    """ Iteratively refits ellipse to its inliers (Sampson distance < max_err px), returns (ellipse, inliers of last refit)
+    """
+    
+    pts_x, pts_y = points[:, 0], points[:, 1]
+    inliers = points
+    
+    for _ in range(refine_iters_max):
+        
+        inliers = points[get_sampson_distances(ellipse.get_coeffs(), pts_x, pts_y)[0] < max_err]
+        
+        if len(inliers) < 5: raise NotEnoughInliers()
+        
+        ellipse = fit_ellipse(inliers, img_shape)
+    
+    return ellipse, inliers
+
+
+def fit_from_prior(prior, points, bgr_img, refine_iters_max=3, max_err=2, min_inlier_ratio=prior_min_inlier_ratio):
+    
+    """ Refines a predicted ellipse (e.g. last frame's) against points, in place of RANSAC
+    
+    Returns None when prediction no longer has the support or coverage to be trusted, so caller falls back to RANSAC
+    """
+    
+    if points.size == 0: return None
+    
+    try:
+        ellipse, _ = refine_ellipse(prior, points, bgr_img.shape[:2], refine_iters_max, max_err)
+    except (NotEnoughInliers, BadEllipseShape):
+        return None
+    
+    # Score final fit, not the one before it
+    inliers, _, coverage = score_ellipse(ellipse, points[:, 0], points[:, 1], max_err)
+    
+    if np.sum(inliers) < min_inlier_ratio * len(points): return None
+    if coverage < min_coverage: return None
+    
+    return ellipse
 
 
-def ransac_ellipse_fit(points, bgr_img, roi_pos, ransac_iters_max=50, refine_iters_max=3, max_err=2, debug=False):
+def ransac_ellipse_fit(points, bgr_img, roi_pos, ransac_iters_max=50, refine_iters_max=3, max_err=2, debug=False,
+                       stats=None):
+    
+    """ stats - optional RansacStats, left with iteration counts for caller
+    """
     
     if points.size == 0: raise NoEllipseFound()
     
+    if stats is None: stats = RansacStats(sample_size=6, iters_max=ransac_iters_max)
+    
     blurred_grey_img = cv2.blur(cv2.cvtColor(bgr_img, cv2.COLOR_BGR2GRAY), (3, 3))
     
     image_dx = cv2.Sobel(blurred_grey_img, ddepth=cv2.CV_32F, dx=1, dy=0, ksize=5)
@@ -86,6 +128,9 @@ def ransac_ellipse_fit(points, bgr_img, roi_pos, ransac_iters_max=50, refine_ite
     pts_x, pts_y = np.split(points, 2, axis=1)
     pts_x, pts_y = np.squeeze(pts_x), np.squeeze(pts_y)
     
+    # Image gradients at every point, looked up once rather than per hypothesis
+    pts_dx, pts_dy = get_image_grads_at(image_dx, image_dy, pts_x, pts_y) if image_aware_support else (None, None)
+    
     if debug:
         img_points = np.copy(bgr_img)
         draw_points(img_points, points, (0, 0, 255), 1, 2)
@@ -94,7 +139,7 @@ def ransac_ellipse_fit(points, bgr_img, roi_pos, ransac_iters_max=50, refine_ite
     
     best_ellipse = None
     best_support = float('-inf')
-    best_inliers = None
+    best_coverage = 0
 
     # Points on right and left of predicted pupil location (center of ROI-img)
     r_inds, l_inds = np.squeeze([pts_x > (bgr_img.shape[1] / 2)]), np.squeeze([pts_x < (bgr_img.shape[1] / 2)])
@@ -107,8 +152,11 @@ def ransac_ellipse_fit(points, bgr_img, roi_pos, ransac_iters_max=50, refine_ite
     
     if len(points_r) < 3 or len(points_l) < 3:  raise NoEllipseFound()  
     
-    # Perform N RANSAC iterations
-    for ransac_iter in range(ransac_iters_max):
+    # Perform RANSAC iterations until enough for current inlier ratio, or max
+    while not stats.should_stop():
+        
+        ransac_iter = stats.iters
+        stats.add_iters()
         
         try:
         
@@ -128,11 +176,12 @@ def ransac_ellipse_fit(points, bgr_img, roi_pos, ransac_iters_max=50, refine_ite
             # Image-aware sample rejection
             for (p_x, p_y) in sample:
                 grad_x, grad_y = ellipse.algebraic_gradient_dir((p_x, p_y))
-                dx, dy = image_dx[p_y][p_x], image_dy[p_y][p_x]
+                dx, dy = image_dx[int(p_y)][int(p_x)], image_dy[int(p_y)][int(p_x)]
                 
                 # If sample and ellipse gradients don't agree, move to next set of samples
                 if dx * grad_x + dy * grad_y <= 0:
                     if debug: print 'Sample and ellipse gradients do not agree, reject'
+                    stats.add_iters(0, 1)
                     break
             
             else:   # Only continues for else-block did not break on above line (image-aware sample rejection)
@@ -140,13 +189,7 @@ def ransac_ellipse_fit(points, bgr_img, roi_pos, ransac_iters_max=50, refine_ite
                 # Iteratively refine inliers further
                 for _ in range(refine_iters_max):
                     
-                    pts_distances = ellipse.distances(pts_x, pts_y)
-                    inlier_inds = np.squeeze([np.abs(get_err_scale(ellipse) * pts_distances) < max_err])
-                    inliers = points[inlier_inds]
-                    
-                    if len(inliers) < 5: raise NotEnoughInliers()
-                    
-                    ellipse = fit_ellipse(inliers, bgr_img.shape[:2])
+                    ellipse, inliers = refine_ellipse(ellipse, points, bgr_img.shape[:2], 1, max_err)
                     
                     if debug:
                         img_refined = np.copy(bgr_img)
@@ -157,46 +200,34 @@ def ransac_ellipse_fit(points, bgr_img, roi_pos, ransac_iters_max=50, refine_ite
                         cv2.imshow(winname, img_refined)
                         cv2.waitKey()
                 
-                # Calculate the image aware support of the ellipse
-                if image_aware_support:
-                    
-                    inliers_pts_x, inliers_pts_y = np.split(inliers, 2, axis=1)
-                    inliers_pts_x, inliers_pts_y = np.squeeze(inliers_pts_x), np.squeeze(inliers_pts_y)
-                    
-                    # Ellipse gradients at inlier points
-                    grads_x, grads_y = ellipse.algebraic_gradient_dirs(inliers_pts_x, inliers_pts_y)
-                    
-                    # Image gradients at inlier points
-                    dxs = image_dx[inliers_pts_y.astype(int), inliers_pts_x.astype(int)]
-                    dys = image_dy[inliers_pts_y.astype(int), inliers_pts_x.astype(int)]
-                    
-                    support = np.sum(dxs.dot(grads_x) + dys.dot(grads_y))
-                        
-                else: support = len(inliers)
+                # Support (image aware when pts_dx, pts_dy given) and coverage of final fit, in one pass over points
+                inlier_inds, support, coverage = score_ellipse(ellipse, pts_x, pts_y, max_err, pts_dx, pts_dy)
+                inlier_ratio = np.sum(inlier_inds) / float(len(points))
                 
                 if support > best_support:
                     best_ellipse = ellipse
                     best_support = support
-                    best_inliers = inliers
+                    best_coverage = coverage
                 
-                # Early termination for > 95% inliers
-                print len(inliers) / float(len(points))
-                if len(inliers) / float(len(points)) > 0.95:
-                    print "Early Termination"
-                    break
+                # Terminates early once inlier ratio is high enough
+                stats.update(inlier_ratio)
+                if debug: print 'Inlier ratio: %0.2f' % inlier_ratio
                 
         except NotEnoughInliers:
             if debug: print 'Not Enough Inliers'
+            stats.add_iters(0, 1)
         
         except BadEllipseShape as e:
             if debug: print 'Bad Ellipse Shape: %s' % e.msg
+            stats.add_iters(0, 1)
+    
+    if debug: print 'Limbus RANSAC: %s' % stats.get_summary()
                 
     if best_ellipse == None:
         raise NoEllipseFound()
 
-    coverage = calculate_coverage(best_ellipse, best_inliers)
-    if coverage < min_coverage:
-        raise CoverageTooLow('Minimum inlier coverage: %d, actual coverage: %d' % (min_coverage, coverage))
+    if best_coverage < min_coverage:
+        raise CoverageTooLow('Minimum inlier coverage: %d, actual coverage: %d' % (min_coverage, best_coverage))
     
     if debug:
         img_bgr_img = np.copy(bgr_img)
@@ -205,3 +236,142 @@ def ransac_ellipse_fit(points, bgr_img, roi_pos, ransac_iters_max=50, refine_ite
         cv2.waitKey()
     
     return best_ellipse
+
+
+def ransac_ellipse_fit_batched(points, bgr_img, roi_pos, ransac_iters_max=50, refine_iters_max=3, max_err=2,
+                               debug=False, stats=None):
+    
+    """ ransac_ellipse_fit with hypotheses drawn, fitted (fit_ellipse_numpy.fit_ellipses), refined and scored in
+    batches of hyps_per_batch, rather than one cv2.fitEllipse round trip at a time
+    """
+    
+    if points.size == 0: raise NoEllipseFound()
+    
+    if stats is None: stats = RansacStats(sample_size=6, iters_max=ransac_iters_max)
+    
+    blurred_grey_img = cv2.blur(cv2.cvtColor(bgr_img, cv2.COLOR_BGR2GRAY), (3, 3))
+    
+    image_dx = cv2.Sobel(blurred_grey_img, ddepth=cv2.CV_32F, dx=1, dy=0, ksize=5)
+    image_dy = cv2.Sobel(blurred_grey_img, ddepth=cv2.CV_32F, dx=0, dy=1, ksize=5)
+    
+    points = np.asarray(points).reshape(-1, 2)
+    pts_x, pts_y = points[:, 0].astype(float), points[:, 1].astype(float)
+    pts_dx, pts_dy = get_image_grads_at(image_dx, image_dy, pts_x, pts_y)
+    
+    # Points on right and left of predicted pupil location (center of ROI-img)
+    r_inds, l_inds = np.flatnonzero(pts_x > bgr_img.shape[1] / 2), np.flatnonzero(pts_x < bgr_img.shape[1] / 2)
+    if len(r_inds) < 3 or len(l_inds) < 3: raise NoEllipseFound()
+    
+    img_shape = bgr_img.shape[:2]
+    best_ellipse, best_support, best_coverage = None, float('-inf'), 0
+    
+    while not stats.should_stop():
+        
+        num_hyps = min(hyps_per_batch, stats.get_iters_left())
+        
+        # 3 distinct points from each side per hypothesis
+        sample_inds = np.column_stack([r_inds[np.argsort(np.random.rand(num_hyps, len(r_inds)), axis=1)[:, :3]],
+                                       l_inds[np.argsort(np.random.rand(num_hyps, len(l_inds)), axis=1)[:, :3]]])
+        
+        coeffs, rects, valid = fit_ellipses(points[sample_inds])
+        valid &= check_shapes(rects, img_shape)
+        
+        # Image-aware sample rejection: image gradients at every sample point must agree with ellipse's normals
+        _, dirs_x, dirs_y = get_sampson_distances(coeffs, pts_x[sample_inds], pts_y[sample_inds])
+        valid &= np.all(pts_dx[sample_inds] * dirs_x + pts_dy[sample_inds] * dirs_y > 0, axis=1)
+        
+        # Only hypotheses passing so far are refined
+        stats.add_iters(num_hyps, np.sum(~valid))
+        coeffs, rects, valid = coeffs[valid], rects[valid], valid[valid]
+        if not np.any(valid): continue
+        
+        # Iteratively refine inliers further, hypotheses with too few inliers or bad shapes are dropped
+        all_points = np.broadcast_to(points, (len(valid),) + points.shape)
+        for _ in range(refine_iters_max):
+            
+            inlier_masks = get_sampson_distances(coeffs, pts_x, pts_y)[0] < max_err
+            valid &= inlier_masks.sum(axis=1) >= 5
+            
+            refined_coeffs, refined_rects, refined_ok = fit_ellipses(all_points, inlier_masks)
+            valid &= refined_ok & check_shapes(refined_rects, img_shape)
+            coeffs = np.where(valid[:, np.newaxis], refined_coeffs, coeffs)
+            rects = np.where(valid[:, np.newaxis], refined_rects, rects)
+        
+        stats.add_iters(0, np.sum(~valid))
+        if not np.any(valid): continue
+        
+        # Support of final fits, image aware as in ransac_ellipse_fit
+        dists, dirs_x, dirs_y = get_sampson_distances(coeffs, pts_x, pts_y)
+        inlier_masks = (dists < max_err) & valid[:, np.newaxis]
+        if image_aware_support:
+            supports = np.sum(np.where(inlier_masks, pts_dx * dirs_x + pts_dy * dirs_y, 0), axis=1)
+        else:
+            supports = inlier_masks.sum(axis=1)
+        supports = np.where(valid, supports, float('-inf'))
+        
+        best_ind = np.argmax(supports)
+        if supports[best_ind] > best_support:
+            best_ellipse = EllipseBatch(rects, coeffs)[best_ind]
+            best_support = supports[best_ind]
+            best_coverage = get_coverage(rects[best_ind, 0], rects[best_ind, 1],
+                                         pts_x[inlier_masks[best_ind]], pts_y[inlier_masks[best_ind]])
+        
+        # Terminates early once inlier ratio is high enough
+        stats.update(inlier_masks.sum(axis=1).max() / float(len(points)))
+    
+    if debug: print 'Limbus RANSAC (batched): %s' % stats.get_summary()
+    
+    if best_ellipse == None:
+        raise NoEllipseFound()
+    
+    if best_coverage < min_coverage:
+        raise CoverageTooLow('Minimum inlier coverage: %d, actual coverage: %d' % (min_coverage, best_coverage))
+    
+    return best_ellipse
+
+
+#----------------------------------------
+# EXAMPLE USAGE
+#----------------------------------------
+if __name__ == '__main__':
+    
+    import glob
+    from find_limbus_points import get_limb_pts
+    from time import time
+    
+    eye_imgs = []
+    for path in sorted(glob.glob('eye_images/*.png')):
+        eye_img = cv2.imread(path)
+        img_h, img_w = eye_img.shape[:2]
+        eye_imgs.append(np.ascontiguousarray(eye_img[:, (img_w - img_h) / 2:(img_w + img_h) / 2]))
+    
+    limb_pts = [get_limb_pts(eye_img, phi=20, angle_step=1) for eye_img in eye_imgs]
+    
+    def fit_all(fit, seed, iters):
+        
+        random.seed(seed)
+        np.random.seed(seed)
+        centres = []
+        for eye_img, pts in zip(eye_imgs, limb_pts):
+            try:
+                centres.append(fit(pts, eye_img, (0, 0), iters, 3, 3).rotated_rect[0])
+            except (NoEllipseFound, CoverageTooLow):
+                centres.append(None)
+        return centres
+    
+    # 5 iterations as GazeSystem runs it, and more where batching amortizes better
+    for iters in [5, 50]:
+        results = {}
+        for name, fit, seed in [('cv2.fitEllipse', ransac_ellipse_fit, 0), ('batched', ransac_ellipse_fit_batched, 0),
+                                ('cv2.fitEllipse, reseeded', ransac_ellipse_fit, 1)]:
+            tick = time()
+            results[name] = fit_all(fit, seed, iters)
+            ms = (time() - tick) * 1000 / len(eye_imgs)
+            if name != 'cv2.fitEllipse, reseeded':
+                print '%d iters, %s: %0.2f ms per eye, %d fits' % (iters, name, ms, sum(c is not None for c in results[name]))
+        
+        for name in ['batched', 'cv2.fitEllipse, reseeded']:
+            dists = [np.hypot(c1[0] - c2[0], c1[1] - c2[1]) for (c1, c2) in zip(results['cv2.fitEllipse'], results[name])
+                     if c1 and c2]
+            print '  Limbus centre, %s vs cv2.fitEllipse (px) - median: %0.2f, 90th percentile: %0.2f' % (
+                name, np.median(dists), np.percentile(dists, 90))
@@ -1,5 +1,10 @@
 import numpy as np
-import random
+
+from ransac_stats import RansacStats
+
+max_line_slope = 0.5                # Steeper lower eyelids are rejected
+hyps_per_batch = 8                  # Hypotheses drawn at once, between checks for adaptive termination
+__lower_eyelid_inliers_min = 30
 
 
 class BadFitShape(Exception):
@@ -7,110 +12,219 @@ class BadFitShape(Exception):
 
 
 def fit_line(xs, ys):
-    
+
     a, b = np.polyfit(np.array(xs), np.array(ys), 1)
 
-    if abs(a) > 0.5: raise BadFitShape()
+    if abs(a) > max_line_slope: raise BadFitShape()
     return a, b
 
 
 def fit_parabola(xs, ys):
-    
+
     a, b, c = np.polyfit(xs, ys, 2)
 
     if a < 0: raise BadFitShape()
     return a, b, c
 
 
+def fit_parabolas_3pt(xs, ys):
+
+    """ Closed-form parabolas through 3 points each, xs & ys ~ (H, 3) arrays. Returns (H, 3) [a, b, c] and validity
+    """
+
+    x1, x2, x3 = xs.T.astype(float)
+    y1, y2, y3 = ys.T.astype(float)
+
+    denom = (x1 - x2) * (x1 - x3) * (x2 - x3)
+    valid = denom != 0
+    denom[~valid] = 1
+
+    a = (x3 * (y2 - y1) + x2 * (y1 - y3) + x1 * (y3 - y2)) / denom
+    b = (x3 ** 2 * (y1 - y2) + x2 ** 2 * (y3 - y1) + x1 ** 2 * (y2 - y3)) / denom
+    c = (x2 * x3 * (x2 - x3) * y1 + x3 * x1 * (x3 - x1) * y2 + x1 * x2 * (x1 - x2) * y3) / denom
+
+    return np.column_stack([a, b, c]), valid
+
+
+def fit_polys_masked(pts_x, pts_y, masks, degree):
+
+    """ Least-squares polynomials (highest power first, like np.polyfit) through the points selected by each row
+    of masks ~ (H, N). Returns (H, degree + 1) coeffs and validity (False where system is singular)
+    """
+
+    # Singular unless there are more distinct xs than the degree
+    unique_xs, unique_inds = np.unique(pts_x, return_inverse=True)
+    unique_hits = np.zeros((len(masks), len(unique_xs)), dtype=bool)
+    for i in range(len(masks)): unique_hits[i, unique_inds[masks[i]]] = True
+    valid = unique_hits.sum(axis=1) > degree
+
+    # Scale xs for better conditioned normal equations
+    x_scale = float(max(np.abs(pts_x).max(), 1))
+    powers = np.vander(pts_x / x_scale, degree + 1)                         # (N, degree + 1)
+    weights = masks.astype(float)
+
+    # Normal equations for all hypotheses at once
+    lhs = np.einsum('hn,ni,nj->hij', weights, powers, powers)
+    rhs = np.einsum('hn,ni,n->hi', weights, powers, pts_y.astype(float))
+    lhs[~valid] = np.eye(degree + 1)
+
+    coeffs = np.linalg.solve(lhs, rhs[..., np.newaxis])[..., 0]
+    return coeffs / x_scale ** np.arange(degree, -1, -1), valid
+
+
+def get_residuals(coeffs, pts_x, pts_y):
+
+    """ Absolute vertical distance of every point from every polynomial, ~ (H, N)
+    """
+
+    powers = np.vander(pts_x.astype(float), coeffs.shape[1])
+    return np.abs(pts_y[np.newaxis, :] - coeffs.dot(powers.T))
+
+
+def ransac_poly(pts_x, pts_y, hyp_coeffs, hyp_valid, refine_iters_max, max_err, min_inliers, check_shape):
+
+    """ Refines and scores a batch of hypotheses together, returns (best coeffs or None, best number of inliers)
+    """
+
+    degree = hyp_coeffs.shape[1] - 1
+    coeffs, valid = hyp_coeffs, hyp_valid & check_shape(hyp_coeffs)
+
+    # Iteratively refine inliers further
+    for _ in range(refine_iters_max):
+
+        inlier_masks = get_residuals(coeffs, pts_x, pts_y) < max_err
+        enough_inliers = valid & (inlier_masks.sum(axis=1) >= min_inliers)
+
+        refined_coeffs, refined_ok = fit_polys_masked(pts_x, pts_y, inlier_masks, degree)
+        refined_ok &= enough_inliers
+
+        # Bad refinements discard the hypothesis, too few inliers just stops refining it
+        valid &= ~refined_ok | check_shape(refined_coeffs)
+        coeffs = np.where((refined_ok & valid)[:, np.newaxis], refined_coeffs, coeffs)
+
+    supports = np.where(valid, (get_residuals(coeffs, pts_x, pts_y) < max_err).sum(axis=1), -1)
+    if not np.any(valid): return None, 0
+
+    best_ind = np.argmax(supports)
+    return tuple(coeffs[best_ind]), supports[best_ind]
+
+
 def ransac_parabola(points_l, points_r, ransac_iters_max=5, refine_iters_max=2, max_err=2, debug=False):
-    
+
+    """ Upper eyelid a(x^2) + b(x) + c through points on both sides of eye, hypotheses are drawn and scored in batches
+    """
+
     if len(points_l) < 3 or len(points_r) < 3: return None
-    
+
+    points_l, points_r = np.asarray(points_l), np.asarray(points_r)
     points = np.concatenate([points_l, points_r])
-    pts_x, pts_y = np.split(points, 2, axis=1)
-    pts_x, pts_y = np.squeeze(pts_x), np.squeeze(pts_y)
-    
-    best_parabola = None
-    best_support = float('-inf')
-
-    # Not enough points to start process
-    if len(points_r) < 3 or len(points_l) < 3: return None
-    
-    # Perform N RANSAC iterations
-    for _ in range(ransac_iters_max):
-        
-        try:
-            sample = random.sample(points_r, 3) + (random.sample(points_l, 3))
-            sample_xs, sample_ys = [x for (x, _) in sample], [y for (_, y) in sample]
-            a, b, c = fit_parabola(sample_xs, sample_ys)
-            
-            # Iteratively refine inliers further
-            for _ in range(refine_iters_max):
-                
-                pts_parabola_y = a * pts_x ** 2 + b * pts_x + c
-                inlier_inds = np.squeeze([np.abs(pts_y - pts_parabola_y) < max_err])
-                inliers = points[inlier_inds]
-                
-                if inliers.size < 5: break
-                a, b, c = fit_parabola(pts_x[inlier_inds], pts_y[inlier_inds])
-    
-            support = len(inliers)
-            
-            if support > best_support:
-                best_parabola = (a, b, c)
-                best_support = support
-                
-        except BadFitShape: continue 
-            
-        # Early termination for > 90% inliers
-        if len(inliers) / len(points) > 0.90: break
+    pts_x, pts_y = points[:, 0], points[:, 1]
 
-    return best_parabola
+    stats = RansacStats(sample_size=3, iters_max=ransac_iters_max, early_stop_ratio=0.9)
+    best_parabola, best_support = None, 0
 
+    while not stats.should_stop():
+
+        # One point from each side and one from anywhere, so hypotheses span the eye
+        num_hyps = min(hyps_per_batch, stats.get_iters_left())
+        sample_inds = np.column_stack([np.random.randint(len(points_l), size=num_hyps),
+                                       len(points_l) + np.random.randint(len(points_r), size=num_hyps),
+                                       np.random.randint(len(points), size=num_hyps)])
+        hyp_coeffs, hyp_valid = fit_parabolas_3pt(pts_x[sample_inds], pts_y[sample_inds])
+
+        parabola, support = ransac_poly(pts_x, pts_y, hyp_coeffs, hyp_valid, refine_iters_max, max_err,
+                                        min_inliers=5, check_shape=lambda coeffs : coeffs[:, 0] >= 0)
+        stats.add_iters(num_hyps, np.sum(~hyp_valid))
+
+        if parabola is not None and support > best_support:
+            best_parabola, best_support = parabola, support
+            stats.update(support / float(len(points)))
+
+    if debug: print 'Upper eyelid RANSAC: %s' % stats.get_summary()
+    return best_parabola
 
-__lower_eyelid_inliers_min = 30
 
 def ransac_line(points, ransac_iters_max=5, refine_iters_max=2, max_err=2, debug=False):
-    
+
+    """ Lower eyelid a(x) + b, hypotheses are least-squares lines through 3 points, drawn and scored in batches
+    """
+
     if len(points) < __lower_eyelid_inliers_min: return None
-    
-    pts_x, pts_y = np.split(points, 2, axis=1)
-    pts_x, pts_y = np.squeeze(pts_x), np.squeeze(pts_y)
-    
-    best_line = None
-    best_support = float('-inf')
-
-    # Not enough points to start process
-    if len(points) < __lower_eyelid_inliers_min : return None
-    
-    # Perform N RANSAC iterations
-    for _ in range(ransac_iters_max):
-        
-        try:
-            sample = random.sample(points, 3)
-            sample_xs, sample_ys = [x for (x, _) in sample], [y for (_, y) in sample]
-            a, b = fit_line(sample_xs, sample_ys)
-            
-            # Iteratively refine inliers further
-            for _ in range(refine_iters_max):
-                
-                pts_line_y = a * pts_x + b
-                inlier_inds = np.squeeze([np.abs(pts_y - pts_line_y) < max_err])
-                inliers = points[inlier_inds]
-                
-                if len(inliers) < 3: break
-                
-                a, b = fit_line(pts_x[inlier_inds], pts_y[inlier_inds])
-    
-            support = len(inliers)
-            
-            if len(inliers) > __lower_eyelid_inliers_min and support > best_support:
-                best_line = (a, b)
-                best_support = support
-                
-        except BadFitShape: continue 
-            
-        # Early termination for > 90% inliers
-        if len(inliers) / len(points) > 0.90: break
 
+    points = np.asarray(points)
+    pts_x, pts_y = points[:, 0], points[:, 1]
+
+    stats = RansacStats(sample_size=3, iters_max=ransac_iters_max, early_stop_ratio=0.9)
+    best_line, best_support = None, __lower_eyelid_inliers_min
+
+    while not stats.should_stop():
+
+        num_hyps = min(hyps_per_batch, stats.get_iters_left())
+        sample_inds = np.random.randint(len(points), size=(num_hyps, 3))
+
+        # Closed-form least-squares line through each sample of 3
+        sample_xs, sample_ys = pts_x[sample_inds].astype(float), pts_y[sample_inds].astype(float)
+        dxs = sample_xs - sample_xs.mean(axis=1)[:, np.newaxis]
+        dys = sample_ys - sample_ys.mean(axis=1)[:, np.newaxis]
+        var_xs = np.sum(dxs ** 2, axis=1)
+        hyp_valid = var_xs > 0
+        slopes = np.sum(dxs * dys, axis=1) / np.where(hyp_valid, var_xs, 1)
+        hyp_coeffs = np.column_stack([slopes, sample_ys.mean(axis=1) - slopes * sample_xs.mean(axis=1)])
+
+        line, support = ransac_poly(pts_x, pts_y, hyp_coeffs, hyp_valid, refine_iters_max, max_err,
+                                    min_inliers=3, check_shape=lambda coeffs : np.abs(coeffs[:, 0]) <= max_line_slope)
+        stats.add_iters(num_hyps, np.sum(~hyp_valid))
+
+        if line is not None and support > best_support:
+            best_line, best_support = line, support
+            stats.update(support / float(len(points)))
+
+    if debug: print 'Lower eyelid RANSAC: %s' % stats.get_summary()
     return best_line
+
+
+#----------------------------------------
+# EXAMPLE USAGE
+#----------------------------------------
+if __name__ == '__main__':
+
+    import random
+    from time import time
+
+    # Reference version: one np.polyfit per hypothesis and refinement
+    def ransac_parabola_reference(points_l, points_r, ransac_iters_max=5, refine_iters_max=2, max_err=2):
+
+        points = np.concatenate([points_l, points_r])
+        pts_x, pts_y = points[:, 0], points[:, 1]
+        best_parabola, best_support = None, float('-inf')
+
+        for _ in range(ransac_iters_max):
+            try:
+                sample = np.array(random.sample(list(points_r), 3) + random.sample(list(points_l), 3))
+                a, b, c = fit_parabola(sample[:, 0], sample[:, 1])
+                for _ in range(refine_iters_max):
+                    inlier_inds = np.abs(pts_y - (a * pts_x ** 2 + b * pts_x + c)) < max_err
+                    if np.sum(inlier_inds) < 5: break
+                    a, b, c = fit_parabola(pts_x[inlier_inds], pts_y[inlier_inds])
+                support = np.sum(np.abs(pts_y - (a * pts_x ** 2 + b * pts_x + c)) < max_err)
+                if support > best_support: best_parabola, best_support = (a, b, c), support
+            except BadFitShape: continue
+
+        return best_parabola
+
+    # Synthetic upper eyelid with noise and 30% outliers
+    true_a, true_b, true_c = 0.01, -2.0, 130.0
+    xs = np.arange(0, 200, 2)
+    ys = true_a * xs ** 2 + true_b * xs + true_c + np.random.normal(0, 1, len(xs))
+    outlier_inds = np.random.rand(len(xs)) < 0.3
+    ys[outlier_inds] = np.random.uniform(0, 100, np.sum(outlier_inds))
+    points = np.column_stack([xs, ys])
+    points_l, points_r = points[xs < 100], points[xs > 100]
+
+    num_iters = 200
+    for name, fit in [('reference', ransac_parabola_reference), ('batched', ransac_parabola)]:
+        tick, errs = time(), []
+        for _ in range(num_iters):
+            a, b, c = fit(points_l, points_r, ransac_iters_max=20)
+            errs.append(np.abs((a * xs ** 2 + b * xs + c) - (true_a * xs ** 2 + true_b * xs + true_c)).mean())
+        print '%s: %0.2f ms, mean error %0.2f px' % (name, (time() - tick) * 1000 / num_iters, np.mean(errs))
@@ -0,0 +1,56 @@
+from math import log, ceil
+
+
+class RansacStats:
+
+    def __init__(self, sample_size, iters_max, confidence=0.99, early_stop_ratio=0.95):
+
+        """ Iteration and inlier bookkeeping shared by the RANSAC fitters, with adaptive termination
+
+        sample_size - number of points in each hypothesis
+        confidence - stop once an all-inlier sample has been drawn with this probability
+        early_stop_ratio - also stop as soon as a hypothesis explains this fraction of points
+        """
+
+        self.sample_size = sample_size
+        self.iters_max = iters_max
+        self.confidence = confidence
+        self.early_stop_ratio = early_stop_ratio
+
+        self.iters = 0              # hypotheses drawn so far
+        self.rejected = 0           # hypotheses rejected before scoring (bad shape, disagreeing gradients ...)
+        self.best_inlier_ratio = 0.0
+
+    def add_iters(self, num_iters=1, num_rejected=0):
+
+        self.iters += num_iters
+        self.rejected += num_rejected
+
+    def update(self, inlier_ratio):
+
+        self.best_inlier_ratio = max(self.best_inlier_ratio, inlier_ratio)
+
+    def get_iters_needed(self):
+
+        """ Standard estimate of hypotheses needed to draw one all-inlier sample, from best inlier ratio so far
+        """
+
+        all_inlier_prob = self.best_inlier_ratio ** self.sample_size
+        if all_inlier_prob <= 0: return self.iters_max
+        if all_inlier_prob >= 1: return 1
+
+        return min(self.iters_max, int(ceil(log(1 - self.confidence) / log(1 - all_inlier_prob))))
+
+    def get_iters_left(self):
+        return max(0, self.get_iters_needed() - self.iters)
+
+    def should_stop(self):
+
+        return (self.iters >= self.iters_max or
+                self.best_inlier_ratio > self.early_stop_ratio or
+                self.iters >= self.get_iters_needed())
+
+    def get_summary(self):
+
+        return '%d/%d iters (%d rejected), best inlier ratio: %0.2f' % (self.iters, self.iters_max, self.rejected,
+                                                                        self.best_inlier_ratio)
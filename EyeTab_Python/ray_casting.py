@@ -1,4 +1,5 @@
-import cv2, numpy as np
+import cv2, numpy as np, fast_kernels
+import find_limbus_points
 
 from math import sin, cos, radians
 from draw_utils import draw_cross, draw_points
@@ -6,6 +7,10 @@ from image_utils import stack_imgs_vertical
 
 winname = 'Ray Casting'
 
+# Radii for get_limb_pts_rays are polar px of the fixed-size img, as for get_limb_pts, so bands are interchangeable
+__fixed_width = find_limbus_points.__fixed_width
+__limb_r_range = (find_limbus_points.__min_limb_r, find_limbus_points.__max_limb_r)
+
 class NoLimbusFound(Exception):
     pass
 
@@ -20,16 +25,27 @@ class RayCaster:
     def get_intensity(self, (b, g, r)):
         return int(b / 2 + g / 2)
     
+    def get_intensity_img(self, bgr_img):
+        
+        """ get_intensity of every pixel
+        """
+        
+        b, g, _ = cv2.split(bgr_img)
+        return (b / 2).astype(np.int32) + g / 2
+    
     def cast_rays_spread(self, bgr_img, start_pos, angle_mean, spread, limb_r_range, step_angle=2):
         
-        (x0, y0) = start_pos
-        (min_limb_r, max_limb_r) = limb_r_range
+        """ ray_sample along every ray of spread at once (fast_kernels.sample_rays)
+        """
+        
+        if bgr_img is None: raise NoLimbusFound
         
-        points_found_in_spread = set()
-        for tht in range(angle_mean - spread / 2, angle_mean + spread / 2, step_angle):
-            points_found_in_spread.add(self.ray_sample(bgr_img, radians(tht), (x0, y0), min_limb_r, max_limb_r))
+        (min_limb_r, max_limb_r) = limb_r_range
+        angles = np.radians(range(angle_mean - spread / 2, angle_mean + spread / 2, step_angle))
         
-        return points_found_in_spread
+        pts = fast_kernels.sample_rays(self.get_intensity_img(bgr_img), start_pos, angles, min_limb_r, max_limb_r,
+                                       kernel=self.kernel)
+        return set((x, y) for (x, y) in pts.tolist())
     
     
     def ray_sample(self, bgr_img, angle, (x0, y0), ray_start, ray_end, step_ray=1):
@@ -47,7 +63,7 @@ class RayCaster:
         for i in range(len_to_travel / step_ray):
             x_sample, y_sample = x0_off + dx * i, y0_off + dy * i
             if not(0 < x_sample < img_w) or not(0 < y_sample < img_h): break
-            sample_list.append(self.get_intensity(bgr_img[y_sample][x_sample]))
+            sample_list.append(self.get_intensity(bgr_img[int(y_sample)][int(x_sample)]))
         
         conv = np.convolve(sample_list, self.kernel, 'valid')
         
@@ -94,3 +110,106 @@ class RayCaster:
         
         return pts_found
 
+
+def get_fan_angles(phi, angle_step):
+    
+    """ Degrees of rays from ROI centre, one per angle_step bar those too close to lids, the polar columns
+    find_limbus_points.get_limb_pts keeps: [90 - phi, 90 + phi) & [270 - phi, 270 + phi) are left out
+    """
+    
+    cols = np.arange(360 / angle_step)
+    near_lids = (((90 - phi) / angle_step <= cols) & (cols < (90 + phi) / angle_step) |
+                 ((270 - phi) / angle_step <= cols) & (cols < (270 + phi) / angle_step))
+    return cols[~near_lids] * angle_step
+
+
+#                     eye_img - bgr img of eye ROI
+#                     |        phi - angle to ignore at extreme ranges (close to 90 or 270)
+#                     |        |       angles considered = 360 / angle_step
+#                     |        |       |                 r_range - (min, max) polar radii to search, see get_limb_r_range
+#                     |        |       |                 |
+def get_limb_pts_rays(eye_img, phi=20, angle_step=1, debug_index=False, r_range=None, kernel=(1, 2, 0, -2, -1)):
+    
+    """ Drop-in for find_limbus_points.get_limb_pts: strongest dark-to-light step along each ray of a fan cast from
+    ROI centre (fast_kernels.sample_rays), sampled once per polar px between radii
+    """
+    
+    min_limb_r, max_limb_r = __limb_r_range if r_range is None else r_range
+    scale = eye_img.shape[0] / float(__fixed_width)
+    
+    blurred_img = cv2.GaussianBlur(eye_img, (5, 5), 5)
+    intensity_img = RayCaster().get_intensity_img(blurred_img)
+    
+    img_h, img_w = eye_img.shape[:2]
+    pts, responses = fast_kernels.sample_rays(intensity_img, (img_w / 2.0, img_h / 2.0),
+                                              np.radians(get_fan_angles(phi, angle_step)), min_limb_r * scale,
+                                              max_limb_r * scale, step_ray=scale, kernel=kernel, with_responses=True)
+    
+    # Rays without any rising edge (iris to sclera) give no point, like empty polar columns in get_limb_pts
+    pts_cart = pts[responses > 0].astype(float)
+    
+    # --------------------- Debug Drawing ---------------------
+    if debug_index != False:
+        debug_img = blurred_img.copy()
+        cv2.circle(debug_img, (debug_img.shape[1] / 2, debug_img.shape[0] / 2), int(min_limb_r * scale), (255, 255, 0))
+        cv2.circle(debug_img, (debug_img.shape[1] / 2, debug_img.shape[0] / 2), int(max_limb_r * scale), (255, 255, 0))
+        draw_points(debug_img, pts_cart, (0, 0, 255), width=1)
+        if debug_index > 1:
+            cv2.imshow(winname, np.concatenate([eye_img, debug_img], axis=1))
+    # --------------------- Debug Drawing ---------------------
+    
+    return pts_cart
+
+
+#----------------------------------------
+# EXAMPLE USAGE
+#----------------------------------------
+if __name__ == '__main__':
+    
+    import glob
+    import random
+    import ransac_ellipse
+    from find_limbus_points import get_limb_pts
+    from time import time
+    
+    eye_imgs = []
+    for path in sorted(glob.glob('eye_images/*.png')):
+        eye_img = cv2.imread(path)
+        img_h, img_w = eye_img.shape[:2]
+        eye_imgs.append(np.ascontiguousarray(eye_img[:, (img_w - img_h) / 2:(img_w + img_h) / 2]))
+    
+    num_iters = 10
+    detectors = [('get_limb_pts (polar Gabor)', get_limb_pts), ('get_limb_pts_rays', get_limb_pts_rays)]
+    
+    results = {}
+    for (name, detector) in detectors:
+        tick = time()
+        for _ in range(num_iters):
+            pts = [detector(eye_img, phi=20, angle_step=1) for eye_img in eye_imgs]
+        ms = (time() - tick) * 1000 / (num_iters * len(eye_imgs))
+        
+        # Same RANSAC settings as GazeSystem on each detector's points
+        random.seed(0)
+        centres = []
+        for (eye_img, eye_pts) in zip(eye_imgs, pts):
+            try:
+                ellipse = ransac_ellipse.ransac_ellipse_fit(eye_pts, eye_img, (0, 0), 5, 3, 3)
+                centres.append(ellipse.rotated_rect[0])
+            except (ransac_ellipse.NoEllipseFound, ransac_ellipse.CoverageTooLow):
+                centres.append(None)
+        results[name] = centres
+        
+        print '%s: %0.2f ms per ROI, %0.0f points per ROI, %d/%d limbus fits' % (
+            name, ms, np.mean([len(p) for p in pts]), sum(c is not None for c in centres), len(eye_imgs))
+    
+    # Narrow band, as when warm-started from the previous frame
+    for (name, detector) in detectors:
+        tick = time()
+        for _ in range(num_iters):
+            for eye_img in eye_imgs: detector(eye_img, phi=20, angle_step=1, r_range=(90, 120))
+        print '%s, narrow band: %0.2f ms per ROI' % (name, (time() - tick) * 1000 / (num_iters * len(eye_imgs)))
+    
+    dists = [np.hypot(c1[0] - c2[0], c1[1] - c2[1]) for (c1, c2) in zip(*[results[name] for (name, _) in detectors])
+             if c1 and c2]
+    print 'Limbus centre, rays vs polar (px) - median: %0.2f, 90th percentile: %0.2f' % (np.median(dists),
+                                                                                        np.percentile(dists, 90))
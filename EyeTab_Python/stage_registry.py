@@ -0,0 +1,291 @@
+import random
+import numpy as np
+
+import pre_processing
+import eye_center_locator_combined
+import eyelid_locator
+import ransac_ellipse
+import ray_casting
+
+from find_limbus_points import get_limb_pts
+from time import time
+
+# Per-eye stages of GazeSystem.get_gaze_from_frame in order, each backend is called like the stage's reference:
+#
+#   specular    f(eye_img, debug=False)                                 -> eye_img
+#   pupil       f(eye_img, fast_width_grads, fast_width_iso, debug_index=False) -> (x0, y0, confidence)
+#   eyelids     f(eye_img, debug_index)                                 -> (u_eyelid, l_eyelid)
+#   limbus_pts  f(eye_img, phi, angle_step, debug_index, r_range)       -> (N, 2) pts
+#   ellipse     f(points, bgr_img, roi_pos, ransac_iters_max, refine_iters_max, max_err, debug, stats) -> Ellipse
+stages = ['specular', 'pupil', 'eyelids', 'limbus_pts', 'ellipse']
+
+__backends = dict((stage, {}) for stage in stages)
+__references = {}
+__deltas = {}
+
+
+class UnknownBackend(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+
+def register(stage, name, func, reference=False):
+
+    """ Adds func as backend name of stage, the reference is what candidates are compared against
+    """
+
+    if stage not in __backends: raise UnknownBackend('No stage %s' % stage)
+
+    __backends[stage][name] = func
+    if reference: __references[stage] = name
+
+
+def register_delta(stage, delta):
+
+    """ delta(ref_output, candidate_output, args) ~ scalar difference (px) between two backends' outputs
+    """
+
+    __deltas[stage] = delta
+
+
+def get_backend_names(stage):
+    return sorted(__backends[stage].keys())
+
+
+def get_reference_name(stage):
+    return __references[stage]
+
+
+def get_backend(stage, name=None):
+
+    """ Backend name of stage, or its reference if name is None
+    """
+
+    if stage not in __backends: raise UnknownBackend('No stage %s' % stage)
+    if name is None: name = __references[stage]
+
+    if name not in __backends[stage]:
+        raise UnknownBackend('No %s backend %s, choose from %s' % (stage, name, get_backend_names(stage)))
+    return __backends[stage][name]
+
+
+def get_backends(config=None):
+
+    """ {stage: backend} for every stage, config ~ {stage: backend name} overrides the references
+    """
+
+    config = config or {}
+    for stage in config:
+        if stage not in __backends: raise UnknownBackend('No stage %s' % stage)
+
+    return dict((stage, get_backend(stage, config.get(stage))) for stage in stages)
+
+
+def get_backend_config(config=None):
+
+    """ {stage: backend name} for every stage, with references filled in where config has none
+    """
+
+    config = config or {}
+    return dict((stage, config.get(stage) or get_reference_name(stage)) for stage in stages)
+
+
+# --------------------- Output Deltas ---------------------
+
+def get_img_delta(ref_img, img, args):
+
+    """ Mean absolute pixel difference
+    """
+
+    return np.mean(np.abs(ref_img.astype(float) - img))
+
+
+def get_pupil_delta(ref_pupil, pupil, args):
+    return np.hypot(ref_pupil[0] - pupil[0], ref_pupil[1] - pupil[1])
+
+
+def get_eyelids_delta(ref_eyelids, eyelids, args):
+
+    """ Mean vertical distance (px) between eyelid curves across the ROI, inf if only one backend found a lid
+    """
+
+    xs = np.arange(args[0].shape[1])
+    dists = []
+    for ref_coeffs, coeffs in zip(ref_eyelids, eyelids):
+        if ref_coeffs is None and coeffs is None: continue
+        if ref_coeffs is None or coeffs is None: return np.inf
+        dists.append(np.mean(np.abs(np.polyval(ref_coeffs, xs) - np.polyval(coeffs, xs))))
+
+    return np.mean(dists) if dists else 0.0
+
+
+def get_pts_delta(ref_pts, pts, args):
+
+    """ Median distance (px) from each point to the nearest reference point
+    """
+
+    if len(ref_pts) == 0 or len(pts) == 0: return 0.0 if len(ref_pts) == len(pts) else np.inf
+
+    dists = np.hypot(pts[:, 0, np.newaxis] - ref_pts[:, 0], pts[:, 1, np.newaxis] - ref_pts[:, 1])
+    return np.median(np.min(dists, axis=1))
+
+
+def get_ellipse_delta(ref_ellipse, ellipse, args):
+
+    """ Distance (px) between centres, inf if only one backend found an ellipse
+    """
+
+    if ref_ellipse is None or ellipse is None: return 0.0 if ref_ellipse is ellipse else np.inf
+
+    (ref_x0, ref_y0), (x0, y0) = ref_ellipse.rotated_rect[0], ellipse.rotated_rect[0]
+    return np.hypot(ref_x0 - x0, ref_y0 - y0)
+
+
+# --------------------- Backends ---------------------
+
+# Specular removal modes keep their own PreProcessor, bound methods share erase_specular's signature
+__specular_telea = pre_processing.PreProcessor(pre_processing.TELEA)
+__specular_fast = pre_processing.PreProcessor(pre_processing.FAST)
+
+register('specular', 'telea', __specular_telea.erase_specular, reference=True)
+register('specular', 'fast', __specular_fast.erase_specular)
+register_delta('specular', get_img_delta)
+
+register('pupil', 'fused', eye_center_locator_combined.find_pupil_fused, reference=True)
+register_delta('pupil', get_pupil_delta)
+
+register('eyelids', 'gabor_ransac', eyelid_locator.find_eyelids, reference=True)
+register_delta('eyelids', get_eyelids_delta)
+
+register('limbus_pts', 'polar_gabor', get_limb_pts, reference=True)
+register('limbus_pts', 'rays', ray_casting.get_limb_pts_rays)
+register_delta('limbus_pts', get_pts_delta)
+
+register('ellipse', 'ransac', ransac_ellipse.ransac_ellipse_fit, reference=True)
+register('ellipse', 'batched', ransac_ellipse.ransac_ellipse_fit_batched)
+register_delta('ellipse', get_ellipse_delta)
+
+
+# --------------------- Equivalence Harness ---------------------
+
+def get_stage_inputs(eye_imgs):
+
+    """ {stage: [args]} - inputs to each stage for every eye ROI, with earlier stages run by their references
+    """
+
+    inputs = dict((stage, []) for stage in stages)
+    backends = get_backends()
+
+    for eye_img in eye_imgs:
+        inputs['specular'].append((eye_img, False))
+        eye_img = backends['specular'](eye_img, False)
+
+        inputs['pupil'].append((eye_img, 25.0, 80.0))
+        inputs['eyelids'].append((eye_img, False))
+        u_eyelid, l_eyelid = backends['eyelids'](eye_img, False)
+
+        inputs['limbus_pts'].append((eye_img, 20, 1, False, None))
+        pts = eyelid_locator.filter_limbus_pts(u_eyelid, l_eyelid, backends['limbus_pts'](eye_img, 20, 1, False, None))
+
+        inputs['ellipse'].append((pts, eye_img, (0, 0), 5, 3, 3, False, None))
+
+    return inputs
+
+
+def run_backend(func, args):
+
+    """ Output of func(*args), None when it finds nothing. Seeded, so RANSAC backends draw the same samples
+    """
+
+    random.seed(0)
+    np.random.seed(0)
+    try:
+        return func(*args)
+    except (ransac_ellipse.NoEllipseFound, ransac_ellipse.CoverageTooLow):
+        return None
+
+
+class BackendComparison:
+
+    def __init__(self, stage, candidate, reference, deltas, reference_ms, candidate_ms):
+
+        self.stage = stage
+        self.candidate = candidate
+        self.reference = reference
+        self.deltas = np.asarray(deltas, dtype=float)       # per input, inf where only one backend found anything
+        self.reference_ms = reference_ms                    # mean per call
+        self.candidate_ms = candidate_ms
+
+    def get_speed_up(self):
+        return self.reference_ms / max(self.candidate_ms, 1e-9)
+
+    def get_disagreements(self):
+        return int(np.sum(np.isinf(self.deltas)))
+
+    def get_summary(self):
+
+        finite = self.deltas[np.isfinite(self.deltas)]
+        median, worst = (np.median(finite), np.max(finite)) if len(finite) else (0.0, 0.0)
+        return '%s %s vs %s: %0.2f vs %0.2f ms (%0.2fx), delta median %0.2f, max %0.2f, %d/%d disagree' % (
+            self.stage, self.candidate, self.reference, self.candidate_ms, self.reference_ms, self.get_speed_up(),
+            median, worst, self.get_disagreements(), len(self.deltas))
+
+
+def compare_backends(stage, candidate, inputs, reference=None, num_iters=3):
+
+    """ Runs reference & candidate backends of stage on the same inputs ~ [args], returns a BackendComparison
+
+    Timings are the best of num_iters passes over all inputs, so one-off allocations & caching don't count
+    """
+
+    reference = reference or get_reference_name(stage)
+
+    results = {}
+    for name in [reference, candidate]:
+        func = get_backend(stage, name)
+        best_ms = np.inf
+        for _ in range(num_iters):
+            tick = time()
+            outputs = [run_backend(func, args) for args in inputs]
+            best_ms = min(best_ms, (time() - tick) * 1000 / max(len(inputs), 1))
+        results[name] = (outputs, best_ms)
+
+    (ref_outputs, ref_ms), (outputs, ms) = results[reference], results[candidate]
+    deltas = [__deltas[stage](ref_output, output, args) for (ref_output, output, args) in zip(ref_outputs, outputs, inputs)]
+
+    return BackendComparison(stage, candidate, reference, deltas, ref_ms, ms)
+
+
+def compare_all(eye_imgs, num_iters=3):
+
+    """ BackendComparison of every non-reference backend of every stage on eye_imgs
+    """
+
+    inputs = get_stage_inputs(eye_imgs)
+    return [compare_backends(stage, name, inputs[stage], num_iters=num_iters) for stage in stages
+            for name in get_backend_names(stage) if name != get_reference_name(stage)]
+
+
+#----------------------------------------
+# EXAMPLE USAGE
+#----------------------------------------
+if __name__ == '__main__':
+
+    import cv2
+    import glob
+
+    eye_imgs = []
+    for path in sorted(glob.glob('eye_images/*.png')):
+        eye_img = cv2.imread(path)
+        img_h, img_w = eye_img.shape[:2]
+        eye_imgs.append(np.ascontiguousarray(eye_img[:, (img_w - img_h) / 2:(img_w + img_h) / 2]))
+
+    for stage in stages:
+        print '%s: %s (reference %s)' % (stage, ', '.join(get_backend_names(stage)), get_reference_name(stage))
+
+    # Every reference compared against itself should show no deltas, and a speed-up of ~1
+    inputs = get_stage_inputs(eye_imgs)
+    print compare_backends('ellipse', 'ransac', inputs['ellipse']).get_summary()
+
+    for comparison in compare_all(eye_imgs):
+        print comparison.get_summary()
@@ -1,3 +1,6 @@
+import subprocess
+import sys
+
 from time import time
 
 class TimeProfiler:
@@ -32,3 +35,25 @@ class TimeProfiler:
             summary = summary + '%s: %0.2f ' % (section, (self.sections[section] / float(total)) * 100)
             
         return summary + ('[total: %d ms, %d hz]' % (total, int(1000 / total)))
+
+
+def time_import(module_name, python=sys.executable):
+    
+    """ Returns time (ms) to import a module in a fresh interpreter, so already-loaded modules don't hide the cost
+    """
+    
+    cmd = 'import time; tick = time.time(); import %s; print((time.time() - tick) * 1000)' % module_name
+    return float(subprocess.check_output([python, '-c', cmd]).strip())
+
+
+#----------------------------------------
+# EXAMPLE USAGE 
+#----------------------------------------
+if __name__ == '__main__':
+    
+    # Compute core should import quickly without VPython, PIL or a display
+    for module_name in ['conic_section', 'gaze_geometry', 'ransac_ellipse', 'eye_extractor', 'gaze_system']:
+        try:
+            print '%s: %0.1f ms' % (module_name, time_import(module_name))
+        except subprocess.CalledProcessError:
+            print '%s: failed to import' % module_name
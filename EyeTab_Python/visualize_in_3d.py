@@ -5,9 +5,13 @@ import gaze_geometry
 import image_utils
 import anatomical_constants
 
-from PIL import ImageGrab
 from visual import *
-import marker_manager
+
+try:
+    import marker_manager
+    get_marker_id_for_vis = marker_manager.get_marker_id_for_vis
+except ImportError:
+    get_marker_id_for_vis = lambda marker_ind : marker_ind   # Markers looked at in creation order
 
 # VPYTHON : GAZETRACKER
 # x, y, z : x, -y, z
@@ -120,7 +124,7 @@ class Visualizer3d:
         self.active_marker_ind = marker_ind
         
         # Translates marker index (order looked at) into order created by vpython
-        vis_marker_id = marker_manager.get_marker_id_for_vis(marker_ind)
+        vis_marker_id = get_marker_id_for_vis(marker_ind)
         
         if self.active_marker_vpy_id == vis_marker_id:return
         self.active_marker_vpy_id = vis_marker_id;
@@ -190,6 +194,7 @@ class Visualizer3d:
 
 
     def take_screenshot(self):
+        from PIL import ImageGrab                   # Windows-only, so only import when recording
         pil_img = ImageGrab.grab((win_os_margin_small,
                                   win_os_margin_large,
                                   self.win_w - win_os_margin_small,
@@ -197,7 +202,7 @@ class Visualizer3d:
         return image_utils.pil_to_cv2(pil_img)
         
           
-    def update_vis(self, limbuses, smoothed_gaze_pt_mm=None):
+    def update_vis(self, limbuses, smoothed_gaze_pt_mm=None, predicted_gaze_pt_mm=None):
         
         self.handle_keyboard()
         
@@ -268,6 +273,12 @@ class Visualizer3d:
                                                ("%.4f" % gaze_pos.x), ("%.4f" % gaze_pos.y),
                                                ("%.4f" % mag(limb_mid_pt)),
                                                ("%.4f" % dist_offset), ("%.4f" % x_offset), ("%.4f" % angle_offset)]])
+                    
+                    # Optionally followed by predicted gaze x,y, predicted dist_err
+                    if predicted_gaze_pt_mm is not None:
+                        pred_pos = vector(cvt_pt(predicted_gaze_pt_mm[0], predicted_gaze_pt_mm[1], 0))
+                        line_to_write += ',' + ','.join([("%.4f" % pred_pos.x), ("%.4f" % pred_pos.y),
+                                                         ("%.4f" % mag(correct_pos - pred_pos))])
                     self.eval_file.write(line_to_write + '\n')
                     
                 else: